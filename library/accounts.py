@@ -0,0 +1,45 @@
+from django.contrib.auth.models import User, UserManager
+from django.db import IntegrityError, transaction
+from django.db.models.functions import Lower
+
+from .models import UserProfile
+
+
+class RegistrationError(Exception):
+    def __init__(self, field, message):
+        super().__init__(message)
+        self.field = field
+        self.message = message
+
+
+def split_full_name(full_name):
+    names = full_name.split(' ', 1)
+    return names[0], names[1] if len(names) > 1 else ''
+
+
+# only runs after an insert failed, to tell the form which field clashed
+def duplicate_error(username, email):
+    if User.objects.annotate(username_lower=Lower('username')).filter(username_lower=username.lower()).exists():
+        return RegistrationError('username', 'This username is already taken.')
+    return RegistrationError('email', 'An account with this email already exists.')
+
+
+# one insert for the user and one for the profile, the unique indexes on
+# LOWER(username) and LOWER(email) do the duplicate checking
+def register_user(username, email, password, full_name, phone=''):
+    first_name, last_name = split_full_name(full_name)
+    user = User(
+        username=User.normalize_username(username),
+        email=UserManager.normalize_email(email),
+        first_name=first_name,
+        last_name=last_name,
+    )
+    user.set_password(password)
+
+    try:
+        with transaction.atomic():
+            user.save()
+            UserProfile.objects.create(user=user, phone=phone)
+    except IntegrityError:
+        raise duplicate_error(user.username, user.email)
+    return user
@@ -0,0 +1,126 @@
+from collections import defaultdict
+
+from django.contrib.auth.models import User
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Q, Sum
+from django.db.models.functions import Greatest, TruncMonth
+from django.utils import timezone
+
+from .events import add_months
+from .models import BorrowRecord, CategoryActivity, ReadingActivity, Review
+
+COUNTERS = ('borrowed', 'returned', 'returned_late', 'reviews', 'rating_total')
+
+
+def month_of(value):
+    if hasattr(value, 'tzinfo'):
+        value = timezone.localdate(value)
+    return value.replace(day=1)
+
+
+# adds to the counters of one row with F(), creating it on first use. a row
+# created by someone else in between is caught by the unique constraint.
+# a decrement never creates a row and never goes below zero
+def _bump(model, keys, counts):
+    counts = {field: n for field, n in counts.items() if n}
+    if not counts:
+        return
+    changes = {field: F(field) + n if n > 0 else Greatest(F(field) + n, 0) for field, n in counts.items()}
+    rows = model.objects.filter(**keys)
+    if rows.update(**changes) or min(counts.values()) < 0:
+        return
+    try:
+        with transaction.atomic():
+            model.objects.create(**keys, **counts)
+    except IntegrityError:
+        rows.update(**changes)
+
+
+def bump(user_id, month, **counts):
+    _bump(ReadingActivity, {'user_id': user_id, 'month': month}, counts)
+
+
+def borrowed(record, category_id):
+    bump(record.user_id, month_of(record.borrow_date), borrowed=1)
+    if category_id is not None:
+        _bump(CategoryActivity, {'user_id': record.user_id, 'category_id': category_id}, {'borrowed': 1})
+
+
+# (user_id, late) for every record returned on this day, one update per member
+def returned(rows, day):
+    counts = defaultdict(lambda: [0, 0])
+    for user_id, late in rows:
+        counts[user_id][0] += 1
+        counts[user_id][1] += late
+    for user_id, (total, late) in sorted(counts.items()):
+        bump(user_id, month_of(day), returned=total, returned_late=late)
+
+
+# count is -1 when a review is deleted, an edited rating passes 0 and the difference
+def reviewed(review, count=1, rating=None):
+    bump(review.user_id, month_of(review.created_at), reviews=count,
+         rating_total=count * review.rating if rating is None else rating)
+
+
+# the member's whole history from the first active month to this one, read in
+# one range query off the (user, month) index. quiet months are filled with zeros
+def history(user):
+    rows = {row.month: row for row in ReadingActivity.objects.filter(user=user, month__lte=month_of(timezone.now()))}
+    if not rows:
+        return []
+    months = []
+    month, last = min(rows), month_of(timezone.now())
+    while month <= last:
+        months.append(rows.get(month) or ReadingActivity(user=user, month=month))
+        month = add_months(month, 1)
+    return months
+
+
+def summary(user):
+    months = history(user)
+    totals = {field: sum(getattr(row, field) for row in months) for field in COUNTERS}
+    peak = max((row.borrowed for row in months), default=0)
+    for row in months:
+        row.height = round(row.borrowed * 100 / peak) if peak else 0
+    favourites = CategoryActivity.objects.filter(user=user, borrowed__gt=0).select_related('category')
+    return {
+        'months': months,
+        'totals': totals,
+        'average_rating': totals['rating_total'] / totals['reviews'] if totals['reviews'] else None,
+        'favourite_categories': list(favourites.order_by('-borrowed', 'category__name')[:3]),
+    }
+
+
+# recounts these members from BorrowRecord and Review and swaps their rows in
+# one transaction. their borrows wait on the user row lock until it is done
+def rebuild(user_ids):
+    user_ids = list(user_ids)
+    rows = defaultdict(dict)
+    with transaction.atomic():
+        list(User.objects.select_for_update().filter(pk__in=user_ids).values_list('pk'))
+        records = BorrowRecord.objects.filter(user_id__in=user_ids).order_by()
+        for row in records.annotate(m=TruncMonth('borrow_date')).values('user_id', 'm').annotate(n=Count('pk')):
+            rows[row['user_id'], row['m']]['borrowed'] = row['n']
+        returns = records.filter(is_returned=True, return_date__isnull=False).annotate(m=TruncMonth('return_date'))
+        for row in returns.values('user_id', 'm').annotate(
+            n=Count('pk'), late=Count('pk', filter=Q(return_date__gt=F('due_date'))),
+        ):
+            rows[row['user_id'], row['m']].update(returned=row['n'], returned_late=row['late'])
+        reviews = Review.objects.filter(user_id__in=user_ids).order_by().annotate(m=TruncMonth('created_at'))
+        for row in reviews.values('user_id', 'm').annotate(n=Count('pk'), total=Sum('rating')):
+            rows[row['user_id'], month_of(row['m'])].update(reviews=row['n'], rating_total=row['total'])
+        categories = records.filter(book__category__isnull=False).values('user_id', 'book__category_id').annotate(
+            n=Count('pk'),
+        )
+
+        ReadingActivity.objects.filter(user_id__in=user_ids).delete()
+        ReadingActivity.objects.bulk_create([
+            ReadingActivity(user_id=user_id, month=month_of(month), **counts)
+            for (user_id, month), counts in rows.items()
+        ], batch_size=1000)
+        CategoryActivity.objects.filter(user_id__in=user_ids).delete()
+        CategoryActivity.objects.bulk_create([
+            CategoryActivity(user_id=row['user_id'], category_id=row['book__category_id'], borrowed=row['n'])
+            for row in categories
+        ], batch_size=1000)
+    return len(rows)
@@ -1,52 +1,342 @@
-from django.contrib import admin
+from django.conf import settings
+from django.contrib import admin, messages
+from django.core.paginator import Paginator
+from django.db import OperationalError, connection, transaction
+from django.db.models import Avg, Count, DateField, ExpressionWrapper, F, Max, Q
+from django.utils import timezone
+from django.utils.functional import cached_property
+from datetime import timedelta
+
+from . import circulation, events
+from .codes import normalize_barcode, normalize_isbn
+from .exports import export_response
+from .uploads import reject_oversized
 from .models import (
-    Category, Author, Book, UserProfile,
+    Category, Author, Book, Branch, BranchStock, Copy, UserProfile,
     BorrowRecord, Review, ContactMessage,
-    VisitLog, SiteSettings,
+    VisitLog, SiteSettings, Task, Event,
 )
 
 
+# the planner's row count for a table, None when there are no statistics yet
+# (sqlite fills sqlite_stat1 on ANALYZE)
+def estimated_rows(table):
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute('SELECT reltuples FROM pg_class WHERE relname = %s', [table])
+            row = cursor.fetchone()
+            return int(row[0]) if row and row[0] > 0 else None
+        if connection.vendor == 'sqlite':
+            try:
+                cursor.execute('SELECT stat FROM sqlite_stat1 WHERE tbl = %s LIMIT 1', [table])
+            except OperationalError:
+                return None
+            row = cursor.fetchone()
+            return int(row[0].split()[0]) if row else None
+    return None
+
+
+# skips the full COUNT(*) on huge log tables when the changelist isnt filtered.
+# the estimate can be off by whatever changed since the statistics were taken, so
+# tables under ADMIN_EXACT_COUNT_LIMIT rows are counted exactly and their last
+# page always exists
+class EstimatedCountPaginator(Paginator):
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if queryset.query.where:
+            return super().count
+        estimate = estimated_rows(queryset.model._meta.db_table)
+        if estimate is None or estimate <= getattr(settings, 'ADMIN_EXACT_COUNT_LIMIT', 100000):
+            return super().count
+        return estimate
+
+
+# fixed list of methods so the filter doesnt run SELECT DISTINCT over every visit
+class MethodListFilter(admin.SimpleListFilter):
+    title = 'نوع الطلب'
+    parameter_name = 'method'
+
+    def lookups(self, request, model_admin):
+        return [(m, m) for m in ('GET', 'POST', 'PUT', 'PATCH', 'DELETE', 'HEAD')]
+
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(method=self.value())
+        return queryset
+
+
+
+# senders with more than one message in the last week, counted over the
+# created_at index. picking one is an equality lookup on the email index
+class FrequentSenderListFilter(admin.SimpleListFilter):
+    title = 'المرسلون المتكررون'
+    parameter_name = 'sender'
+
+    def lookups(self, request, model_admin):
+        recent = ContactMessage.objects.filter(created_at__gte=timezone.now() - timedelta(days=7))
+        senders = recent.order_by().values('email').annotate(n=Count('pk')).filter(n__gt=1).order_by('-n')[:10]
+        return [(row['email'], f'{row["email"]} ({row["n"]})') for row in senders]
+
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(email=self.value())
+        return queryset
+
+
+
+# uploads over MEDIA_UPLOAD_MAX_SIZE are dropped mid-stream, this reports them
+# on the form instead of saving the record without its image
+class UploadLimitMixin:
+    def get_form(self, request, obj=None, **kwargs):
+        form = super().get_form(request, obj, **kwargs)
+
+        class UploadLimitForm(form):
+            def clean(self):
+                cleaned = super().clean()
+                reject_oversized(request, self)
+                return cleaned
+
+        return UploadLimitForm
+
+
 
 @admin.register(Category)
-class CategoryAdmin(admin.ModelAdmin):
+class CategoryAdmin(UploadLimitMixin, admin.ModelAdmin):
     list_display = ['name', 'icon', 'book_count']
     search_fields = ['name']
     list_per_page = 20
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).annotate(_book_count=Count('books'))
+
+    @admin.display(description='عدد الكتب', ordering='_book_count')
+    def book_count(self, obj):
+        return obj._book_count
+
 
 
 @admin.register(Author)
-class AuthorAdmin(admin.ModelAdmin):
+class AuthorAdmin(UploadLimitMixin, admin.ModelAdmin):
     list_display = ['name', 'book_count']
     search_fields = ['name']
     list_per_page = 20
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).annotate(_book_count=Count('books'))
+
+    @admin.display(description='عدد الكتب', ordering='_book_count')
+    def book_count(self, obj):
+        return obj._book_count
+
+
+
+# read off the counter table, copies are added and withdrawn with the actions
+class BranchStockInline(admin.TabularInline):
+    model = BranchStock
+    fields = ['branch', 'total_copies', 'available_copies']
+    readonly_fields = fields
+    extra = 0
+    can_delete = False
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
 
 
 @admin.register(Book)
-class BookAdmin(admin.ModelAdmin):
-    list_display = ['title', 'author', 'category', 'total_copies', 'available_copies', 'average_rating', 'created_at']
-    list_filter = ['category', 'language', 'author']
+class BookAdmin(UploadLimitMixin, admin.ModelAdmin):
+    list_display = ['title', 'author', 'category', 'isbn', 'total_copies', 'available_copies', 'average_rating', 'created_at']
+    # author is searchable instead of listed, the filter sidebar would render every author
+    list_filter = ['category', 'language']
     search_fields = ['title', 'author__name', 'description']
+    list_select_related = ['author', 'category']
+    autocomplete_fields = ['author', 'category']
+    inlines = [BranchStockInline]
+    actions = ['add_copy', 'remove_copy', 'recompute_available_copies']
     list_per_page = 20
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).annotate(_average_rating=Avg('reviews__rating'))
+
+    # a scanned or typed ISBN in either form is one lookup on the unique index
+    def get_search_results(self, request, queryset, search_term):
+        isbn = normalize_isbn(search_term)
+        if isbn is not None:
+            return queryset.filter(isbn=isbn), False
+        return super().get_search_results(request, queryset, search_term)
+
+    def get_changeform_initial_data(self, request):
+        return {'total_copies': 1, **super().get_changeform_initial_data(request)}
+
+    # the counters follow the copies, only a new book says how many to shelve
+    def get_readonly_fields(self, request, obj=None):
+        if obj is None:
+            return ['available_copies']
+        return ['total_copies', 'available_copies']
+
+    def save_model(self, request, obj, form, change):
+        if change:
+            with transaction.atomic():
+                super().save_model(request, obj, form, change)
+                events.record(Event.BOOK_EDITED, book=obj, actor=request.user, fields=form.changed_data)
+            return
+        count = obj.total_copies
+        obj.total_copies = obj.available_copies = 0
+        with transaction.atomic():
+            super().save_model(request, obj, form, change)
+            events.record(Event.BOOK_EDITED, book=obj, actor=request.user, fields=form.changed_data, created=True)
+            if count:
+                circulation.add_copies(obj, circulation.default_branch(), count, request.user)
+        obj.refresh_from_db(fields=['total_copies', 'available_copies'])
+
+    @admin.display(description='متوسط التقييم', ordering='_average_rating')
+    def average_rating(self, obj):
+        if obj._average_rating is None:
+            return 0
+        return round(obj._average_rating, 1)
+
+    # one transaction and a few set-based queries for the whole selection
+    @admin.action(description='إضافة نسخة للكتب المحددة في الفرع الرئيسي')
+    def add_copy(self, request, queryset):
+        branch = circulation.default_branch()
+        updated = circulation.stock_copies(queryset.values_list('pk', flat=True), branch, actor=request.user)
+        self.message_user(request, f'Added a copy to {updated} book(s) at {branch}.', messages.SUCCESS)
+
+    # the newest copy on the shelf of each book, books with none available are skipped
+    @admin.action(description='إزالة نسخة متاحة من الكتب المحددة')
+    def remove_copy(self, request, queryset):
+        newest = Copy.objects.filter(book__in=queryset, status=Copy.AVAILABLE).order_by().values('book_id').annotate(
+            newest=Max('pk'),
+        ).values('newest')
+        updated = circulation.withdraw_copies(Copy.objects.filter(pk__in=newest), request.user)
+        self.message_user(request, f'Removed a copy from {updated} book(s).', messages.SUCCESS)
+
+    # fixes drifted counters from the copies themselves
+    @admin.action(description='إعادة حساب النسخ المتاحة')
+    def recompute_available_copies(self, request, queryset):
+        updated = circulation.rebuild_stock(queryset, request.user)
+        self.message_user(request, f'Recomputed available copies for {updated} book(s).', messages.SUCCESS)
+
+
+
+@admin.register(Branch)
+class BranchAdmin(admin.ModelAdmin):
+    list_display = ['name', 'code', 'address']
+    search_fields = ['name', 'code']
+    list_per_page = 20
+
+
+
+@admin.register(Copy)
+class CopyAdmin(admin.ModelAdmin):
+    list_display = ['barcode', 'book', 'branch', 'status', 'added_at']
+    list_filter = ['status', 'branch']
+    search_fields = ['barcode', 'book__title']
+    list_select_related = ['book', 'branch']
+    autocomplete_fields = ['book']
+    actions = ['withdraw']
+    list_per_page = 50
+
+    # a scanned barcode is an exact match on the unique index, titles fall back to the usual search
+    def get_search_results(self, request, queryset, search_term):
+        exact = queryset.filter(barcode=normalize_barcode(search_term)) if search_term.strip() else queryset.none()
+        if exact.exists():
+            return exact, False
+        return super().get_search_results(request, queryset, search_term)
+
+    # status and placement only change through circulation, which moves the counters too
+    def get_readonly_fields(self, request, obj=None):
+        if obj is None:
+            return ['status']
+        return ['book', 'branch', 'status']
+
+    def save_model(self, request, obj, form, change):
+        if change:
+            super().save_model(request, obj, form, change)
+            return
+        with transaction.atomic():
+            super().save_model(request, obj, form, change)
+            BranchStock.objects.get_or_create(book=obj.book, branch=obj.branch)
+            circulation.shift_stock(obj.book_id, obj.branch_id, total=1, available=1)
+            circulation.refresh_facets([obj.book_id])
+            events.record(Event.COPIES_ADJUSTED, book=obj.book_id, branch=obj.branch_id, copy=obj,
+                          actor=request.user, total=1, available=1)
+
+    # single and bulk deletes both take the copies out of the counters
+    def delete_model(self, request, obj):
+        circulation.delete_copies(Copy.objects.filter(pk=obj.pk), request.user)
+
+    def delete_queryset(self, request, queryset):
+        circulation.delete_copies(queryset, request.user)
+
+    @admin.action(description='سحب النسخ المحددة من التداول')
+    def withdraw(self, request, queryset):
+        updated = circulation.withdraw_copies(queryset, request.user)
+        self.message_user(request, f'Withdrew {updated} copy(ies), copies on loan were skipped.', messages.SUCCESS)
+
 
 
 @admin.register(UserProfile)
-class UserProfileAdmin(admin.ModelAdmin):
+class UserProfileAdmin(UploadLimitMixin, admin.ModelAdmin):
     list_display = ['user', 'phone', 'currently_borrowed_count', 'total_borrowed_count']
     search_fields = ['user__username', 'user__email', 'phone']
+    list_select_related = ['user']
+    autocomplete_fields = ['user']
     list_per_page = 20
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).annotate(
+            _currently_borrowed=Count('user__borrows', filter=Q(user__borrows__is_returned=False)),
+            _total_borrowed=Count('user__borrows'),
+        )
+
+    @admin.display(description='الاستعارات الحالية', ordering='_currently_borrowed')
+    def currently_borrowed_count(self, obj):
+        return obj._currently_borrowed
+
+    @admin.display(description='إجمالي الاستعارات', ordering='_total_borrowed')
+    def total_borrowed_count(self, obj):
+        return obj._total_borrowed
+
 
 
 @admin.register(BorrowRecord)
 class BorrowRecordAdmin(admin.ModelAdmin):
-    list_display = ['user', 'book', 'borrow_date', 'due_date', 'return_date', 'is_returned']
-    list_filter = ['is_returned', 'borrow_date']
-    search_fields = ['user__username', 'book__title']
+    list_display = ['user', 'book', 'copy', 'borrow_date', 'due_date', 'return_date', 'is_returned']
+    list_filter = ['is_returned', 'borrow_date', 'book__category']
+    search_fields = ['user__username', 'book__title', 'copy__barcode']
+    list_select_related = ['user', 'book', 'copy']
+    autocomplete_fields = ['user', 'book', 'copy']
+    # newest first by primary key so the page is read straight off the index
+    ordering = ['-id']
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    actions = ['mark_returned', 'extend_due_date', 'export_csv', 'export_xlsx']
     list_per_page = 20
 
+    # frees the copies and moves the counters with one UPDATE per book and branch
+    @admin.action(description='تسجيل إرجاع السجلات المحددة')
+    def mark_returned(self, request, queryset):
+        updated = len(circulation.return_records(queryset, request.user))
+        self.message_user(request, f'Marked {updated} record(s) as returned.', messages.SUCCESS)
+
+    @admin.action(description='تمديد موعد الإرجاع أسبوعاً')
+    def extend_due_date(self, request, queryset):
+        updated = queryset.filter(is_returned=False).update(due_date=ExpressionWrapper(
+            F('due_date') + timedelta(days=7), output_field=DateField(),
+        ))
+        self.message_user(request, f'Extended the due date of {updated} record(s) by 7 days.', messages.SUCCESS)
+
+    # streamed, so "select all" over the filtered changelist works on any table size
+    @admin.action(description='تصدير السجلات المحددة (CSV)')
+    def export_csv(self, request, queryset):
+        return export_response('borrows', queryset, 'csv')
+
+    @admin.action(description='تصدير السجلات المحددة (Excel)')
+    def export_xlsx(self, request, queryset):
+        return export_response('borrows', queryset, 'xlsx')
+
 
 
 @admin.register(Review)
@@ -54,6 +344,8 @@ class ReviewAdmin(admin.ModelAdmin):
     list_display = ['user', 'book', 'rating', 'created_at']
     list_filter = ['rating']
     search_fields = ['user__username', 'book__title', 'comment']
+    list_select_related = ['user', 'book']
+    autocomplete_fields = ['user', 'book']
     list_per_page = 20
 
 
@@ -61,18 +353,58 @@ class ReviewAdmin(admin.ModelAdmin):
 @admin.register(ContactMessage)
 class ContactMessageAdmin(admin.ModelAdmin):
     list_display = ['name', 'email', 'subject', 'created_at']
+    list_filter = ['created_at', FrequentSenderListFilter]
     search_fields = ['name', 'email', 'subject', 'message']
+    actions = ['delete_from_senders']
     list_per_page = 20
 
+    # clears out a flood in one go, every message from the senders of the selected ones
+    @admin.action(description='حذف كل رسائل المرسلين المحددين', permissions=['delete'])
+    def delete_from_senders(self, request, queryset):
+        emails = set(queryset.values_list('email', flat=True))
+        deleted, _ = ContactMessage.objects.filter(email__in=emails).delete()
+        self.message_user(request, f'Deleted {deleted} message(s) from {len(emails)} sender(s).', messages.SUCCESS)
+
 
 
 @admin.register(VisitLog)
 class VisitLogAdmin(admin.ModelAdmin):
     list_display = ['path', 'method', 'ip_address', 'timestamp']
-    list_filter = ['method']
+    list_filter = [MethodListFilter]
     search_fields = ['path', 'ip_address']
+    ordering = ['-id']
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    actions = ['export_csv', 'export_xlsx']
     list_per_page = 50
 
+    @admin.action(description='تصدير الزيارات المحددة (CSV)')
+    def export_csv(self, request, queryset):
+        return export_response('visits', queryset, 'csv')
+
+    @admin.action(description='تصدير الزيارات المحددة (Excel)')
+    def export_xlsx(self, request, queryset):
+        return export_response('visits', queryset, 'xlsx')
+
+
+
+@admin.register(Task)
+class TaskAdmin(admin.ModelAdmin):
+    list_display = ['name', 'status', 'attempts', 'run_at', 'created_at', 'finished_at']
+    list_filter = ['status', 'name']
+    search_fields = ['name', 'idempotency_key']
+    readonly_fields = ['attempts', 'locked_until', 'locked_by', 'last_error', 'created_at', 'finished_at']
+    ordering = ['-id']
+    actions = ['retry_now']
+    list_per_page = 50
+
+    @admin.action(description='إعادة تشغيل المهام المحددة الآن')
+    def retry_now(self, request, queryset):
+        updated = queryset.exclude(status=Task.RUNNING).update(
+            status=Task.PENDING, attempts=0, run_at=timezone.now(), locked_until=None, locked_by='', finished_at=None,
+        )
+        self.message_user(request, f'Queued {updated} task(s) again.', messages.SUCCESS)
+
 
 
 @admin.register(SiteSettings)
@@ -89,6 +421,34 @@ class SiteSettingsAdmin(admin.ModelAdmin):
     def has_delete_permission(self, request, obj=None):
         return False
 
+    def save_model(self, request, obj, form, change):
+        with transaction.atomic():
+            super().save_model(request, obj, form, change)
+            if form.changed_data:
+                events.record(Event.SETTINGS_CHANGED, actor=request.user,
+                              **{field: form.cleaned_data[field] for field in form.changed_data})
+
+
+
+@admin.register(Event)
+class EventAdmin(admin.ModelAdmin):
+    list_display = ['occurred_at', 'kind', 'book_id', 'user_id', 'actor_id', 'copy_id', 'branch_id', 'data']
+    list_filter = ['kind']
+    ordering = ['-id']
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    list_per_page = 50
+
+    # the log is append-only, the admin can only read it
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
 
 
 admin.site.site_header = 'لوحة تحكم المكتبة'
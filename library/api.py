@@ -0,0 +1,189 @@
+import base64
+import hashlib
+import json
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import Http404, HttpResponse, HttpResponseNotModified, JsonResponse, StreamingHttpResponse
+from django.urls import reverse
+from django.utils.http import parse_etags
+from django.views.decorators.http import require_GET
+
+from .codes import normalize_isbn
+from .models import Author, Book, Category, Review
+
+
+# public field name -> ORM path, only these columns are ever selected
+RESOURCES = {
+    'books': {
+        'model': Book,
+        'fields': {
+            'id': 'id',
+            'title': 'title',
+            'isbn': 'isbn',
+            'author': 'author_id',
+            'author_name': 'author__name',
+            'category': 'category_id',
+            'category_name': 'category__name',
+            'cover': 'cover',
+            'description': 'description',
+            'publication_year': 'publication_year',
+            'pages': 'pages',
+            'language': 'language',
+            'total_copies': 'total_copies',
+            'available_copies': 'available_copies',
+            'created_at': 'created_at',
+        },
+        'filters': {'author': 'author_id', 'category': 'category_id', 'language': 'language', 'isbn': 'isbn'},
+    },
+    'authors': {
+        'model': Author,
+        'fields': {'id': 'id', 'name': 'name', 'photo': 'photo', 'bio': 'bio'},
+        'filters': {},
+    },
+    'categories': {
+        'model': Category,
+        'fields': {'id': 'id', 'name': 'name', 'icon': 'icon', 'image': 'image', 'description': 'description'},
+        'filters': {},
+    },
+    'reviews': {
+        'model': Review,
+        'fields': {
+            'id': 'id',
+            'book': 'book_id',
+            'user': 'user__username',
+            'rating': 'rating',
+            'comment': 'comment',
+            'created_at': 'created_at',
+        },
+        'filters': {'book': 'book_id'},
+    },
+}
+
+# filter values in the form they are stored, None when nothing can match
+FILTER_VALUES = {'isbn': normalize_isbn}
+
+# stored as file names, sent back as urls
+FILE_FIELDS = {'cover', 'photo', 'image'}
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 200
+
+
+def get_resource(name):
+    try:
+        return RESOURCES[name]
+    except KeyError:
+        raise Http404('Unknown resource')
+
+
+# ?fields=id,title picks columns, unknown names are dropped
+def selected_fields(request, resource):
+    available = resource['fields']
+    requested = [f for f in request.GET.get('fields', '').split(',') if f in available]
+    if 'id' not in requested:
+        requested.insert(0, 'id')
+    return requested if len(requested) > 1 else list(available)
+
+
+def base_queryset(request, resource, fields):
+    queryset = resource['model'].objects.order_by('id')
+    for param, lookup in resource['filters'].items():
+        value = request.GET.get(param)
+        if not value:
+            continue
+        if param in FILTER_VALUES:
+            value = FILTER_VALUES[param](value)
+        # a non numeric id or a bad isbn can never match
+        if value is None or lookup.endswith('_id') and not value.isdigit():
+            return queryset.none().values_list(*[resource['fields'][f] for f in fields])
+        queryset = queryset.filter(**{lookup: value})
+    return queryset.values_list(*[resource['fields'][f] for f in fields])
+
+
+def to_dict(fields, row):
+    item = dict(zip(fields, row))
+    for name in FILE_FIELDS.intersection(item):
+        item[name] = settings.MEDIA_URL + item[name] if item[name] else None
+    return item
+
+
+def encode_cursor(last_id):
+    return base64.urlsafe_b64encode(str(last_id).encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        return int(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+
+# strong ETag over the exact body, answers 304 when the client already has it
+def etag_response(request, payload):
+    body = json.dumps(payload, cls=DjangoJSONEncoder, ensure_ascii=False, separators=(',', ':')).encode()
+    etag = '"%s"' % hashlib.sha256(body).hexdigest()[:32]
+
+    if etag in parse_etags(request.headers.get('If-None-Match', '')):
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(body, content_type='application/json')
+    response['ETag'] = etag
+    return response
+
+
+@require_GET
+def resource_list(request, resource_name):
+    resource = get_resource(resource_name)
+    fields = selected_fields(request, resource)
+
+    try:
+        limit = min(max(int(request.GET.get('limit', DEFAULT_LIMIT)), 1), MAX_LIMIT)
+    except ValueError:
+        limit = DEFAULT_LIMIT
+
+    # keyset pagination on id, no OFFSET scans on deep pages
+    rows = base_queryset(request, resource, fields)
+    cursor = request.GET.get('cursor')
+    if cursor:
+        after = decode_cursor(cursor)
+        if after is None:
+            return JsonResponse({'error': 'Invalid cursor'}, status=400)
+        rows = rows.filter(id__gt=after)
+    rows = list(rows[:limit + 1])
+
+    next_url = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        params = request.GET.copy()
+        params['cursor'] = encode_cursor(rows[-1][0])
+        next_url = reverse('api_list', args=[resource_name]) + '?' + params.urlencode()
+
+    return etag_response(request, {
+        'results': [to_dict(fields, row) for row in rows],
+        'next': next_url,
+    })
+
+
+@require_GET
+def resource_detail(request, resource_name, id):
+    resource = get_resource(resource_name)
+    fields = selected_fields(request, resource)
+    row = base_queryset(request, resource, fields).filter(id=id).first()
+    if row is None:
+        raise Http404('Not found')
+    return etag_response(request, to_dict(fields, row))
+
+
+# whole table as newline delimited json, streamed in chunks so memory stays flat
+@require_GET
+def resource_export(request, resource_name):
+    resource = get_resource(resource_name)
+    fields = selected_fields(request, resource)
+    rows = base_queryset(request, resource, fields).iterator(chunk_size=2000)
+
+    encoder = DjangoJSONEncoder(ensure_ascii=False, separators=(',', ':'))
+    lines = (encoder.encode(to_dict(fields, row)) + '\n' for row in rows)
+    response = StreamingHttpResponse(lines, content_type='application/x-ndjson')
+    response['Content-Disposition'] = f'attachment; filename="{resource_name}.ndjson"'
+    return response
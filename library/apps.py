@@ -4,3 +4,8 @@ from django.apps import AppConfig
 class LibraryConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'library'
+
+    def ready(self):
+        from . import sessions  # noqa: F401
+        from . import signals  # noqa: F401
+        from . import tasks  # noqa: F401
@@ -0,0 +1,84 @@
+from django.conf import settings
+from django.contrib.auth.backends import ModelBackend
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db.models import Q
+from django.db.models.functions import Lower
+
+
+# one query for "username or email", matched against the LOWER(email) index
+def find_account(identifier):
+    candidates = list(
+        User.objects.annotate(email_lower=Lower('email'))
+        .filter(Q(username=identifier) | Q(email_lower=identifier.strip().lower()))[:2]
+    )
+    # an exact username wins over somebody elses email
+    user = next((u for u in candidates if u.username == identifier), None)
+    if user is None and candidates:
+        user = candidates[0]
+    return user
+
+
+# login_view looks the account up once for the throttle and passes it on
+UNRESOLVED = object()
+
+
+class EmailOrUsernameBackend(ModelBackend):
+    def authenticate(self, request, username=None, password=None, account=UNRESOLVED, **kwargs):
+        if username is None or password is None:
+            return None
+
+        user = find_account(username) if account is UNRESOLVED else account
+        if user is None:
+            # hash anyway so a missing account takes as long as a wrong password
+            User().set_password(password)
+            return None
+
+        if user.check_password(password) and self.user_can_authenticate(user):
+            return user
+        return None
+
+
+# REMOTE_ADDR, unless it is one of our own proxies. then X-Forwarded-For is read
+# from the right, past the proxies, since a client can put anything on its left
+def client_ip(request):
+    ip = request.META.get('REMOTE_ADDR', '')
+    trusted = getattr(settings, 'TRUSTED_PROXIES', ())
+    if ip not in trusted:
+        return ip
+    hops = [hop.strip() for hop in request.META.get('HTTP_X_FORWARDED_FOR', '').split(',') if hop.strip()]
+    for hop in reversed(hops):
+        if hop not in trusted:
+            return hop
+    return hops[0] if hops else ip
+
+
+# failures count against the account, whether it was named by username or
+# email, so switching between the two gets no extra guesses. unknown names
+# count on their own. account is find_account(identifier)
+def login_throttle_keys(request, identifier, account):
+    name = f'user:{account.pk}' if account is not None else identifier.strip().lower()
+    return [
+        (f'library:login_fail:ip:{client_ip(request)}', settings.LOGIN_FAILURE_LIMIT_IP),
+        (f'library:login_fail:account:{name}', settings.LOGIN_FAILURE_LIMIT_ACCOUNT),
+    ]
+
+
+# checked before any password hashing so brute force traffic is cheap to reject
+def login_throttled(keys):
+    counts = cache.get_many([key for key, _ in keys])
+    return any(counts.get(key, 0) >= limit for key, limit in keys)
+
+
+def record_login_failure(keys):
+    for key, _ in keys:
+        # add only sets the window on the first failure, incr keeps it
+        cache.add(key, 0, settings.LOGIN_FAILURE_WINDOW)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, 1, settings.LOGIN_FAILURE_WINDOW)
+
+
+def reset_login_failures(keys):
+    cache.delete(keys[1][0])
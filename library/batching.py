@@ -0,0 +1,83 @@
+import logging
+import os
+import threading
+
+from django.conf import settings
+from django.db import InterfaceError, OperationalError, close_old_connections
+
+
+logger = logging.getLogger(__name__)
+
+
+# requests only append to a list in memory, a background thread writes the list
+# with one bulk INSERT every <PREFIX>_FLUSH_INTERVAL seconds or <PREFIX>_BATCH_SIZE
+# rows. whatever is still buffered when the process is killed outright is lost.
+# after_flush gets the written rows, with their primary keys where the database
+# returns them
+class BatchWriter:
+    def __init__(self, model, prefix, written, dropped, after_flush=None):
+        self.model = model
+        self.prefix = prefix
+        self.written = written
+        self.dropped = dropped
+        self.after_flush = after_flush
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.pending = []
+        self.thread = None
+        self.pid = None
+
+    def setting(self, name, default):
+        return getattr(settings, f'{self.prefix}_{name}', default)
+
+    def add(self, row):
+        with self.lock:
+            if self.pid != os.getpid():
+                # a forked worker doesnt inherit the parent's thread, only its buffer
+                self.pending, self.thread, self.pid = [], None, os.getpid()
+            if len(self.pending) >= self.setting('BUFFER_MAX', 50000):
+                self.dropped.inc()
+                return False
+            self.pending.append(row)
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self.run, name=f'{self.model._meta.model_name}-writer', daemon=True,
+                )
+                self.thread.start()
+            if len(self.pending) >= self.setting('BATCH_SIZE', 500):
+                self.wake.set()
+        return True
+
+    def run(self):
+        while True:
+            self.wake.wait(self.setting('FLUSH_INTERVAL', 1.0))
+            self.wake.clear()
+            self.flush()
+            close_old_connections()
+
+    def flush(self):
+        with self.lock:
+            batch, self.pending = self.pending, []
+        if not batch:
+            return 0
+        try:
+            self.model.objects.bulk_create(batch, batch_size=self.setting('BATCH_SIZE', 500))
+        except (OperationalError, InterfaceError):
+            # database unreachable, keep the rows for the next round while there is room
+            logger.exception('Could not write %d %s row(s), will retry', len(batch), self.model._meta.model_name)
+            with self.lock:
+                room = max(self.setting('BUFFER_MAX', 50000) - len(self.pending), 0)
+                self.pending[:0] = batch[:room]
+            self.dropped.inc(max(len(batch) - room, 0))
+            return 0
+        except Exception:
+            logger.exception('Could not write %d %s row(s)', len(batch), self.model._meta.model_name)
+            self.dropped.inc(len(batch))
+            return 0
+        self.written.inc(len(batch))
+        if self.after_flush is not None:
+            try:
+                self.after_flush(batch)
+            except Exception:
+                logger.exception('after_flush failed for %d %s row(s)', len(batch), self.model._meta.model_name)
+        return len(batch)
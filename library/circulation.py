@@ -0,0 +1,278 @@
+from collections import Counter, defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Count, F, OuterRef, Q, Subquery, Sum
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from . import activity, events
+from .facets import index as facet_index
+from .models import Book, BorrowRecord, Branch, BranchStock, Copy, Event
+from .recommendations import invalidate_for_you
+
+BORROW_LIMIT = 5
+LOAN_DAYS = 14
+
+
+class CirculationError(Exception):
+    def __init__(self, outcome, message):
+        super().__init__(message)
+        self.outcome = outcome
+        self.message = message
+
+
+def default_branch():
+    branch, _ = Branch.objects.get_or_create(
+        code=getattr(settings, 'LIBRARY_DEFAULT_BRANCH', 'MAIN'), defaults={'name': 'Main Library'},
+    )
+    return branch
+
+
+# counters are moved with F() so concurrent borrows never overwrite each other
+def shift_stock(book_id, branch_id, total=0, available=0):
+    shift_stocks({(book_id, branch_id): (total, available)})
+
+
+# (book_id, branch_id) -> (total, available) changes for many books at once, one
+# UPDATE per branch and distinct change rather than one per book
+def shift_stocks(changes):
+    by_branch, by_book = defaultdict(list), defaultdict(lambda: [0, 0])
+    for (book_id, branch_id), (total, available) in changes.items():
+        by_branch[(branch_id, total, available)].append(book_id)
+        by_book[book_id][0] += total
+        by_book[book_id][1] += available
+    for (branch_id, total, available), book_ids in by_branch.items():
+        BranchStock.objects.filter(book_id__in=book_ids, branch_id=branch_id).update(
+            total_copies=F('total_copies') + total,
+            available_copies=F('available_copies') + available,
+        )
+    by_change = defaultdict(list)
+    for book_id, (total, available) in by_book.items():
+        by_change[(total, available)].append(book_id)
+    for (total, available), book_ids in by_change.items():
+        Book.objects.filter(pk__in=book_ids).update(
+            total_copies=F('total_copies') + total,
+            available_copies=F('available_copies') + available,
+        )
+
+
+# queryset updates skip post_save, so the facet index is told once the change is committed
+def refresh_facets(book_ids):
+    def refresh():
+        if facet_index.is_tracking():
+            for book in Book.objects.filter(pk__in=book_ids):
+                facet_index.update_book(book)
+    transaction.on_commit(refresh)
+
+
+# generated barcodes are <book id>-<number>. numbering goes on from the highest
+# one in use, so a deleted copy never hands its barcode to a new one. call with
+# the book rows locked, two admins adding copies then take turns
+def next_barcodes(book_ids, count):
+    last = dict.fromkeys(book_ids, 0)
+    for book_id, barcode in Copy.objects.filter(book_id__in=book_ids).values_list('book_id', 'barcode'):
+        prefix, _, number = barcode.partition('-')
+        if prefix == f'{book_id:06d}' and number.isdigit():
+            last[book_id] = max(last[book_id], int(number))
+    return {
+        book_id: [f'{book_id:06d}-{number:03d}' for number in range(last[book_id] + 1, last[book_id] + count + 1)]
+        for book_id in book_ids
+    }
+
+
+# count new copies of every book at one branch, a few queries for the whole selection
+def stock_copies(book_ids, branch, count=1, actor=None):
+    with transaction.atomic():
+        book_ids = list(Book.objects.select_for_update().filter(pk__in=book_ids).order_by('pk').values_list('pk', flat=True))
+        if not book_ids or count < 1:
+            return 0
+        barcodes = next_barcodes(book_ids, count)
+        Copy.objects.bulk_create([
+            Copy(book_id=book_id, branch=branch, barcode=barcode)
+            for book_id in book_ids for barcode in barcodes[book_id]
+        ], batch_size=1000)
+        BranchStock.objects.bulk_create(
+            [BranchStock(book_id=book_id, branch=branch) for book_id in book_ids], ignore_conflicts=True,
+        )
+        shift_stocks({(book_id, branch.pk): (count, count) for book_id in book_ids})
+        refresh_facets(book_ids)
+        for book_id in book_ids:
+            events.record(Event.COPIES_ADJUSTED, book=book_id, branch=branch, actor=actor, total=count, available=count)
+    return len(book_ids)
+
+
+def add_copies(book, branch, count=1, actor=None):
+    stock_copies([book.pk], branch, count, actor)
+
+
+# only copies on the shelf can be taken out of circulation, the rest of the
+# queryset is skipped. gives back how many were withdrawn
+def withdraw_copies(copies, actor=None):
+    with transaction.atomic():
+        rows = list(copies.filter(status=Copy.AVAILABLE).select_for_update().order_by('pk').values_list(
+            'pk', 'book_id', 'branch_id',
+        ))
+        if not rows:
+            return 0
+        Copy.objects.filter(pk__in=[row[0] for row in rows]).update(status=Copy.WITHDRAWN)
+        removed = Counter((book_id, branch_id) for _, book_id, branch_id in rows)
+        shift_stocks({key: (-n, -n) for key, n in removed.items()})
+        refresh_facets({row[1] for row in rows})
+        for pk, book_id, branch_id in rows:
+            events.record(Event.COPIES_ADJUSTED, book=book_id, branch=branch_id, copy=pk, actor=actor,
+                          total=-1, available=-1)
+    return len(rows)
+
+
+def withdraw_copy(copy, actor=None):
+    return bool(withdraw_copies(Copy.objects.filter(pk=copy.pk), actor))
+
+
+# a copy on loan stops counting towards the total, its loan keeps running
+# without it. withdrawn copies were already taken out of the counters
+def delete_copies(copies, actor=None):
+    with transaction.atomic():
+        rows = list(copies.select_for_update().order_by('pk').values_list('pk', 'book_id', 'branch_id', 'status'))
+        Copy.objects.filter(pk__in=[row[0] for row in rows]).delete()
+        changes = Counter()
+        for pk, book_id, branch_id, status in rows:
+            if status == Copy.WITHDRAWN:
+                continue
+            available = -1 if status == Copy.AVAILABLE else 0
+            changes[(book_id, branch_id, available)] += 1
+            events.record(Event.COPIES_ADJUSTED, book=book_id, branch=branch_id, copy=pk, actor=actor,
+                          total=-1, available=available, deleted=True)
+        removed = defaultdict(lambda: [0, 0])
+        for (book_id, branch_id, available), n in changes.items():
+            removed[(book_id, branch_id)][0] -= n
+            removed[(book_id, branch_id)][1] += available * n
+        shift_stocks({key: tuple(value) for key, value in removed.items()})
+        refresh_facets({row[1] for row in rows})
+    return len(rows)
+
+
+# a free copy, from the given branch or the one with the most on the shelf, or
+# the exact copy that was scanned. the conditional update is what claims it, two
+# borrowers can read the same row
+def take_copy(book, branch=None, copy=None):
+    if copy is not None:
+        if Copy.objects.filter(pk=copy.pk, status=Copy.AVAILABLE).update(status=Copy.ON_LOAN):
+            copy.status = Copy.ON_LOAN
+            return copy
+        return None
+    stock = BranchStock.objects.filter(book=book, available_copies__gt=0)
+    if branch is not None:
+        stock = stock.filter(branch=branch)
+    for branch_id in stock.order_by('-available_copies').values_list('branch_id', flat=True):
+        candidates = Copy.objects.filter(book=book, branch_id=branch_id, status=Copy.AVAILABLE).order_by('pk')
+        for copy in candidates[:5]:
+            if Copy.objects.filter(pk=copy.pk, status=Copy.AVAILABLE).update(status=Copy.ON_LOAN):
+                copy.status = Copy.ON_LOAN
+                return copy
+    return None
+
+
+def check_can_borrow(user, book):
+    active = BorrowRecord.objects.filter(user=user, is_returned=False)
+    if active.filter(book=book).exists():
+        raise CirculationError('already_borrowing', 'You already have this book borrowed.')
+    if active.count() >= BORROW_LIMIT:
+        raise CirculationError('limit_reached', f'You have reached the maximum of {BORROW_LIMIT} borrowed books.')
+
+
+def borrow(user, book, branch=None, copy=None, actor=None):
+    with transaction.atomic():
+        # serialises borrows by the same user so two requests cant both pass the limit
+        User.objects.select_for_update().get(pk=user.pk)
+        check_can_borrow(user, book)
+        copy = take_copy(book, branch, copy)
+        if copy is None:
+            raise CirculationError('unavailable', 'This book has no available copies right now.')
+        record = BorrowRecord.objects.create(
+            user=user, book=book, copy=copy, due_date=timezone.now().date() + timedelta(days=LOAN_DAYS),
+        )
+        shift_stock(book.pk, copy.branch_id, available=-1)
+        refresh_facets([book.pk])
+        activity.borrowed(record, book.category_id)
+        events.record(Event.BORROWED, book=book, user=user, actor=actor or user, copy=copy, branch=copy.branch_id)
+    return record
+
+
+# returns every open record in the queryset with a handful of UPDATEs, one per
+# branch and count touched. gives back the ids of the records it returned
+def return_records(records, actor=None):
+    with transaction.atomic():
+        active = records.filter(is_returned=False).select_for_update(of=('self',)).order_by()
+        rows = list(active.values_list('pk', 'book_id', 'copy_id', 'copy__branch_id', 'user_id', 'due_date'))
+        if not rows:
+            return []
+        returned = [row[0] for row in rows]
+        today = timezone.now().date()
+        BorrowRecord.objects.filter(pk__in=returned).update(is_returned=True, return_date=today)
+
+        # a copy withdrawn while it was out stays withdrawn
+        lent = set(Copy.objects.filter(
+            pk__in=[row[2] for row in rows if row[2]], status=Copy.ON_LOAN,
+        ).values_list('pk', flat=True))
+        Copy.objects.filter(pk__in=lent).update(status=Copy.AVAILABLE)
+        shelved = Counter((book_id, branch_id) for _, book_id, copy_id, branch_id, _, _ in rows if copy_id in lent)
+        shift_stocks({key: (0, count) for key, count in shelved.items()})
+        refresh_facets({row[1] for row in rows})
+        invalidate_for_you(row[4] for row in rows)
+        activity.returned([(user_id, today > due_date) for _, _, _, _, user_id, due_date in rows], today)
+        for _, book_id, copy_id, branch_id, user_id, _ in rows:
+            fields = {} if copy_id in lent else {'shelved': False}
+            events.record(Event.RETURNED, book=book_id, user=user_id, actor=actor or user_id, copy=copy_id,
+                          branch=branch_id, **fields)
+    return returned
+
+
+def return_record(record, actor=None):
+    if not return_records(BorrowRecord.objects.filter(pk=record.pk), actor):
+        raise CirculationError('already_returned', 'This book has already been returned.')
+
+
+# replaces the counters of these books with (book, branch) -> (total, available),
+# branches left out are dropped. logged as absolute adjustments, replay starts over from them
+def write_stock(book_ids, counters, actor=None):
+    with transaction.atomic():
+        previous = set(BranchStock.objects.filter(book_id__in=book_ids).values_list('book_id', 'branch_id'))
+        BranchStock.objects.filter(book_id__in=book_ids).delete()
+        BranchStock.objects.bulk_create([
+            BranchStock(book_id=book_id, branch_id=branch_id, total_copies=total, available_copies=available)
+            for (book_id, branch_id), (total, available) in counters.items()
+        ], batch_size=5000)
+        sums = BranchStock.objects.filter(book_id=OuterRef('pk')).order_by().values('book_id')
+        updated = Book.objects.filter(pk__in=book_ids).update(
+            total_copies=Coalesce(Subquery(sums.annotate(n=Sum('total_copies')).values('n')), 0),
+            available_copies=Coalesce(Subquery(sums.annotate(n=Sum('available_copies')).values('n')), 0),
+        )
+        refresh_facets(book_ids)
+        for book_id, branch_id in previous | set(counters):
+            total, available = counters.get((book_id, branch_id), (0, 0))
+            events.record(Event.COPIES_ADJUSTED, book=book_id, branch=branch_id, actor=actor,
+                          total=total, available=available, absolute=True)
+    return updated
+
+
+# rebuilds the branch and book counters from the copies themselves
+def rebuild_stock(books, actor=None):
+    book_ids = list(books.values_list('pk', flat=True))
+    counts = Copy.objects.filter(book_id__in=book_ids).exclude(status=Copy.WITHDRAWN).values(
+        'book_id', 'branch_id',
+    ).annotate(total=Count('pk'), available=Count('pk', filter=Q(status=Copy.AVAILABLE)))
+    return write_stock(book_ids, {
+        (row['book_id'], row['branch_id']): (row['total'], row['available']) for row in counts
+    }, actor)
+
+
+# branches holding each book, read from the counter table for a page of books
+def branch_availability(book_ids):
+    stock = BranchStock.objects.filter(book_id__in=book_ids, total_copies__gt=0).select_related('branch')
+    by_book = defaultdict(list)
+    for row in stock.order_by('branch__name'):
+        by_book[row.book_id].append(row)
+    return by_book
@@ -0,0 +1,65 @@
+import re
+
+from django.core.exceptions import ValidationError
+from django.db import models
+
+ISBN_CHARS_RE = re.compile(r'[\s-]')
+
+
+def isbn13_check_digit(first12):
+    total = sum(int(d) * (3 if i % 2 else 1) for i, d in enumerate(first12))
+    return str((10 - total % 10) % 10)
+
+
+# ISBN-10 or ISBN-13 with or without hyphens, always returned as ISBN-13.
+# None if the checksum is wrong
+def normalize_isbn(value):
+    digits = ISBN_CHARS_RE.sub('', value).upper()
+    if len(digits) == 10 and digits[:9].isdigit() and (digits[9].isdigit() or digits[9] == 'X'):
+        total = sum((10 - i) * (10 if d == 'X' else int(d)) for i, d in enumerate(digits))
+        if total % 11:
+            return None
+        first12 = '978' + digits[:9]
+        return first12 + isbn13_check_digit(first12)
+    if len(digits) == 13 and digits.isdigit() and digits[:3] in ('978', '979'):
+        return digits if isbn13_check_digit(digits[:12]) == digits[12] else None
+    return None
+
+
+# scanners add stray whitespace and some print lowercase letters
+def normalize_barcode(value):
+    return ''.join(value.split()).upper()
+
+
+# stored as ISBN-13 so both forms of the same book hit one unique index. lookups
+# go through get_prep_value too, filter(isbn='0-306-40615-2') finds 9780306406157
+class ISBNField(models.CharField):
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('max_length', 13)
+        super().__init__(*args, **kwargs)
+
+    def to_python(self, value):
+        value = super().to_python(value)
+        if not value:
+            return value
+        isbn = normalize_isbn(value)
+        if isbn is None:
+            raise ValidationError('Enter a valid ISBN-10 or ISBN-13.', code='invalid_isbn')
+        return isbn
+
+    def get_prep_value(self, value):
+        value = super().get_prep_value(value)
+        if not value:
+            # NULL, so books without an ISBN dont collide on the unique index
+            return None
+        return normalize_isbn(value) or value
+
+
+class BarcodeField(models.CharField):
+    def to_python(self, value):
+        value = super().to_python(value)
+        return normalize_barcode(value) if value else value
+
+    def get_prep_value(self, value):
+        value = super().get_prep_value(value)
+        return normalize_barcode(value) if value else value
@@ -0,0 +1,77 @@
+import hashlib
+import logging
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DatabaseError, transaction
+
+from .auth import client_ip
+from .metrics import contact_submissions
+from .taskqueue import enqueue
+from .tasks import notify_contact_message
+
+ACCEPTED = 'accepted'
+DUPLICATE = 'duplicate'
+THROTTLED = 'throttled'
+UNAVAILABLE = 'unavailable'
+
+logger = logging.getLogger(__name__)
+
+
+def _bucket_keys(request, email):
+    ip = client_ip(request)
+    return [
+        (f'library:contact:ip:{ip}', settings.CONTACT_IP_BURST, settings.CONTACT_IP_PER_HOUR),
+        (f'library:contact:email:{email.strip().lower()}', settings.CONTACT_EMAIL_BURST, settings.CONTACT_EMAIL_PER_HOUR),
+    ]
+
+
+# a token from the ip bucket and one from the email bucket, or neither. buckets
+# are (tokens, last refill) in the cache and refill continuously. two workers
+# reading the same bucket at once can let an extra message through, which is fine
+def take_tokens(request, email):
+    keys = _bucket_keys(request, email)
+    now = time.time()
+    stored = cache.get_many([key for key, _, _ in keys])
+    buckets = {}
+    for key, burst, per_hour in keys:
+        tokens, refilled = stored.get(key, (burst, now))
+        tokens = min(burst, tokens + (now - refilled) * per_hour / 3600)
+        if tokens < 1:
+            return False
+        buckets[key] = (tokens - 1, now)
+    # gone from the cache once it would be full again anyway
+    cache.set_many(buckets, max(3600 * burst / per_hour for _, burst, per_hour in keys))
+    return True
+
+
+def content_key(data):
+    text = '\0'.join([data['email'].strip().lower(), ' '.join(data['subject'].split()), ' '.join(data['message'].split())])
+    return f'library:contact:seen:{hashlib.sha256(text.encode()).hexdigest()}'
+
+
+# runs on a valid ContactForm. duplicates look accepted to the sender, so a
+# double submit or a bot replaying the same post learns nothing and costs no write.
+# the message is stored before the sender hears it was sent, and only a stored
+# message marks its content as seen, so a failed one can be sent again
+def intake(request, form):
+    data = form.cleaned_data
+    key = content_key(data)
+    if cache.get(key) is not None:
+        outcome = DUPLICATE
+    elif not take_tokens(request, data['email']):
+        outcome = THROTTLED
+    else:
+        try:
+            with transaction.atomic():
+                message = form.save()
+                # the email to staff goes out from the worker
+                enqueue(notify_contact_message, idempotency_key=f'contact:{message.pk}', message_id=message.pk)
+                transaction.on_commit(lambda: cache.set(key, 1, settings.CONTACT_DEDUP_WINDOW))
+            outcome = ACCEPTED
+        except DatabaseError:
+            logger.exception('Could not store a contact message')
+            outcome = UNAVAILABLE
+    contact_submissions.inc(outcome=outcome)
+    return outcome
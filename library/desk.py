@@ -0,0 +1,161 @@
+import json
+
+from django.conf import settings
+from django.db import transaction
+from django.http import JsonResponse
+from django.views.decorators.http import require_POST
+
+from . import circulation
+from .auth import find_account
+from .codes import normalize_barcode, normalize_isbn
+from .metrics import borrow_outcomes
+from .models import Book, BorrowRecord, Copy
+
+ACTIONS = ('auto', 'checkout', 'checkin')
+
+
+class ScanError(Exception):
+    pass
+
+
+# json {"user": ..., "codes": [...], "action": ...} from the desk page, or plain
+# form fields with one "code" per scan
+def read_scan(request):
+    if request.content_type == 'application/json':
+        try:
+            data = json.loads(request.body)
+        except ValueError:
+            raise ScanError('Send a JSON object.')
+        if not isinstance(data, dict):
+            raise ScanError('Send a JSON object.')
+        codes = data.get('codes', [data['code']] if 'code' in data else [])
+        member, action = data.get('user') or '', data.get('action') or 'auto'
+    else:
+        codes = request.POST.getlist('code')
+        member, action = request.POST.get('user', ''), request.POST.get('action') or 'auto'
+
+    if not isinstance(codes, list) or not all(isinstance(code, str) and code.strip() for code in codes):
+        raise ScanError('Codes must be a list of non-empty strings.')
+    if not codes:
+        raise ScanError('Scan at least one code.')
+    limit = getattr(settings, 'DESK_BATCH_LIMIT', 50)
+    if len(codes) > limit:
+        raise ScanError(f'At most {limit} codes can be sent at once.')
+    if action not in ACTIONS:
+        raise ScanError(f'Action must be one of {", ".join(ACTIONS)}.')
+    if not isinstance(member, str):
+        raise ScanError('The user must be a username or email.')
+    return member.strip(), codes, action
+
+
+# a scan is a copy barcode, or failing that an ISBN. two queries for the whole batch
+def resolve(codes):
+    barcodes = {code: normalize_barcode(code) for code in codes}
+    copies = Copy.objects.filter(barcode__in=set(barcodes.values())).select_related('book')
+    copies = {copy.barcode: copy for copy in copies}
+    isbns = {code: normalize_isbn(code) for code in codes if barcodes[code] not in copies}
+    books = Book.objects.in_bulk({isbn for isbn in isbns.values() if isbn}, field_name='isbn')
+    return {code: copies.get(barcodes[code]) or books.get(isbns.get(code)) for code in codes}
+
+
+def scan_result(code, action, outcome, message, book=None, record=None):
+    result = {'code': code, 'action': action, 'ok': outcome in ('borrowed', 'returned'),
+              'outcome': outcome, 'message': message}
+    if book is not None:
+        result['book'] = {'id': book.pk, 'title': book.title}
+    if record is not None:
+        result['copy'] = record.copy.barcode if record.copy_id else None
+        result['due_date'] = record.due_date
+        result['overdue'] = record.is_overdue()
+    return result
+
+
+# works out what each scan means, then does every return in one call and the
+# checkouts one by one, all in one transaction. results keep the scan order
+def process_scans(member, codes, action, actor=None):
+    targets = resolve(codes)
+    copy_ids = [target.pk for target in targets.values() if isinstance(target, Copy)]
+    book_ids = [target.pk for target in targets.values() if isinstance(target, Book)]
+    open_loans = BorrowRecord.objects.filter(is_returned=False).select_related('copy')
+    loans_by_copy = {record.copy_id: record for record in open_loans.filter(copy_id__in=copy_ids)}
+    loans_by_book = {}
+    if member is not None and book_ids:
+        loans_by_book = {record.book_id: record for record in open_loans.filter(user=member, book_id__in=book_ids)}
+
+    results = [None] * len(codes)
+    checkins, checkouts = [], []
+    for position, code in enumerate(codes):
+        target = targets[code]
+        if target is None:
+            results[position] = scan_result(code, action, 'unknown_code', 'No copy or book has this code.')
+            continue
+        if isinstance(target, Copy):
+            book, copy, record = target.book, target, loans_by_copy.get(target.pk)
+        else:
+            book, copy, record = target, None, loans_by_book.get(target.pk)
+
+        kind = action
+        if kind == 'auto':
+            kind = 'checkin' if record is not None else 'checkout'
+        if kind == 'checkin':
+            if record is None:
+                results[position] = scan_result(code, kind, 'not_on_loan', 'This copy is not on loan.', book)
+            else:
+                checkins.append((position, code, book, record))
+        elif member is None:
+            results[position] = scan_result(code, kind, 'no_member', 'Scan a member to check out.', book)
+        else:
+            checkouts.append((position, code, book, copy))
+
+    with transaction.atomic():
+        returned = set(circulation.return_records(
+            BorrowRecord.objects.filter(pk__in=[record.pk for _, _, _, record in checkins]), actor,
+        ))
+        for position, code, book, record in checkins:
+            if record.pk in returned:
+                returned.discard(record.pk)
+                results[position] = scan_result(code, 'checkin', 'returned', f'Returned "{book.title}".', book, record)
+            else:
+                # the same copy scanned twice, or returned elsewhere meanwhile
+                results[position] = scan_result(code, 'checkin', 'already_returned',
+                                                'This book has already been returned.', book)
+
+        for position, code, book, copy in checkouts:
+            try:
+                record = circulation.borrow(member, book, copy=copy, actor=actor)
+            except circulation.CirculationError as e:
+                results[position] = scan_result(code, 'checkout', e.outcome, e.message, book)
+            else:
+                results[position] = scan_result(code, 'checkout', 'borrowed',
+                                                f'Borrowed "{book.title}" until {record.due_date}.', book, record)
+
+    for result in results:
+        kind = {'checkout': 'borrow', 'checkin': 'return'}.get(result['action'], 'scan')
+        borrow_outcomes.inc(action=kind, outcome=result['outcome'])
+    return results
+
+
+# scanner endpoint for the circulation desk. a member plus one code checks out or
+# checks in in one round trip, a stack of returns goes in as one batch
+@require_POST
+def desk_scan(request):
+    if not (request.user.is_active and request.user.is_staff and request.user.has_perm('library.change_borrowrecord')):
+        return JsonResponse({'error': 'Desk staff only.'}, status=403)
+    try:
+        identifier, codes, action = read_scan(request)
+    except ScanError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    member = None
+    if identifier:
+        member = find_account(identifier)
+        if member is None:
+            return JsonResponse({'error': 'No member with this username or email.'}, status=404)
+
+    results = process_scans(member, codes, action, request.user)
+    return JsonResponse({
+        'member': {'id': member.pk, 'username': member.username} if member else None,
+        'results': results,
+        'ok': sum(result['ok'] for result in results),
+        'failed': sum(not result['ok'] for result in results),
+    })
@@ -0,0 +1,142 @@
+import atexit
+import re
+from collections import defaultdict
+from datetime import date
+
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .batching import BatchWriter
+from .metrics import events_dropped, events_written
+from .models import Event
+
+PARTITION_RE = re.compile(r'^library_event_y(\d{4})m(\d{2})$')
+
+
+def _pk(value):
+    return getattr(value, 'pk', value)
+
+
+def build(kind, *, book=None, user=None, actor=None, copy=None, branch=None, **data):
+    return Event(
+        kind=kind, occurred_at=timezone.now(),
+        actor_id=_pk(actor), user_id=_pk(user), book_id=_pk(book), copy_id=_pk(copy), branch_id=_pk(branch),
+        data=data or None,
+    )
+
+
+# buffered in memory and written in batches, see library/batching.py
+writer = BatchWriter(Event, 'EVENT', events_written, events_dropped)
+atexit.register(writer.flush)
+
+
+# queued once the surrounding transaction commits, a rolled back borrow leaves no event
+def record(kind, **fields):
+    event = build(kind, **fields)
+    transaction.on_commit(lambda: writer.add(event))
+
+
+def _window(events, since, until, kinds):
+    if since is not None:
+        events = events.filter(occurred_at__gte=since)
+    if until is not None:
+        events = events.filter(occurred_at__lt=until)
+    if kinds:
+        events = events.filter(kind__in=kinds)
+    return events.order_by('-occurred_at')
+
+
+# newest first, read off the (book_id, occurred_at) index. a time range also
+# lets PostgreSQL skip the months outside it
+def for_book(book_id, since=None, until=None, kinds=None):
+    return _window(Event.objects.filter(book_id=book_id), since, until, kinds)
+
+
+def for_user(user_id, since=None, until=None, kinds=None):
+    return _window(Event.objects.filter(user_id=user_id), since, until, kinds)
+
+
+# folds copy adjustments, borrows and returns into (book, branch) -> [total, available].
+# an absolute adjustment (a snapshot or a rebuild) replaces whatever came before it
+def replay_stock(book_ids=None):
+    counters = defaultdict(lambda: [0, 0])
+    events = Event.objects.filter(kind__in=[Event.BORROWED, Event.RETURNED, Event.COPIES_ADJUSTED])
+    if book_ids is not None:
+        events = events.filter(book_id__in=book_ids)
+    rows = events.order_by('occurred_at', 'id').values_list('kind', 'book_id', 'branch_id', 'data')
+    for kind, book_id, branch_id, data in rows.iterator(chunk_size=5000):
+        data = data or {}
+        # a copy withdrawn or deleted while on loan comes back to no shelf
+        if kind == Event.RETURNED and not data.get('shelved', True):
+            continue
+        counter = counters[(book_id, branch_id)]
+        if kind == Event.BORROWED:
+            counter[1] -= 1
+        elif kind == Event.RETURNED:
+            counter[1] += 1
+        elif data.get('absolute'):
+            counter[0], counter[1] = data['total'], data['available']
+        else:
+            counter[0] += data.get('total', 0)
+            counter[1] += data.get('available', 0)
+    return counters
+
+
+def add_months(day, months):
+    years, month = divmod(day.month - 1 + months, 12)
+    return date(day.year + years, month + 1, 1)
+
+
+def partition_name(month):
+    return f'library_event_y{month.year}m{month.month:02d}'
+
+
+# PostgreSQL only: a partition per calendar month (UTC) from this month on. rows
+# outside every partition land in library_event_default, run this ahead of time
+def ensure_partitions(months_ahead=3, using=None):
+    using = using or connection
+    if using.vendor != 'postgresql':
+        return []
+    created = []
+    this_month = timezone.now().date().replace(day=1)
+    with using.cursor() as cursor:
+        for offset in range(months_ahead + 1):
+            month = add_months(this_month, offset)
+            name = partition_name(month)
+            cursor.execute('SELECT to_regclass(%s)', [name])
+            if cursor.fetchone()[0] is not None:
+                continue
+            cursor.execute(
+                f"CREATE TABLE {name} PARTITION OF library_event "
+                f"FOR VALUES FROM ('{month} 00:00:00+00') TO ('{add_months(month, 1)} 00:00:00+00')"
+            )
+            created.append(name)
+    return created
+
+
+def partitions(using=None):
+    using = using or connection
+    if using.vendor != 'postgresql':
+        return []
+    with using.cursor() as cursor:
+        cursor.execute(
+            'SELECT child.relname FROM pg_inherits '
+            'JOIN pg_class child ON child.oid = pg_inherits.inhrelid '
+            'JOIN pg_class parent ON parent.oid = pg_inherits.inhparent '
+            "WHERE parent.relname = 'library_event' ORDER BY 1"
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+# history older than the cutoff goes a whole month at a time, no DELETE involved
+def drop_partitions(keep_months, using=None):
+    using = using or connection
+    cutoff = add_months(timezone.now().date().replace(day=1), -keep_months)
+    dropped = []
+    for name in partitions(using):
+        match = PARTITION_RE.match(name)
+        if match and date(int(match.group(1)), int(match.group(2)), 1) < cutoff:
+            with using.cursor() as cursor:
+                cursor.execute(f'DROP TABLE {name}')
+            dropped.append(name)
+    return dropped
@@ -0,0 +1,264 @@
+import csv
+import re
+import zipfile
+from datetime import datetime, time, timedelta
+# html.escape rather than xml.sax.saxutils, which pulls in urllib, http.client
+# and ssl at import time. the admin imports this module on every worker boot
+from html import escape
+
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+
+from .models import BorrowRecord, VisitLog
+
+
+CHUNK_SIZE = 5000
+
+# header -> ORM path, rows are read with values_list in this order
+REPORTS = {
+    'borrows': {
+        'model': BorrowRecord,
+        'columns': [
+            ('id', 'id'),
+            ('user', 'user__username'),
+            ('book', 'book__title'),
+            ('category', 'book__category__name'),
+            ('borrow_date', 'borrow_date'),
+            ('due_date', 'due_date'),
+            ('return_date', 'return_date'),
+            ('is_returned', 'is_returned'),
+        ],
+        'date_field': 'borrow_date',
+        # which filters the report understands and what they filter on
+        'filters': {
+            'user': 'user_id',
+            'book': 'book_id',
+            'category': 'book__category_id',
+        },
+    },
+    'visits': {
+        'model': VisitLog,
+        'columns': [
+            ('id', 'id'),
+            ('timestamp', 'timestamp'),
+            ('method', 'method'),
+            ('path', 'path'),
+            ('ip_address', 'ip_address'),
+        ],
+        'date_field': 'timestamp',
+        'filters': {},
+    },
+}
+
+
+def report_queryset(name, date_from=None, date_to=None, **filters):
+    report = REPORTS[name]
+    queryset = report['model'].objects.all()
+
+    for key, value in filters.items():
+        if value is None:
+            continue
+        if key not in report['filters']:
+            raise ValueError(f'The {name} report cannot be filtered by {key}.')
+        queryset = queryset.filter(**{report['filters'][key]: value})
+
+    # both ends inclusive, datetimes are compared against whole local days
+    date_field = report['date_field']
+    if report['model']._meta.get_field(date_field).get_internal_type() == 'DateTimeField':
+        if date_from:
+            queryset = queryset.filter(**{f'{date_field}__gte': timezone.make_aware(datetime.combine(date_from, time.min))})
+        if date_to:
+            queryset = queryset.filter(**{f'{date_field}__lt': timezone.make_aware(datetime.combine(date_to + timedelta(days=1), time.min))})
+    else:
+        if date_from:
+            queryset = queryset.filter(**{f'{date_field}__gte': date_from})
+        if date_to:
+            queryset = queryset.filter(**{f'{date_field}__lte': date_to})
+    return queryset
+
+
+# rows straight from the cursor in primary key order, never the whole table at once
+def report_rows(name, queryset, chunk_size=CHUNK_SIZE):
+    paths = [path for _, path in REPORTS[name]['columns']]
+    return queryset.order_by('pk').values_list(*paths).iterator(chunk_size=chunk_size)
+
+
+def report_header(name):
+    return [header for header, _ in REPORTS[name]['columns']]
+
+
+# csv.writer wants a file, this one hands back the line instead of storing it
+class Echo:
+    def write(self, value):
+        return value
+
+
+# spreadsheets run a cell starting with one of these as a formula. usernames and
+# visited paths come from users, so such cells get a leading quote
+FORMULA_START = ('=', '+', '-', '@', '\t', '\r')
+
+
+def csv_cell(value):
+    if type(value) is str and value.startswith(FORMULA_START):
+        return "'" + value
+    return value
+
+
+# lines are sent in batches, a write per row makes the response far slower
+def csv_chunks(header, rows, batch=1000):
+    writer = csv.writer(Echo())
+    pending = [writer.writerow(header)]
+    for row in rows:
+        pending.append(writer.writerow([csv_cell(value) for value in row]))
+        if len(pending) >= batch:
+            yield ''.join(pending)
+            pending = []
+    yield ''.join(pending)
+
+
+# zipfile writes here, the generator empties it after every batch of rows
+class ChunkBuffer:
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+XLSX_HEAD = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+XLSX_MAIN = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+XLSX_RELS = 'http://schemas.openxmlformats.org/package/2006/relationships'
+XLSX_DOC_RELS = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+
+# excel stops reading a sheet after 1,048,576 rows, the header takes one of them
+XLSX_SHEET_ROWS = 1_048_575
+
+
+# the parts that list the sheets, written last once the sheet count is known
+def xlsx_parts(sheets):
+    numbers = range(1, sheets + 1)
+    overrides = ''.join(
+        f'<Override PartName="/xl/worksheets/sheet{n}.xml" '
+        f'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        for n in numbers
+    )
+    return {
+        '[Content_Types].xml': (
+            f'{XLSX_HEAD}<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            f'<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            f'<Default Extension="xml" ContentType="application/xml"/>'
+            f'<Override PartName="/xl/workbook.xml" '
+            f'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+            f'{overrides}</Types>'
+        ),
+        '_rels/.rels': (
+            f'{XLSX_HEAD}<Relationships xmlns="{XLSX_RELS}">'
+            f'<Relationship Id="rId1" Type="{XLSX_DOC_RELS}/officeDocument" Target="xl/workbook.xml"/>'
+            f'</Relationships>'
+        ),
+        'xl/workbook.xml': (
+            f'{XLSX_HEAD}<workbook xmlns="{XLSX_MAIN}" xmlns:r="{XLSX_DOC_RELS}"><sheets>'
+            + ''.join(f'<sheet name="Report {n}" sheetId="{n}" r:id="rId{n}"/>' for n in numbers)
+            + '</sheets></workbook>'
+        ),
+        'xl/_rels/workbook.xml.rels': (
+            f'{XLSX_HEAD}<Relationships xmlns="{XLSX_RELS}">'
+            + ''.join(
+                f'<Relationship Id="rId{n}" Type="{XLSX_DOC_RELS}/worksheet" Target="worksheets/sheet{n}.xml"/>'
+                for n in numbers
+            )
+            + '</Relationships>'
+        ),
+    }
+
+
+# control characters xml 1.0 doesnt allow even escaped, one in a visited path
+# (a request for /%01) would make the whole workbook unreadable
+XML_ILLEGAL = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+
+def xlsx_text(value):
+    return escape(XML_ILLEGAL.sub('\ufffd', value), quote=False)
+
+
+# checked by exact type, most cells are strings and ints
+def xlsx_cell(value, tz):
+    kind = type(value)
+    if kind is str:
+        return f'<c t="inlineStr"><is><t>{xlsx_text(value)}</t></is></c>'
+    if kind is int or kind is float:
+        return f'<c><v>{value}</v></c>'
+    if value is None:
+        return '<c/>'
+    if kind is bool:
+        return f'<c t="b"><v>{int(value)}</v></c>'
+    if kind is datetime:
+        if value.tzinfo is not None:
+            value = value.astimezone(tz)
+        value = value.isoformat(' ', 'seconds')[:19]
+    return f'<c t="inlineStr"><is><t>{xlsx_text(str(value))}</t></is></c>'
+
+
+def xlsx_row(values, tz):
+    return '<row>' + ''.join([xlsx_cell(value, tz) for value in values]) + '</row>'
+
+
+# inline strings only, written into a zip that is never seeked so every
+# compressed batch goes out as soon as it is ready
+def xlsx_chunks(header, rows, batch=1000):
+    buffer = ChunkBuffer()
+    tz = timezone.get_current_timezone()
+    header_row = xlsx_row(header, tz)
+    rows = iter(rows)
+    sheets = 0
+
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        first = next(rows, None)
+        while sheets == 0 or first is not None:
+            sheets += 1
+            # force_zip64 because the sheet size isnt known until the last row
+            with archive.open(f'xl/worksheets/sheet{sheets}.xml', 'w', force_zip64=True) as sheet:
+                sheet.write(f'{XLSX_HEAD}<worksheet xmlns="{XLSX_MAIN}"><sheetData>{header_row}'.encode())
+                pending = []
+                written = 0
+                while first is not None and written < XLSX_SHEET_ROWS:
+                    pending.append(xlsx_row(first, tz))
+                    written += 1
+                    if len(pending) >= batch:
+                        sheet.write(''.join(pending).encode())
+                        pending = []
+                        yield buffer.take()
+                    first = next(rows, None)
+                sheet.write((''.join(pending) + '</sheetData></worksheet>').encode())
+
+        for name, content in xlsx_parts(sheets).items():
+            archive.writestr(name, content)
+    yield buffer.take()
+
+
+FORMATS = {
+    'csv': (csv_chunks, 'text/csv; charset=utf-8'),
+    'xlsx': (xlsx_chunks, 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'),
+}
+
+
+def export_chunks(name, queryset, file_format='csv', chunk_size=CHUNK_SIZE):
+    writer, _ = FORMATS[file_format]
+    return writer(report_header(name), report_rows(name, queryset, chunk_size))
+
+
+def export_response(name, queryset, file_format='csv'):
+    _, content_type = FORMATS[file_format]
+    response = StreamingHttpResponse(export_chunks(name, queryset, file_format), content_type=content_type)
+    stamp = timezone.localdate().isoformat()
+    response['Content-Disposition'] = f'attachment; filename="{name}-{stamp}.{file_format}"'
+    return response
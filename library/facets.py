@@ -0,0 +1,309 @@
+import heapq
+import time
+from collections import defaultdict
+
+from django.core.paginator import Paginator
+from django.db.models import Avg, Q
+from django.utils.functional import cached_property
+
+from .indexing import InMemoryIndex
+from .models import Book, Review
+
+
+PAGE_BUCKETS = [
+    (None, 99, 'Under 100'),
+    (100, 199, '100 - 199'),
+    (200, 299, '200 - 299'),
+    (300, 499, '300 - 499'),
+    (500, None, '500+'),
+]
+
+# author counts are only kept for the biggest authors, the rest are still filterable
+TOP_AUTHORS = 10
+
+
+def page_bucket(pages):
+    if pages is None:
+        return None
+    for position, (low, high, _) in enumerate(PAGE_BUCKETS):
+        if (low is None or pages >= low) and (high is None or pages <= high):
+            return position
+    return None
+
+
+# facet values a single book is filed under
+def book_keys(category_id, language, year, pages, available, rating):
+    keys = [('category', category_id), ('language', language)]
+    if year is not None:
+        keys += [('year', year), ('decade', year // 10 * 10)]
+    bucket = page_bucket(pages)
+    if bucket is not None:
+        keys.append(('pages', bucket))
+    if available:
+        keys.append(('available', True))
+    # "n stars & up" so a 4.3 book sits in the 1, 2, 3 and 4 masks
+    for stars in range(1, int(rating) + 1):
+        keys.append(('rating', stars))
+    return keys
+
+
+# bit positions to an int bitmask, built in a bytearray so it stays linear
+def mask_from_positions(positions):
+    positions = list(positions)
+    if not positions:
+        return 0
+    bits = bytearray(max(positions) // 8 + 1)
+    for position in positions:
+        bits[position >> 3] |= 1 << (position & 7)
+    return int.from_bytes(bits, 'little')
+
+
+# one bitmask per facet value, counts are AND + bit_count. bits are positions
+# handed out in id order at build time, so masks grow with the number of books
+# rather than the highest id. books added later get the next position
+class FacetIndex(InMemoryIndex):
+    name = 'facet index'
+    max_age_setting = 'FACET_INDEX_MAX_AGE'
+
+    def __init__(self):
+        super().__init__()
+        self.masks = defaultdict(dict)
+        self.books = {}
+        self.positions = {}
+        self.ratings = {}
+        self.author_books = defaultdict(set)
+        self.author_masks = {}
+        self.all = 0
+
+    def load(self):
+        rows = Book.objects.order_by().values_list(
+            'id', 'category_id', 'language', 'author_id', 'publication_year', 'pages', 'available_copies',
+        )
+        ratings = dict(
+            Review.objects.order_by().values('book_id').annotate(avg=Avg('rating')).values_list('book_id', 'avg')
+        )
+
+        books = {}
+        author_books = defaultdict(set)
+        for book_id, category_id, language, author_id, year, pages, available in rows.iterator(chunk_size=5000):
+            books[book_id] = (author_id, book_keys(
+                category_id, language, year, pages, available > 0, ratings.get(book_id) or 0,
+            ))
+            author_books[author_id].add(book_id)
+
+        positions = {book_id: position for position, book_id in enumerate(sorted(books))}
+        size = len(books) // 8 + 1
+        bits = defaultdict(lambda: bytearray(size))
+        for book_id, (_, keys) in books.items():
+            position = positions[book_id]
+            for key in keys:
+                bits[key][position >> 3] |= 1 << (position & 7)
+
+        masks = defaultdict(dict)
+        for (facet, value), raw in bits.items():
+            masks[facet][value] = int.from_bytes(raw, 'little')
+
+        top = heapq.nlargest(TOP_AUTHORS, author_books, key=lambda a: len(author_books[a]))
+        with self.lock:
+            self.masks = masks
+            self.books = books
+            self.positions = positions
+            self.ratings = ratings
+            self.author_books = author_books
+            self.author_masks = {author_id: self._mask(author_books[author_id]) for author_id in top}
+            self.all = (1 << len(positions)) - 1
+            self.built_at = time.monotonic()
+
+    # call with self.lock held, books the index doesnt know are left out
+    def _mask(self, book_ids):
+        positions = self.positions
+        return mask_from_positions([positions[book_id] for book_id in book_ids if book_id in positions])
+
+    def _remove(self, book_id):
+        entry = self.books.pop(book_id, None)
+        if entry is None:
+            return
+        author_id, keys = entry
+        bit = 1 << self.positions[book_id]
+        for facet, value in keys:
+            self.masks[facet][value] &= ~bit
+        self.author_books[author_id].discard(book_id)
+        if author_id in self.author_masks:
+            self.author_masks[author_id] &= ~bit
+        self.all &= ~bit
+
+    def update_book(self, book):
+        keys = book_keys(
+            book.category_id, book.language, book.publication_year, book.pages,
+            book.available_copies > 0, self.ratings.get(book.id) or 0,
+        )
+        with self.lock:
+            self.touch(book.id)
+            self._remove(book.id)
+            position = self.positions.setdefault(book.id, len(self.positions))
+            bit = 1 << position
+            self.books[book.id] = (book.author_id, keys)
+            for facet, value in keys:
+                self.masks[facet][value] = self.masks[facet].get(value, 0) | bit
+            self.author_books[book.author_id].add(book.id)
+            if book.author_id in self.author_masks:
+                self.author_masks[book.author_id] |= bit
+            self.all |= bit
+
+    def remove_book(self, book_id):
+        with self.lock:
+            self.touch(book_id)
+            self._remove(book_id)
+
+    def update_rating(self, book_id):
+        self.ratings[book_id] = Review.objects.filter(book_id=book_id).aggregate(avg=Avg('rating'))['avg']
+        book = Book.objects.filter(id=book_id).first()
+        if book is not None:
+            self.update_book(book)
+        else:
+            self.remove_book(book_id)
+
+    def replay(self, book_ids):
+        for book_id in book_ids:
+            self.update_rating(book_id)
+
+    def _author_mask(self, author_id):
+        if author_id in self.author_masks:
+            return self.author_masks[author_id]
+        return self._mask(self.author_books.get(author_id, ()))
+
+    # OR of the selected values inside one facet
+    def _selection_mask(self, facet, selected):
+        if facet == 'year':
+            low, high = selected
+            mask = 0
+            for year, year_mask in self.masks['year'].items():
+                if (low is None or year >= low) and (high is None or year <= high):
+                    mask |= year_mask
+            return mask
+        if facet == 'author':
+            mask = 0
+            for author_id in selected:
+                mask |= self._author_mask(author_id)
+            return mask
+        if facet in ('available', 'rating'):
+            return self.masks[facet].get(selected, 0)
+        mask = 0
+        for value in selected:
+            mask |= self.masks[facet].get(value, 0)
+        return mask
+
+    # each facet is counted against every other active filter but not its own,
+    # so picking a category still shows what the other categories would give.
+    # book_ids limits everything to those books (the search results)
+    def counts(self, filters, book_ids=None):
+        self.ensure_fresh()
+        with self.lock:
+            universe = self.all if book_ids is None else self.all & self._mask(book_ids)
+            active = {facet: self._selection_mask(facet, selected) for facet, selected in filters.items()}
+
+            def narrowed(skip=None):
+                mask = universe
+                for facet, facet_mask in active.items():
+                    if facet != skip:
+                        mask &= facet_mask
+                return mask
+
+            total = narrowed().bit_count()
+            counts = {}
+            for facet, skip in (('category', 'category'), ('language', 'language'), ('pages', 'pages'),
+                                ('decade', 'year'), ('rating', 'rating'), ('available', 'available')):
+                mask = narrowed(skip)
+                counts[facet] = {value: (mask & value_mask).bit_count() for value, value_mask in self.masks[facet].items()}
+            # selected authors outside the top ones are counted too, so they can be unticked
+            mask = narrowed('author')
+            authors = set(self.author_masks) | filters.get('author', set())
+            counts['author'] = {author_id: (mask & self._author_mask(author_id)).bit_count() for author_id in authors}
+        return total, counts
+
+
+def _int_set(params, name):
+    return {int(v) for v in params.getlist(name) if v.isdigit()}
+
+
+def _int_or_none(value):
+    return int(value) if value and value.isdigit() else None
+
+
+# reads the facet selections out of the query string, bad values are ignored
+def parse_filters(params):
+    filters = {}
+    for name in ('category', 'author'):
+        selected = _int_set(params, name)
+        if selected:
+            filters[name] = selected
+
+    languages = {v for v in params.getlist('language') if v}
+    if languages:
+        filters['language'] = languages
+
+    year_from = _int_or_none(params.get('year_from'))
+    year_to = _int_or_none(params.get('year_to'))
+    if year_from is not None or year_to is not None:
+        filters['year'] = (year_from, year_to)
+
+    pages = {p for p in _int_set(params, 'pages') if p < len(PAGE_BUCKETS)}
+    if pages:
+        filters['pages'] = pages
+
+    if params.get('available'):
+        filters['available'] = True
+
+    rating = _int_or_none(params.get('rating'))
+    if rating and 1 <= rating <= 4:
+        filters['rating'] = rating
+    return filters
+
+
+# the same filters as plain WHERE clauses for fetching the page itself
+def apply_filters(books, filters):
+    if 'category' in filters:
+        books = books.filter(category_id__in=filters['category'])
+    if 'language' in filters:
+        books = books.filter(language__in=filters['language'])
+    if 'author' in filters:
+        books = books.filter(author_id__in=filters['author'])
+    if 'year' in filters:
+        year_from, year_to = filters['year']
+        if year_from is not None:
+            books = books.filter(publication_year__gte=year_from)
+        if year_to is not None:
+            books = books.filter(publication_year__lte=year_to)
+    if 'pages' in filters:
+        ranges = Q()
+        for position in filters['pages']:
+            low, high, _ = PAGE_BUCKETS[position]
+            bucket = Q(pages__isnull=False)
+            if low is not None:
+                bucket &= Q(pages__gte=low)
+            if high is not None:
+                bucket &= Q(pages__lte=high)
+            ranges |= bucket
+        books = books.filter(ranges)
+    if filters.get('available'):
+        books = books.filter(available_copies__gt=0)
+    if 'rating' in filters:
+        books = books.annotate(facet_rating=Avg('reviews__rating')).filter(facet_rating__gte=filters['rating'])
+    return books
+
+
+# the total already comes from the facet index, no need for a COUNT(*). pass
+# None while the index is past its max age and a real count is taken instead
+class KnownCountPaginator(Paginator):
+    def __init__(self, object_list, per_page, count, **kwargs):
+        super().__init__(object_list, per_page, **kwargs)
+        self.known_count = count
+
+    @cached_property
+    def count(self):
+        if self.known_count is None:
+            return super().count
+        return self.known_count
+
+
+index = FacetIndex()
@@ -1,6 +1,6 @@
 from django import forms
-from django.contrib.auth.models import User
 from .models import Review, ContactMessage, UserProfile
+from .uploads import validate_image
 
 
 
@@ -24,19 +24,13 @@ class RegistrationForm(forms.Form):
         attrs={'class': 'form-control', 'placeholder': 'Confirm Password'}
     ))
 
-    # check username isnt taken
+    # taken usernames, in any case, are caught by the unique LOWER(username) index on save
     def clean_username(self):
-        username = self.cleaned_data.get('username').lower()
-        if User.objects.filter(username__iexact=username).exists():
-            raise forms.ValidationError('This username is already taken.')
-        return username
+        return self.cleaned_data.get('username').lower()
 
-    # check email isnt taken
+    # taken emails are caught by the unique LOWER(email) index on save
     def clean_email(self):
-        email = self.cleaned_data.get('email').lower()
-        if User.objects.filter(email__iexact=email).exists():
-            raise forms.ValidationError('An account with this email already exists.')
-        return email
+        return self.cleaned_data.get('email').lower()
 
     # password strength and matching
     def clean(self):
@@ -107,7 +101,7 @@ class ProfileEditForm(forms.Form):
     phone = forms.CharField(max_length=20, required=False, widget=forms.TextInput(
         attrs={'class': 'form-control'}
     ))
-    profile_picture = forms.FileField(required=False, widget=forms.FileInput(
+    profile_picture = forms.FileField(required=False, validators=[validate_image], widget=forms.FileInput(
         attrs={'class': 'form-control'}
     ))
     new_password = forms.CharField(required=False, widget=forms.PasswordInput(
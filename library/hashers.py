@@ -0,0 +1,88 @@
+from django.conf import settings
+from django.contrib.auth.hashers import PBKDF2PasswordHasher, ScryptPasswordHasher, mask_hash
+from django.utils.crypto import constant_time_compare
+from django.utils.translation import gettext_noop as _
+
+
+# work factors come from settings so they can be tuned to the box with
+# bench_hashers. hashes made with other values are redone by django on the
+# next successful login (must_update)
+class TunedPBKDF2PasswordHasher(PBKDF2PasswordHasher):
+    @property
+    def iterations(self):
+        return getattr(settings, 'PASSWORD_PBKDF2_ITERATIONS', PBKDF2PasswordHasher.iterations)
+
+
+class TunedScryptPasswordHasher(ScryptPasswordHasher):
+    @property
+    def work_factor(self):
+        return getattr(settings, 'PASSWORD_SCRYPT_WORK_FACTOR', ScryptPasswordHasher.work_factor)
+
+
+# cheap hash for roster imports, it carries the pbkdf2_sha256 name so the
+# normal hasher verifies it and upgrades it the first time the student logs in.
+# the rehash_provisioned_passwords task wraps the ones still waiting for that login
+class ProvisioningPasswordHasher(PBKDF2PasswordHasher):
+    @property
+    def iterations(self):
+        return getattr(settings, 'PASSWORD_PROVISIONING_ITERATIONS', 1000)
+
+
+# a cheap pbkdf2_sha256 hash run through pbkdf2 again at full cost, so weak hashes
+# can be hardened without the password:
+#   pbkdf2_wrapped_sha256$<inner iterations>$<inner salt>$<iterations>$<salt>$<hash>
+# not preferred, django replaces it with a plain hash on the next login
+class WrappedPBKDF2PasswordHasher(PBKDF2PasswordHasher):
+    algorithm = 'pbkdf2_wrapped_sha256'
+    inner = PBKDF2PasswordHasher.algorithm
+
+    @property
+    def iterations(self):
+        return getattr(settings, 'PASSWORD_PBKDF2_ITERATIONS', PBKDF2PasswordHasher.iterations)
+
+    # takes a stored pbkdf2_sha256 hash, returns None for anything else
+    def wrap(self, encoded, salt=None):
+        parts = encoded.split('$')
+        if len(parts) != 4 or parts[0] != self.inner:
+            return None
+        outer = super().encode(parts[3], salt or self.salt(), self.iterations)
+        return '$'.join([self.algorithm, parts[1], parts[2], *outer.split('$')[1:]])
+
+    def encode(self, password, salt, iterations=None):
+        inner = PBKDF2PasswordHasher.encode(
+            self, password, self.salt(), getattr(settings, 'PASSWORD_PROVISIONING_ITERATIONS', 1000),
+        )
+        return self.wrap(inner, salt)
+
+    def decode(self, encoded):
+        algorithm, inner_iterations, inner_salt, iterations, salt, hash = encoded.split('$', 5)
+        assert algorithm == self.algorithm
+        return {
+            'algorithm': algorithm,
+            'hash': hash,
+            'inner_iterations': int(inner_iterations),
+            'inner_salt': inner_salt,
+            'iterations': int(iterations),
+            'salt': salt,
+        }
+
+    def verify(self, password, encoded):
+        decoded = self.decode(encoded)
+        inner = PBKDF2PasswordHasher.encode(self, password, decoded['inner_salt'], decoded['inner_iterations'])
+        outer = super().encode(inner.split('$')[3], decoded['salt'], decoded['iterations'])
+        return constant_time_compare(outer.split('$')[3], decoded['hash'])
+
+    def safe_summary(self, encoded):
+        decoded = self.decode(encoded)
+        return {
+            _('algorithm'): decoded['algorithm'],
+            _('iterations'): f"{decoded['inner_iterations']} + {decoded['iterations']}",
+            _('salt'): mask_hash(decoded['salt']),
+            _('hash'): mask_hash(decoded['hash']),
+        }
+
+    def must_update(self, encoded):
+        return True
+
+    def harden_runtime(self, password, encoded):
+        pass
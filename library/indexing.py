@@ -0,0 +1,85 @@
+import logging
+import threading
+import time
+from abc import ABC, abstractmethod
+
+from django.conf import settings
+from django.db import connections
+
+
+logger = logging.getLogger(__name__)
+
+
+# base for the in-process indexes built from the database. signals only reach the
+# process that made the change, so each index is rebuilt every <max_age_setting>
+# seconds to pick up what other workers changed. only the very first build runs in
+# the request that needs it, later ones run in a background thread while the old
+# index keeps answering and are swapped in when done. changes seen while a build
+# runs are replayed on top of it, the build may have read those rows before them
+class InMemoryIndex(ABC):
+    name = None
+    max_age_setting = None
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.built_at = None
+        self.building = False
+        self.touched = None
+
+    # reads the database and swaps the new structures in under self.lock,
+    # setting built_at
+    @abstractmethod
+    def load(self):
+        pass
+
+    # brings the given touched keys up to date from the database
+    @abstractmethod
+    def replay(self, keys):
+        pass
+
+    # signal handlers keep the index in step once it is built, and while its first
+    # build runs, so what changes under that build gets replayed too
+    def is_tracking(self):
+        return self.built_at is not None or self.touched is not None
+
+    # call with self.lock held
+    def touch(self, key):
+        if self.touched is not None:
+            self.touched.add(key)
+
+    def build(self):
+        with self.lock:
+            self.touched = set()
+        try:
+            self.load()
+        finally:
+            with self.lock:
+                touched, self.touched = self.touched, None
+        self.replay(touched)
+
+    def is_fresh(self):
+        max_age = getattr(settings, self.max_age_setting, 900)
+        return self.built_at is not None and time.monotonic() - self.built_at <= max_age
+
+    def ensure_fresh(self):
+        if self.built_at is None:
+            self.build()
+        elif not self.is_fresh():
+            self.rebuild_in_background()
+
+    def rebuild_in_background(self):
+        with self.lock:
+            if self.building:
+                return
+            self.building = True
+        threading.Thread(target=self._rebuild, name=f'{self.name}-build', daemon=True).start()
+
+    def _rebuild(self):
+        try:
+            self.build()
+        except Exception:
+            # the old index keeps answering, the next request past max age tries again
+            logger.exception('Could not rebuild the %s', self.name)
+        finally:
+            self.building = False
+            connections.close_all()
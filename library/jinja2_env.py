@@ -0,0 +1,90 @@
+import re
+
+from django.template.backends.jinja2 import Jinja2
+from django.templatetags.static import static
+from django.urls import reverse
+from django.utils.text import Truncator
+from jinja2 import Environment, nodes
+from jinja2.ext import Extension
+
+from .metrics import TimedTemplate
+from .templatetags.library_filters import book_status, star_rating
+
+
+# {{ url('book_detail', book.id) }} like {% url 'book_detail' book.id %}
+def url(viewname, *args, **kwargs):
+    return reverse(viewname, args=args or None, kwargs=kwargs or None)
+
+
+def truncatewords(value, length):
+    return Truncator(value).words(length, truncate=' …')
+
+
+def pluralize(value, suffix='s'):
+    try:
+        return '' if int(value) == 1 else suffix
+    except (ValueError, TypeError):
+        return ''
+
+
+# the chrome in templates/base.html and the partials in templates/includes/ are
+# rendered by both engines. they stick to what reads the same in both, plus the
+# django tags {% load %} (ignored here), {% url 'name' arg %} and {% static 'path' %}.
+# filter arguments in the partials may be written |name:arg, this turns them into calls.
+# methods are not called for you, filters like star_rating call what they get
+class DjangoSyntax(Extension):
+    tags = {'load', 'url', 'static'}
+    filter_arg_re = re.compile(r'\|(\w+):(\'[^\']*\'|[\w.]+)')
+
+    def preprocess(self, source, name, filename=None):
+        if name and name.startswith('includes/'):
+            return self.filter_arg_re.sub(r'|\1(\2)', source)
+        return source
+
+    def parse(self, parser):
+        tag = next(parser.stream)
+        if tag.value == 'load':
+            while parser.stream.current.type != 'block_end':
+                next(parser.stream)
+            return []
+        args = []
+        while parser.stream.current.type != 'block_end':
+            args.append(parser.parse_expression())
+        return nodes.Output([self.call_method(f'_{tag.value}', args)], lineno=tag.lineno)
+
+    def _url(self, viewname, *args):
+        return url(viewname, *args)
+
+    def _static(self, path):
+        return static(path)
+
+
+def call_star_rating(value):
+    return star_rating(value() if callable(value) else value)
+
+
+# referenced from settings.TEMPLATES, jinja2 only has to be installed when that entry is enabled
+def environment(**options):
+    options.setdefault('extensions', []).append(DjangoSyntax)
+    env = Environment(**options)
+    env.globals.update({
+        'url': url,
+        'static': static,
+    })
+    # the django filters return SafeString, jinja treats anything with __html__ as already escaped
+    env.filters.update({
+        'book_status': book_status,
+        'star_rating': call_star_rating,
+        'truncatewords': truncatewords,
+        'pluralize': pluralize,
+    })
+    return env
+
+
+# same as the Jinja2 backend, with render timing for /metrics
+class InstrumentedJinja2(Jinja2):
+    def get_template(self, template_name):
+        return TimedTemplate(super().get_template(template_name))
+
+    def from_string(self, template_code):
+        return TimedTemplate(super().from_string(template_code))
@@ -0,0 +1,35 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from library import activity
+
+
+class Command(BaseCommand):
+    help = (
+        'Rebuild the monthly reading activity and favourite categories of every member from the '
+        'borrow and review history, a chunk of members per transaction.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, action='append', help='Only this user id, can be repeated.')
+        parser.add_argument('--chunk', type=int, default=500, help='Members per transaction.')
+
+    def handle(self, *args, **options):
+        if options['chunk'] < 1:
+            raise CommandError('--chunk must be at least 1.')
+
+        users = User.objects.order_by('pk')
+        if options['user']:
+            users = users.filter(pk__in=options['user'])
+        # keyset over the primary key, no OFFSET and no list of every id in memory
+        last, members, months = 0, 0, 0
+        while True:
+            chunk = list(users.filter(pk__gt=last).values_list('pk', flat=True)[:options['chunk']])
+            if not chunk:
+                break
+            months += activity.rebuild(chunk)
+            members += len(chunk)
+            last = chunk[-1]
+            if options['verbosity'] > 1:
+                self.stdout.write(f'  up to user {last}: {members} member(s)')
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {months} month(s) of activity for {members} member(s).'))
@@ -0,0 +1,54 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from django.contrib.auth.hashers import get_hashers
+from django.core.management.base import BaseCommand
+
+
+def _hash_for(hasher_path, seconds):
+    from django.utils.module_loading import import_string
+    hasher = import_string(hasher_path)()
+    count = 0
+    started = time.perf_counter()
+    while time.perf_counter() - started < seconds:
+        hasher.encode('correct horse battery staple', hasher.salt())
+        count += 1
+    return count, time.perf_counter() - started
+
+
+class Command(BaseCommand):
+    help = 'Measure password hashes per second per core for each configured hasher.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seconds', type=float, default=3.0, help='How long to hash for per hasher.')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Processes for the all-cores run.')
+        parser.add_argument('--budget-ms', type=float, default=None,
+                            help='Target time for one login hash, used to suggest a PBKDF2 iteration count.')
+
+    def handle(self, *args, **options):
+        seconds = options['seconds']
+        workers = options['workers']
+
+        for hasher in get_hashers():
+            path = f'{type(hasher).__module__}.{type(hasher).__name__}'
+            try:
+                count, elapsed = _hash_for(path, seconds)
+            except Exception as e:
+                # e.g. argon2 without argon2-cffi installed
+                self.stdout.write(self.style.WARNING(f'{hasher.algorithm}: skipped ({e})'))
+                continue
+
+            per_core = count / elapsed
+            with ProcessPoolExecutor(workers) as pool:
+                results = list(pool.map(_hash_for, [path] * workers, [seconds] * workers))
+            total = sum(c / e for c, e in results)
+
+            self.stdout.write(
+                f'{hasher.algorithm:<16} {1000 / per_core:8.1f} ms/hash  '
+                f'{per_core:8.2f} hashes/s/core  {total:8.2f} hashes/s on {workers} core(s)'
+            )
+
+            if options['budget_ms'] and hasher.algorithm == 'pbkdf2_sha256':
+                suggested = int(hasher.iterations * options['budget_ms'] / (1000 / per_core))
+                self.stdout.write(f'  PASSWORD_PBKDF2_ITERATIONS ~= {suggested} for {options["budget_ms"]:.0f} ms')
@@ -0,0 +1,105 @@
+import os
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test import RequestFactory
+from django.views.static import serve
+
+from library.media import serve_media
+
+
+class Command(BaseCommand):
+    help = (
+        'Download one media file from several threads at once through the old static view and '
+        'through serve_media, and report requests and megabytes per second.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='File under MEDIA_ROOT, e.g. books/cover.jpg')
+        parser.add_argument('--threads', type=int, default=8)
+        parser.add_argument('--seconds', type=float, default=3.0, help='How long to run each case for.')
+        parser.add_argument('--url', help='Base url of a running server (e.g. http://127.0.0.1:8000) to '
+                                          'download over HTTP instead of calling the views in-process.')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        if not os.path.isfile(os.path.join(settings.MEDIA_ROOT, path)):
+            raise CommandError(f'{path} is not a file under MEDIA_ROOT.')
+
+        if options['url']:
+            cases = self.http_cases(options['url'].rstrip('/') + settings.MEDIA_URL + path)
+        else:
+            cases = self.view_cases(path)
+        for name, fetch in cases:
+            requests, sent, elapsed = self.run_case(fetch, options['threads'], options['seconds'])
+            self.stdout.write(
+                f'{name:<18} {requests / elapsed:9.0f} req/s  {sent / elapsed / 1e6:8.1f} MB/s'
+            )
+
+    @staticmethod
+    def view_cases(path):
+        factory = RequestFactory()
+        etag = serve_media(factory.get('/'), path)['ETag']
+
+        def body(response):
+            data = b''.join(response) if response.streaming else response.content
+            response.close()
+            return data
+
+        return [
+            ('static.serve', lambda: body(serve(factory.get('/'), path, document_root=settings.MEDIA_ROOT))),
+            ('serve_media', lambda: body(serve_media(factory.get('/'), path))),
+            # a browser that already has the file
+            ('serve_media 304', lambda: body(serve_media(factory.get('/', HTTP_IF_NONE_MATCH=etag), path))),
+            ('serve_media range', lambda: body(serve_media(factory.get('/', HTTP_RANGE='bytes=0-16383'), path))),
+        ]
+
+    # revalidates with whatever validator the server hands out, so older servers compare too
+    @staticmethod
+    def http_cases(url):
+        with urllib.request.urlopen(url) as response:
+            validators = {}
+            if response.headers.get('ETag'):
+                validators['If-None-Match'] = response.headers['ETag']
+            elif response.headers.get('Last-Modified'):
+                validators['If-Modified-Since'] = response.headers['Last-Modified']
+
+        def fetch(headers=None):
+            try:
+                with urllib.request.urlopen(urllib.request.Request(url, headers=headers or {})) as response:
+                    return response.read()
+            except urllib.error.HTTPError as e:
+                if e.code != 304:
+                    raise
+                return b''
+
+        return [
+            ('GET', fetch),
+            ('GET revalidate', lambda: fetch(validators)),
+            ('GET range', lambda: fetch({'Range': 'bytes=0-16383'})),
+        ]
+
+    @staticmethod
+    def run_case(fetch, threads, seconds):
+        totals = []
+        deadline = time.perf_counter() + seconds
+
+        def worker():
+            requests = sent = 0
+            while time.perf_counter() < deadline:
+                sent += len(fetch())
+                requests += 1
+            totals.append((requests, sent))
+
+        started = time.perf_counter()
+        pool = [threading.Thread(target=worker) for _ in range(threads)]
+        for thread in pool:
+            thread.start()
+        for thread in pool:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        return sum(t[0] for t in totals), sum(t[1] for t in totals), elapsed
@@ -0,0 +1,91 @@
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+# what a fresh worker does: load WSGI_APPLICATION, serve one request. only
+# stdlib is imported before the clock starts
+CHILD = '''
+import importlib, json, sys, time
+from io import BytesIO
+from wsgiref.util import setup_testing_defaults
+path, host, wsgi = sys.argv[1:4]
+started = time.perf_counter()
+module, name = wsgi.rsplit('.', 1)
+app = getattr(importlib.import_module(module), name)
+ready = time.perf_counter()
+environ = {'PATH_INFO': path, 'HTTP_HOST': host, 'SERVER_NAME': host, 'wsgi.input': BytesIO()}
+setup_testing_defaults(environ)
+status = []
+response = app(environ, lambda code, headers, exc_info=None: status.append(code))
+for chunk in response:
+    pass
+getattr(response, 'close', lambda: None)()
+done = time.perf_counter()
+print(json.dumps({'setup': ready - started, 'first_response': done - ready, 'status': status[0],
+                  'modules': len(sys.modules)}))
+'''
+
+IMPORTTIME_RE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+
+
+class Command(BaseCommand):
+    help = (
+        'Start fresh interpreters that set up Django and serve one request, and report the time to '
+        'a ready WSGI app, the time to the first response and the slowest imports (-X importtime).'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', default='/', help='Path of the first request.')
+        parser.add_argument('--runs', type=int, default=5, help='Cold starts to take the median of.')
+        parser.add_argument('--top', type=int, default=20, help='How many modules to list.')
+        parser.add_argument('--prefix', help='Only list modules starting with this, e.g. library.')
+        parser.add_argument('--cumulative', action='store_true',
+                            help='Sort by time including nested imports instead of self time.')
+
+    def handle(self, *args, **options):
+        if options['runs'] < 1:
+            raise CommandError('--runs must be at least 1.')
+        hosts = [host.lstrip('.') for host in settings.ALLOWED_HOSTS if host.lstrip('.') not in ('', '*')]
+        argv = [options['path'], hosts[0] if hosts else 'localhost', settings.WSGI_APPLICATION]
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE=settings.SETTINGS_MODULE)
+
+        runs = [self.start([], argv, env)[0] for _ in range(options['runs'])]
+        for key, label in (('setup', 'setup + WSGI app'), ('first_response', 'first response')):
+            times = [run[key] * 1000 for run in runs]
+            self.stdout.write(
+                f'{label:<18} median {statistics.median(times):8.1f} ms  '
+                f'min {min(times):8.1f} ms  max {max(times):8.1f} ms'
+            )
+        self.stdout.write(f'status {runs[0]["status"]}, {runs[0]["modules"]} modules loaded')
+
+        # a separate run, importtime itself slows every import down
+        _, stderr = self.start(['-X', 'importtime'], argv, env)
+        imports = []
+        for line in stderr.splitlines():
+            match = IMPORTTIME_RE.match(line)
+            if match:
+                imports.append((int(match.group(1)), int(match.group(2)), match.group(4)))
+        if options['prefix']:
+            imports = [row for row in imports if row[2].startswith(options['prefix'])]
+        imports.sort(key=lambda row: row[1 if options['cumulative'] else 0], reverse=True)
+
+        self.stdout.write(f'\n{"self ms":>9} {"total ms":>9}  module')
+        for own, total, name in imports[:options['top']]:
+            self.stdout.write(f'{own / 1000:9.1f} {total / 1000:9.1f}  {name}')
+
+    @staticmethod
+    def start(flags, argv, env):
+        result = subprocess.run(
+            [sys.executable, *flags, '-c', CHILD, *argv], env=env, cwd=settings.BASE_DIR,
+            capture_output=True, text=True,
+        )
+        if result.returncode:
+            raise CommandError(f'The worker failed to start:\n{result.stderr[-2000:]}')
+        return json.loads(result.stdout.strip().splitlines()[-1]), result.stderr
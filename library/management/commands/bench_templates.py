@@ -0,0 +1,79 @@
+import time
+
+from django.contrib.auth.models import AnonymousUser
+from django.core.management.base import BaseCommand, CommandError
+from django.core.paginator import Paginator
+from django.template import engines
+from django.template.utils import InvalidTemplateEngineError
+from django.test import RequestFactory
+
+from library.models import Author, Book, Category
+
+
+class Command(BaseCommand):
+    help = 'Render book_list.html with fixed in-memory books on each template engine and report renders per second.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seconds', type=float, default=3.0, help='How long to render each size for.')
+        parser.add_argument('--sizes', type=int, nargs='+', default=[9, 100], help='Cards per page to try.')
+        parser.add_argument(
+            '--engines', nargs='+',
+            help='TEMPLATES names to compare, defaults to every configured engine '
+                 '(set DJANGO_CATALOG_TEMPLATES=jinja2 to add the jinja2 one).',
+        )
+
+    def handle(self, *args, **options):
+        request = RequestFactory().get('/books/')
+        request.user = AnonymousUser()
+
+        try:
+            selected = [engines[name] for name in options['engines']] if options['engines'] else engines.all()
+        except InvalidTemplateEngineError as e:
+            raise CommandError(e)
+
+        for size in options['sizes']:
+            # same context for every engine so only the rendering differs
+            context = self.context(size)
+            for engine in selected:
+                renders = 0
+                started = time.perf_counter()
+                while time.perf_counter() - started < options['seconds']:
+                    # looked up every time like a view does, so the loader cost counts too
+                    engine.get_template('book_list.html').render(context, request)
+                    renders += 1
+                elapsed = time.perf_counter() - started
+                self.stdout.write(
+                    f'{engine.name:>8} {size:>4} cards: {renders / elapsed:8.1f} renders/s  '
+                    f'{elapsed / renders * 1000:7.2f} ms/render'
+                )
+
+    # unsaved objects with the rating filled in, so no query runs while rendering
+    @staticmethod
+    def context(size):
+        category = Category(id=1, name='Fiction')
+        books = []
+        for i in range(size):
+            book = Book(
+                id=i + 1, title=f'Sample Book Number {i}', language='English',
+                available_copies=i % 3, total_copies=3,
+                author=Author(id=i % 20 + 1, name=f'Author {i % 20}'), category=category,
+            )
+            # a callable like the real method, django calls it and the jinja port does too
+            book.average_rating = lambda rating=(i % 11) / 2: rating
+            books.append(book)
+
+        return {
+            'page': Paginator(books, size).get_page(1),
+            'total': size,
+            'categories': [{'id': 1, 'name': 'Fiction', 'count': size, 'selected': False}],
+            'authors': [],
+            'languages': [{'value': 'English', 'count': size, 'selected': False}],
+            'decades': [],
+            'page_ranges': [],
+            'ratings': [],
+            'year_from': None,
+            'year_to': None,
+            'selected_sort': 'newest',
+            'query': '',
+            'querystring': '',
+        }
@@ -0,0 +1,29 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from library import recommendations
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the "readers also borrowed" table from borrow and review history.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true', help='Recompute every book instead of only changed ones.')
+        parser.add_argument('--top-k', type=int, default=recommendations.TOP_K, help='Neighbours kept per book.')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+
+        # first run, forced, or the incremental runs have drifted long enough
+        since = recommendations.last_build_time()
+        if options['full'] or since is None or recommendations.needs_full_rebuild():
+            built = recommendations.rebuild(top_k=options['top_k'])
+            mode = 'full'
+        else:
+            changed = recommendations.changed_book_ids(since)
+            built = recommendations.rebuild(changed, top_k=options['top_k']) if changed else 0
+            mode = 'incremental'
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(f'{mode} rebuild: {built} book(s) in {elapsed:.2f}s'))
@@ -0,0 +1,30 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from library.events import drop_partitions, ensure_partitions, partitions
+
+
+class Command(BaseCommand):
+    help = (
+        'Create event log partitions for the coming months and drop the ones older than '
+        'EVENT_KEEP_MONTHS. Only PostgreSQL partitions the event log.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ahead', type=int, default=3, help='Months after this one to create partitions for.')
+        parser.add_argument('--keep-months', type=int, default=getattr(settings, 'EVENT_KEEP_MONTHS', 24),
+                            help='Months of history to keep, 0 keeps everything.')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            self.stdout.write('The event log is a plain table on this database, nothing to do.')
+            return
+
+        created = ensure_partitions(options['ahead'])
+        dropped = drop_partitions(options['keep_months']) if options['keep_months'] else []
+        for name in partitions():
+            self.stdout.write(f'  {name}')
+        self.stdout.write(self.style.SUCCESS(
+            f'Created {len(created)} partition(s) and dropped {len(dropped)}.'
+        ))
@@ -0,0 +1,111 @@
+import hashlib
+import os
+import shutil
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.template.defaultfilters import filesizeformat
+
+from library.uploads import blob_name, file_fields, upload_prefixes
+
+
+def sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Command(BaseCommand):
+    help = (
+        'Report uploaded files that no record points at and identical files stored more than once. '
+        'With --reclaim, delete the orphans and fold duplicates into one blob. Only the upload '
+        'directories and blobs/ are looked at, other files in MEDIA_ROOT are left alone.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reclaim', action='store_true', help='Delete orphans and merge duplicates.')
+        parser.add_argument('--min-age', type=float, default=24.0,
+                            help='Hours an orphan must be untouched before it is deleted, uploads may be in flight.')
+
+    def handle(self, *args, **options):
+        root = str(settings.MEDIA_ROOT)
+        files = {}
+        for prefix in upload_prefixes():
+            for directory, _, names in os.walk(os.path.join(root, prefix)):
+                for filename in names:
+                    path = os.path.join(directory, filename)
+                    files[os.path.relpath(path, root).replace(os.sep, '/')] = os.stat(path)
+
+        referenced = set()
+        for model, field in file_fields():
+            referenced.update(
+                name for name in model.objects.exclude(**{field: ''}).values_list(field, flat=True).iterator() if name
+            )
+
+        orphans = sorted(name for name in files if name not in referenced)
+        missing = sorted(name for name in referenced if name not in files)
+
+        # only files of the same size can be equal, so most are never hashed
+        by_size = defaultdict(list)
+        for name in files:
+            if name in referenced:
+                by_size[files[name].st_size].append(name)
+        duplicates = defaultdict(list)
+        for names in by_size.values():
+            if len(names) > 1:
+                for name in names:
+                    duplicates[sha256_file(os.path.join(root, name))].append(name)
+        duplicates = {digest: sorted(names) for digest, names in duplicates.items() if len(names) > 1}
+
+        total = sum(stat.st_size for stat in files.values())
+        orphan_bytes = sum(files[name].st_size for name in orphans)
+        duplicate_bytes = sum(files[names[0]].st_size * (len(names) - 1) for names in duplicates.values())
+        self.stdout.write(f'{len(files)} uploaded file(s), {filesizeformat(total)} in {root}')
+        self.stdout.write(f'  orphaned:   {len(orphans)} file(s), {filesizeformat(orphan_bytes)}')
+        self.stdout.write(
+            f'  duplicated: {sum(len(n) - 1 for n in duplicates.values())} extra copies, {filesizeformat(duplicate_bytes)}'
+        )
+        if missing:
+            self.stdout.write(self.style.WARNING(f'  {len(missing)} referenced file(s) are missing, e.g. {missing[0]}'))
+
+        if not options['reclaim']:
+            return
+
+        cutoff = time.time() - options['min_age'] * 3600
+        removed = freed = 0
+        for name in orphans:
+            if files[name].st_mtime < cutoff:
+                os.remove(os.path.join(root, name))
+                removed += 1
+                freed += files[name].st_size
+
+        merged = 0
+        for digest, names in duplicates.items():
+            target = blob_name(digest, names[0])
+            target_path = os.path.join(root, target)
+            if not os.path.exists(target_path):
+                os.makedirs(os.path.dirname(target_path), exist_ok=True)
+                try:
+                    os.link(os.path.join(root, names[0]), target_path)
+                except OSError:
+                    shutil.copy2(os.path.join(root, names[0]), target_path)
+
+            with transaction.atomic():
+                for model, field in file_fields():
+                    model.objects.filter(**{f'{field}__in': names}).update(**{field: target})
+            for name in names:
+                if name != target:
+                    os.remove(os.path.join(root, name))
+                    freed += files[name].st_size
+            # the first copy lives on as the blob
+            freed -= files[names[0]].st_size if target not in names else 0
+            merged += 1
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Deleted {removed} orphan(s) and merged {merged} duplicate group(s), freed {filesizeformat(freed)}.'
+        ))
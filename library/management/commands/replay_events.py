@@ -0,0 +1,86 @@
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand, CommandError
+
+from library import circulation, events
+from library.models import BranchStock, Event
+
+
+class Command(BaseCommand):
+    help = (
+        'Replay the event log into copy counters per book and branch and report where they differ '
+        'from BranchStock. --apply writes the replayed counters, --snapshot logs the current '
+        'counters as the starting point for later replays.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--book', type=int, action='append', help='Only this book id, can be repeated.')
+        parser.add_argument('--apply', action='store_true', help='Write the replayed counters.')
+        parser.add_argument('--snapshot', action='store_true',
+                            help='Log the current counters instead of replaying, for history from before the log.')
+
+    def handle(self, *args, **options):
+        book_ids = options['book']
+        if options['snapshot'] and options['apply']:
+            raise CommandError('--snapshot and --apply cannot be used together.')
+
+        stock = BranchStock.objects.order_by('book_id', 'branch_id')
+        if book_ids:
+            stock = stock.filter(book_id__in=book_ids)
+        stock = stock.values_list('book_id', 'branch_id', 'total_copies', 'available_copies')
+
+        if options['snapshot']:
+            # straight to the table, the buffered writer would drop most of a big catalog
+            batch, written = [], 0
+            for book_id, branch_id, total, available in stock.iterator(chunk_size=5000):
+                batch.append(events.build(Event.COPIES_ADJUSTED, book=book_id, branch=branch_id,
+                                          total=total, available=available, absolute=True))
+                if len(batch) >= 5000:
+                    written += len(Event.objects.bulk_create(batch))
+                    batch = []
+            written += len(Event.objects.bulk_create(batch))
+            self.stdout.write(self.style.SUCCESS(f'Logged the counters of {written} book and branch pair(s).'))
+            return
+
+        # anything this process still has buffered
+        events.writer.flush()
+        replayed = events.replay_stock(book_ids)
+        stored = {(book_id, branch_id): (total, available) for book_id, branch_id, total, available in stock.iterator()}
+
+        logged_books = {book_id for book_id, _ in replayed}
+        unlogged = {book_id for book_id, _ in stored} - logged_books
+        different = sorted(
+            key for key in set(replayed) | set(stored)
+            if key[0] in logged_books and tuple(replayed.get(key, (0, 0))) != stored.get(key, (0, 0))
+        )
+        for book_id, branch_id in different[:20]:
+            total, available = replayed.get((book_id, branch_id), (0, 0))
+            self.stdout.write(
+                f'  book {book_id} branch {branch_id}: stored {stored.get((book_id, branch_id), (0, 0))}, '
+                f'replayed ({total}, {available})'
+            )
+        if len(different) > 20:
+            self.stdout.write(f'  ... and {len(different) - 20} more')
+        if unlogged:
+            self.stdout.write(self.style.WARNING(
+                f'{len(unlogged)} book(s) have no events, run with --snapshot once to give them a starting point.'
+            ))
+        if any(total < 0 or available < 0 for total, available in replayed.values()):
+            self.stdout.write(self.style.WARNING('Some replayed counters are negative, the log starts mid-history.'))
+
+        if not options['apply']:
+            self.stdout.write(f'{len(different)} counter(s) differ from the event log.')
+            return
+
+        by_book = defaultdict(dict)
+        for (book_id, branch_id), (total, available) in replayed.items():
+            if total or available:
+                by_book[book_id][(book_id, branch_id)] = (max(total, 0), max(available, 0))
+        touched = sorted({book_id for book_id, _ in different})
+        for start in range(0, len(touched), 1000):
+            chunk = touched[start:start + 1000]
+            circulation.write_stock(chunk, {
+                key: value for book_id in chunk for key, value in by_book[book_id].items()
+            })
+        events.writer.flush()
+        self.stdout.write(self.style.SUCCESS(f'Rewrote the counters of {len(touched)} book(s) from the event log.'))
@@ -0,0 +1,112 @@
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connections
+
+from library import events, metrics
+from library.taskqueue import claim, purge_finished, run
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Run queued tasks from library.taskqueue until stopped with Ctrl+C or SIGTERM.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=getattr(settings, 'TASK_WORKER_THREADS', 4),
+                            help='Tasks run at the same time in each process.')
+        parser.add_argument('--processes', type=int, default=1, help='Worker processes to start.')
+        parser.add_argument('--poll', type=float, default=1.0, help='Seconds to wait when the queue is empty.')
+        parser.add_argument('--once', action='store_true', help='Exit once nothing is due instead of waiting.')
+
+    def handle(self, *args, **options):
+        if options['processes'] <= 1:
+            self.work(options)
+            return
+
+        # children must not share the parent's database sockets
+        connections.close_all()
+        children = [
+            multiprocessing.Process(target=self.work, args=(options,), daemon=True)
+            for _ in range(options['processes'])
+        ]
+        for child in children:
+            child.start()
+
+        def forward(signum, frame):
+            for child in children:
+                if child.is_alive():
+                    os.kill(child.pid, signal.SIGTERM)
+
+        signal.signal(signal.SIGTERM, forward)
+        signal.signal(signal.SIGINT, forward)
+        for child in children:
+            child.join()
+
+    def work(self, options):
+        stop = threading.Event()
+        signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+        signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+
+        worker = f'{socket.gethostname()}:{os.getpid()}'
+        threads = options['threads']
+        keep = timedelta(days=getattr(settings, 'TASK_KEEP_FINISHED_DAYS', 7))
+        running = set()
+        last_purge = 0.0
+        self.stdout.write(f'Worker {worker} started with {threads} thread(s).')
+
+        with ThreadPoolExecutor(max_workers=threads, thread_name_prefix='task') as pool:
+            while not stop.is_set():
+                tasks = []
+                if len(running) < threads:
+                    try:
+                        tasks = claim(worker, threads - len(running))
+                    except Exception:
+                        logger.exception('Could not claim tasks')
+                for item in tasks:
+                    running.add(pool.submit(self.run_one, item))
+
+                if time.monotonic() - last_purge > 3600:
+                    last_purge = time.monotonic()
+                    try:
+                        purge_finished(keep)
+                    except Exception:
+                        logger.exception('Could not purge finished tasks')
+                    # next months' event log partitions, a no-op off PostgreSQL
+                    try:
+                        events.ensure_partitions()
+                    except Exception:
+                        logger.exception('Could not create event log partitions')
+                metrics.flush()
+
+                if options['once'] and not tasks and not running:
+                    break
+                if running:
+                    # wake up as soon as a slot frees, or poll for newly due tasks
+                    done, _ = wait(running, timeout=options['poll'], return_when=FIRST_COMPLETED)
+                    running -= done
+                elif not tasks:
+                    stop.wait(options['poll'])
+
+        metrics.flush(force=True)
+        self.stdout.write(f'Worker {worker} stopped.')
+
+    @staticmethod
+    def run_one(item):
+        try:
+            run(item)
+        except Exception:
+            # the task itself is handled in run, this is the database going away
+            logger.exception('Task %s #%s could not be recorded', item.name, item.pk)
+        finally:
+            close_old_connections()
@@ -0,0 +1,138 @@
+import mimetypes
+import os
+import re
+import stat
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, Http404, HttpResponse
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_http_date_safe
+from django.views.decorators.http import require_safe
+
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+BLOB_RE = re.compile(r'^blobs/[0-9a-f]{2}/([0-9a-f]{64})\.\w+$')
+
+
+# the file name of a blob is its sha256, so it can never change under the same url
+def media_etag(path, st):
+    match = BLOB_RE.match(path)
+    if match:
+        return f'"{match.group(1)}"'
+    return f'"{st.st_mtime_ns:x}-{st.st_size:x}"'
+
+
+def cache_control(path):
+    if BLOB_RE.match(path):
+        return 'public, max-age=31536000, immutable'
+    return f'public, max-age={settings.MEDIA_CACHE_SECONDS}'
+
+
+# one range only, a multipart reply for several ranges isnt worth it for images.
+# None means ignore the header and send everything, False means 416
+def parse_range(header, size):
+    match = RANGE_RE.match(header.strip())
+    if not match or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if first == '':
+        # bytes=-500 is the last 500 bytes
+        length = min(int(last), size)
+        return (size - length, size - 1) if length else False
+    first = int(first)
+    if last and int(last) < first:
+        return None
+    if first >= size:
+        return False
+    return first, min(int(last), size - 1) if last else size - 1
+
+
+# stops a streamed file at the end of the requested range
+class RangeFile:
+    def __init__(self, f, start, length):
+        f.seek(start)
+        self.f = f
+        self.remaining = length
+
+    def read(self, size=-1):
+        if self.remaining <= 0:
+            return b''
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.f.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.f.close()
+
+
+@require_safe
+def serve_media(request, path):
+    try:
+        full_path = safe_join(settings.MEDIA_ROOT, path)
+        st = os.stat(full_path)
+    except (OSError, ValueError, SuspiciousFileOperation):
+        raise Http404('File not found')
+    if not stat.S_ISREG(st.st_mode):
+        raise Http404('File not found')
+
+    etag = media_etag(path, st)
+    headers = {
+        'ETag': etag,
+        'Last-Modified': http_date(st.st_mtime),
+        'Cache-Control': cache_control(path),
+        'Accept-Ranges': 'bytes',
+    }
+    # 304 for If-None-Match or If-Modified-Since, 412 for failed If-Match
+    not_modified = get_conditional_response(request, etag=etag, last_modified=int(st.st_mtime))
+    if not_modified is not None:
+        for name, value in headers.items():
+            not_modified[name] = value
+        return not_modified
+
+    content_type, encoding = mimetypes.guess_type(full_path)
+    content_type = content_type or 'application/octet-stream'
+
+    # the web server sends the file and handles ranges itself
+    offload = settings.MEDIA_SENDFILE
+    if offload:
+        response = HttpResponse(content_type=content_type)
+        if offload == 'x-accel':
+            response['X-Accel-Redirect'] = settings.MEDIA_ACCEL_PREFIX + path
+        else:
+            response['X-Sendfile'] = full_path
+        for name, value in headers.items():
+            response[name] = value
+        return response
+
+    byte_range = None
+    if 'HTTP_RANGE' in request.META:
+        # If-Range with a stale validator means the client wants the whole new file
+        if_range = request.META.get('HTTP_IF_RANGE')
+        if not if_range or if_range == etag or parse_http_date_safe(if_range) == int(st.st_mtime):
+            byte_range = parse_range(request.META['HTTP_RANGE'], st.st_size)
+            if byte_range is False:
+                response = HttpResponse(status=416)
+                response['Content-Range'] = f'bytes */{st.st_size}'
+                return response
+
+    if request.method == 'HEAD':
+        response = HttpResponse(content_type=content_type)
+        response['Content-Length'] = st.st_size
+    elif byte_range:
+        first, last = byte_range
+        length = last - first + 1
+        response = FileResponse(RangeFile(open(full_path, 'rb'), first, length), content_type=content_type, status=206)
+        response['Content-Length'] = length
+        response['Content-Range'] = f'bytes {first}-{last}/{st.st_size}'
+    else:
+        # a real file object, so the WSGI server can hand it to sendfile()
+        response = FileResponse(open(full_path, 'rb'), content_type=content_type)
+    if encoding:
+        response['Content-Encoding'] = encoding
+    for name, value in headers.items():
+        response[name] = value
+    return response
@@ -0,0 +1,434 @@
+import atexit
+import json
+import os
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connection
+from django.http import HttpResponse, HttpResponseForbidden
+from django.template.backends.django import DjangoTemplates
+from django.utils.crypto import constant_time_compare
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+registry = []
+
+
+class _ShardOwner:
+    pass
+
+
+# every thread writes to its own shard, so the hot path never takes a lock.
+# a scrape adds the shards together. when a thread ends its thread-local owner
+# is collected and the shard is folded into _base, so recycled threads dont
+# pile up shards
+class Metric:
+    kind = None
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self._local = threading.local()
+        self._shards = []
+        self._base = {}
+        self._shards_lock = threading.Lock()
+        registry.append(self)
+
+    def _shard(self):
+        try:
+            return self._local.values
+        except AttributeError:
+            values = {}
+            owner = _ShardOwner()
+            with self._shards_lock:
+                self._shards.append(values)
+            # nothing to fold once the interpreter is going away
+            weakref.finalize(owner, self._retire, values).atexit = False
+            self._local.owner = owner
+            self._local.values = values
+            return values
+
+    def _retire(self, values):
+        with self._shards_lock:
+            self._shards.remove(values)
+            for key, value in values.items():
+                self._add(self._base, key, value)
+
+    # the base and the shards of live threads, read under the lock so a shard
+    # being folded is never counted twice or missed
+    def _parts(self):
+        with self._shards_lock:
+            return [{key: self._copy(value) for key, value in self._base.items()}] + list(self._shards)
+
+    def samples(self):
+        merged = {}
+        for shard in self._parts():
+            for key, value in list(shard.items()):
+                self._add(merged, key, value)
+        return merged
+
+    @staticmethod
+    def _key(labels):
+        return tuple(sorted(labels.items()))
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        shard = self._shard()
+        key = self._key(labels)
+        shard[key] = shard.get(key, 0) + amount
+
+    @staticmethod
+    def _copy(value):
+        return value
+
+    @staticmethod
+    def _add(target, key, value):
+        target[key] = target.get(key, 0) + value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text)
+        self.buckets = buckets
+
+    # per label set: one count per bucket (not cumulative), then sum and count
+    def observe(self, value, **labels):
+        shard = self._shard()
+        key = self._key(labels)
+        row = shard.get(key)
+        if row is None:
+            row = shard[key] = [0] * (len(self.buckets) + 2)
+        for position, bound in enumerate(self.buckets):
+            if value <= bound:
+                row[position] += 1
+                break
+        row[-2] += value
+        row[-1] += 1
+
+    @staticmethod
+    def _copy(row):
+        return list(row)
+
+    @staticmethod
+    def _add(target, key, row):
+        total = target.get(key)
+        if total is None:
+            total = target[key] = [0] * len(row)
+        for position, value in enumerate(row):
+            total[position] += value
+
+
+# evaluated on scrape instead of counted in-process, for numbers that live in
+# the database and would be double counted if every process reported them
+class CallbackGauge:
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, func):
+        self.name = name
+        self.help_text = help_text
+        self.func = func
+        gauges.append(self)
+
+
+gauges = []
+
+
+request_count = Counter('library_http_requests_total', 'Requests by url name, method and status code.')
+request_latency = Histogram('library_http_request_duration_seconds', 'Request latency by url name.')
+db_queries = Counter('library_db_queries_total', 'SQL queries run by url name.')
+db_time = Histogram('library_db_time_seconds', 'SQL time spent per request by url name.')
+template_time = Histogram('library_template_render_seconds', 'Template render time by template.')
+cache_requests = Counter('library_cache_requests_total', 'Cache lookups by cache use and result.')
+visit_log_dropped = Counter('library_visit_log_dropped_total', 'Visit log rows that could not be written.')
+borrow_outcomes = Counter('library_borrow_outcomes_total', 'Borrow and return attempts by outcome.')
+events_written = Counter('library_events_written_total', 'Events written to the event log.')
+events_dropped = Counter('library_events_dropped_total', 'Events lost because the buffer was full or the write failed.')
+contact_submissions = Counter('library_contact_submissions_total', 'Contact form submissions by outcome.')
+task_runs = Counter('library_task_runs_total', 'Task attempts by task and outcome.')
+task_latency = Histogram(
+    'library_task_wait_seconds', 'Time from when a task was due to when a worker started it.',
+    buckets=(0.1, 0.5, 1.0, 5.0, 15.0, 60.0, 300.0, 900.0, 3600.0),
+)
+task_duration = Histogram('library_task_duration_seconds', 'Task run time by task.')
+
+
+def snapshot():
+    return {
+        metric.name: {
+            'kind': metric.kind,
+            'help': metric.help_text,
+            'buckets': list(getattr(metric, 'buckets', ())),
+            'samples': [[list(key), value] for key, value in metric.samples().items()],
+        }
+        for metric in registry
+    }
+
+
+# shared directory mode for several worker processes: each one dumps its own
+# totals to <METRICS_DIR>/<pid>.json and a scrape adds all the files up. the file
+# of a process that exits is folded into dead.json and removed, like
+# mark_process_dead in prometheus_client's multiprocess mode. files left by
+# killed processes are folded by the next scrape, or by a new process that got
+# the same pid before it writes over them
+DEAD_FILE = 'dead.json'
+_last_flush = 0.0
+_flushed_pid = None
+_dead_pid = None
+
+
+@contextmanager
+def _directory_lock(directory):
+    import fcntl
+
+    with open(os.path.join(directory, '.lock'), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write(path, data):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(data, f)
+    os.replace(path + '.tmp', path)
+
+
+# call with the directory lock held
+def _fold(directory, pid):
+    path = os.path.join(directory, f'{pid}.json')
+    snap = _read(path)
+    if snap is not None:
+        dead = _read(os.path.join(directory, DEAD_FILE)) or {}
+        _write(os.path.join(directory, DEAD_FILE), unmerge(merge([dead, snap])))
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def flush(force=False):
+    global _last_flush, _flushed_pid
+    directory = getattr(settings, 'METRICS_DIR', None)
+    if not directory or _dead_pid == os.getpid():
+        return
+    now = time.monotonic()
+    if not force and now - _last_flush < getattr(settings, 'METRICS_FLUSH_INTERVAL', 5):
+        return
+    _last_flush = now
+
+    os.makedirs(directory, exist_ok=True)
+    pid = os.getpid()
+    if _flushed_pid != pid:
+        # whatever is there was left by a dead process with our pid
+        with _directory_lock(directory):
+            _fold(directory, pid)
+        _flushed_pid = pid
+    _write(os.path.join(directory, f'{pid}.json'), snapshot())
+
+
+# registered with atexit for this process. a process manager can call it with
+# the pid of a worker it reaped so its numbers move over before the next scrape
+def mark_process_dead(pid=None):
+    global _dead_pid
+    directory = getattr(settings, 'METRICS_DIR', None)
+    if not directory or not os.path.isdir(directory):
+        return
+    pid = pid or os.getpid()
+    if pid == os.getpid():
+        flush(force=True)
+        # a daemon thread still serving a request must not write the file back
+        _dead_pid = pid
+    with _directory_lock(directory):
+        _fold(directory, pid)
+
+
+atexit.register(mark_process_dead)
+
+
+def merge(snapshots):
+    merged = {}
+    for snap in snapshots:
+        for name, metric in snap.items():
+            target = merged.setdefault(name, {**metric, 'samples': {}})
+            for key, value in metric['samples']:
+                key = tuple(tuple(pair) for pair in key)
+                if metric['kind'] == 'histogram':
+                    total = target['samples'].setdefault(key, [0] * len(value))
+                    for position, part in enumerate(value):
+                        total[position] += part
+                else:
+                    target['samples'][key] = target['samples'].get(key, 0) + value
+    return merged
+
+
+# back to the snapshot layout, for dead.json
+def unmerge(metrics):
+    return {
+        name: {**metric, 'samples': [[list(key), value] for key, value in metric['samples'].items()]}
+        for name, metric in metrics.items()
+    }
+
+
+def collect():
+    directory = getattr(settings, 'METRICS_DIR', None)
+    if not directory:
+        return add_gauges(merge([snapshot()]))
+
+    flush(force=True)
+    snapshots = []
+    # under the lock so a file being folded into dead.json is counted once
+    with _directory_lock(directory):
+        for filename in os.listdir(directory):
+            name, extension = os.path.splitext(filename)
+            if extension == '.json' and name.isdigit() and not _alive(int(name)):
+                _fold(directory, int(name))
+        for filename in os.listdir(directory):
+            if filename.endswith('.json'):
+                snap = _read(os.path.join(directory, filename))
+                if snap is not None:
+                    snapshots.append(snap)
+    return add_gauges(merge(snapshots))
+
+
+def add_gauges(metrics):
+    for gauge in gauges:
+        try:
+            samples = gauge.func()
+        except Exception:
+            # a scrape should still answer if the database is down
+            continue
+        metrics[gauge.name] = {'kind': gauge.kind, 'help': gauge.help_text, 'buckets': [], 'samples': samples}
+    return metrics
+
+
+def _labels(pairs):
+    if not pairs:
+        return ''
+    escaped = (
+        '{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for k, v in pairs
+    )
+    return '{' + ','.join(escaped) + '}'
+
+
+# prometheus text exposition format 0.0.4
+def render_text(metrics):
+    lines = []
+    for name, metric in sorted(metrics.items()):
+        lines.append(f'# HELP {name} {metric["help"]}')
+        lines.append(f'# TYPE {name} {metric["kind"]}')
+        for key, value in sorted(metric['samples'].items()):
+            if metric['kind'] != 'histogram':
+                lines.append(f'{name}{_labels(key)} {value:g}')
+                continue
+            running = 0
+            for bound, count in zip(metric['buckets'], value):
+                running += count
+                lines.append(f'{name}_bucket{_labels(key + (("le", f"{bound:g}"),))} {running}')
+            lines.append(f'{name}_bucket{_labels(key + (("le", "+Inf"),))} {value[-1]}')
+            lines.append(f'{name}_sum{_labels(key)} {value[-2]:g}')
+            lines.append(f'{name}_count{_labels(key)} {value[-1]}')
+    return '\n'.join(lines) + '\n'
+
+
+# scrapers send METRICS_TOKEN as a bearer token, staff can look at it in the
+# browser. METRICS_ALLOWED_IPS is empty unless set, behind a reverse proxy every
+# request comes from the proxy's address
+def metrics_allowed(request):
+    if request.user.is_authenticated and request.user.is_staff:
+        return True
+    token = getattr(settings, 'METRICS_TOKEN', None)
+    scheme, _, given = request.META.get('HTTP_AUTHORIZATION', '').partition(' ')
+    if token and scheme.lower() == 'bearer' and constant_time_compare(given.strip(), token):
+        return True
+    return request.META.get('REMOTE_ADDR') in getattr(settings, 'METRICS_ALLOWED_IPS', ())
+
+
+def metrics_view(request):
+    if not metrics_allowed(request):
+        return HttpResponseForbidden()
+    return HttpResponse(render_text(collect()), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.seconds += time.perf_counter() - started
+
+
+# sits at the top of the stack so latency covers every other middleware
+class MetricsMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        queries = QueryCounter()
+        started = time.perf_counter()
+        with connection.execute_wrapper(queries):
+            response = self.get_response(request)
+        elapsed = time.perf_counter() - started
+
+        match = request.resolver_match
+        view = (match.view_name if match else None) or 'unmatched'
+        request_count.inc(view=view, method=request.method, status=str(response.status_code))
+        request_latency.observe(elapsed, view=view)
+        db_queries.inc(queries.count, view=view)
+        db_time.observe(queries.seconds, view=view)
+        flush()
+        return response
+
+
+class TimedTemplate:
+    def __init__(self, template):
+        self.template = template
+        self.origin = template.origin
+
+    def render(self, context=None, request=None):
+        started = time.perf_counter()
+        try:
+            return self.template.render(context, request)
+        finally:
+            template_time.observe(time.perf_counter() - started, template=self.origin.template_name or 'string')
+
+
+# same engine as DjangoTemplates, with render timing for the metrics
+class InstrumentedDjangoTemplates(DjangoTemplates):
+    def get_template(self, template_name):
+        return TimedTemplate(super().get_template(template_name))
+
+    def from_string(self, template_code):
+        return TimedTemplate(super().from_string(template_code))
@@ -1,5 +1,8 @@
 from django.shortcuts import render
 
+from .metrics import visit_log_dropped
+from .models import SiteSettings, VisitLog
+
 
 # logs every page visit to the database for analytics
 class VisitLoggingMiddleware:
@@ -11,11 +14,10 @@ class VisitLoggingMiddleware:
 
         # skip static and media files so we only track real page visits
         path = request.path
-        if path.startswith('/static/') or path.startswith('/media/'):
+        if path.startswith('/static/') or path.startswith('/media/') or path == '/metrics':
             return response
 
         try:
-            from .models import VisitLog
             ip = request.META.get('REMOTE_ADDR', '')
             VisitLog.objects.create(
                 path=path,
@@ -23,7 +25,7 @@ class VisitLoggingMiddleware:
                 ip_address=ip,
             )
         except Exception:
-            pass
+            visit_log_dropped.inc()
 
         return response
 
@@ -46,7 +48,6 @@ class MaintenanceModeMiddleware:
             return self.get_response(request)
 
         try:
-            from .models import SiteSettings
             if SiteSettings.load().maintenance_mode:
                 return render(request, 'maintenance.html', status=503)
         except Exception:
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.8 on 2026-10-19 18:25
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0003_category_image'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RelatedBook',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('score', models.FloatField(verbose_name='درجة التشابه')),
+                ('computed_at', models.DateTimeField(auto_now=True, verbose_name='وقت الحساب')),
+                ('book', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='related_entries', to='library.book', verbose_name='الكتاب')),
+                ('related', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='library.book', verbose_name='الكتاب المقترح')),
+            ],
+            options={
+                'verbose_name': 'كتاب مقترح',
+                'verbose_name_plural': 'الكتب المقترحة',
+                'ordering': ['-score'],
+                'indexes': [models.Index(fields=['book', '-score'], name='library_rel_book_id_d5367c_idx')],
+            },
+        ),
+    ]
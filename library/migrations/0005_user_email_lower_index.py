@@ -0,0 +1,19 @@
+from django.conf import settings
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0004_relatedbook'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    # auth_user belongs to django, so the LOWER(email) index used by the login
+    # backend is added with plain sql
+    operations = [
+        migrations.RunSQL(
+            sql='CREATE INDEX library_user_email_lower_idx ON auth_user (LOWER(email));',
+            reverse_sql='DROP INDEX library_user_email_lower_idx;',
+        ),
+    ]
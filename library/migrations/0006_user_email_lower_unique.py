@@ -0,0 +1,45 @@
+from django.conf import settings
+from django.db import migrations
+from django.db.models import Count
+from django.db.models.functions import Lower
+
+
+# edit_profile never checked whether an email was taken, so older databases can
+# hold the same address twice or in two cases. the oldest account keeps it, the
+# others are left without an email so the unique index below can be built
+def clear_duplicate_emails(apps, schema_editor):
+    User = apps.get_model('auth', 'User')
+    users = User.objects.exclude(email='').annotate(email_lower=Lower('email'))
+    taken = users.values('email_lower').annotate(n=Count('pk')).filter(n__gt=1).values_list('email_lower', flat=True)
+    keep = {}
+    clear = []
+    for pk, email in users.filter(email_lower__in=list(taken)).order_by('date_joined', 'pk').values_list('pk', 'email_lower'):
+        if email in keep:
+            clear.append(pk)
+        else:
+            keep[email] = pk
+    User.objects.filter(pk__in=clear).update(email='')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0005_user_email_lower_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    # registration relies on this index instead of checking emails first,
+    # blank emails (superusers made from the shell) are left out
+    operations = [
+        migrations.RunPython(clear_duplicate_emails, migrations.RunPython.noop),
+        migrations.RunSQL(
+            sql=[
+                'DROP INDEX library_user_email_lower_idx;',
+                "CREATE UNIQUE INDEX library_user_email_lower_uniq ON auth_user (LOWER(email)) WHERE email <> '';",
+            ],
+            reverse_sql=[
+                'DROP INDEX library_user_email_lower_uniq;',
+                'CREATE INDEX library_user_email_lower_idx ON auth_user (LOWER(email));',
+            ],
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.2.8 on 2026-10-19 18:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0006_user_email_lower_unique'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Task',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, verbose_name='المهمة')),
+                ('kwargs', models.JSONField(blank=True, default=dict, verbose_name='المعاملات')),
+                ('idempotency_key', models.CharField(blank=True, max_length=200, null=True, unique=True, verbose_name='مفتاح عدم التكرار')),
+                ('status', models.CharField(choices=[('pending', 'بالانتظار'), ('running', 'قيد التنفيذ'), ('done', 'مكتملة'), ('failed', 'فشلت')], default='pending', max_length=10, verbose_name='الحالة')),
+                ('attempts', models.PositiveIntegerField(default=0, verbose_name='المحاولات')),
+                ('max_attempts', models.PositiveIntegerField(default=5, verbose_name='أقصى عدد محاولات')),
+                ('run_at', models.DateTimeField(verbose_name='موعد التنفيذ')),
+                ('locked_until', models.DateTimeField(blank=True, null=True, verbose_name='محجوزة حتى')),
+                ('locked_by', models.CharField(blank=True, max_length=100, verbose_name='العامل')),
+                ('last_error', models.TextField(blank=True, verbose_name='آخر خطأ')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='تاريخ الإنشاء')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='تاريخ الانتهاء')),
+            ],
+            options={
+                'verbose_name': 'مهمة',
+                'verbose_name_plural': 'المهام',
+                'ordering': ['-id'],
+                'indexes': [models.Index(fields=['status', 'run_at'], name='library_tas_status_9f8e02_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.8 on 2026-10-19 19:01
+
+import library.uploads
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0007_task'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='author',
+            name='photo',
+            field=models.FileField(blank=True, null=True, upload_to='authors/', validators=[library.uploads.validate_image], verbose_name='الصورة'),
+        ),
+        migrations.AlterField(
+            model_name='book',
+            name='cover',
+            field=models.FileField(blank=True, null=True, upload_to='books/', validators=[library.uploads.validate_image], verbose_name='صورة الغلاف'),
+        ),
+        migrations.AlterField(
+            model_name='category',
+            name='image',
+            field=models.FileField(blank=True, null=True, upload_to='categories/', validators=[library.uploads.validate_image], verbose_name='صورة التصنيف'),
+        ),
+        migrations.AlterField(
+            model_name='userprofile',
+            name='profile_picture',
+            field=models.FileField(blank=True, null=True, upload_to='profiles/', validators=[library.uploads.validate_image], verbose_name='صورة الملف الشخصي'),
+        ),
+    ]
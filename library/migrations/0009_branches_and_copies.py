@@ -0,0 +1,136 @@
+# Generated by Django 5.2.8 on 2026-10-19 19:08
+
+from collections import defaultdict
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+BATCH_SIZE = 5000
+
+
+def copy_barcode(book_id, number):
+    return f'{book_id:06d}-{number:03d}'
+
+
+# turns total_copies into Copy rows at a single main branch. open loans decide how
+# many copies are out, the stored available_copies may have drifted from them
+def expand_copies(apps, schema_editor):
+    db = schema_editor.connection.alias
+    Book = apps.get_model('library', 'Book')
+    Branch = apps.get_model('library', 'Branch')
+    Copy = apps.get_model('library', 'Copy')
+    BranchStock = apps.get_model('library', 'BranchStock')
+    BorrowRecord = apps.get_model('library', 'BorrowRecord')
+
+    branch, _ = Branch.objects.using(db).get_or_create(
+        code=getattr(settings, 'LIBRARY_DEFAULT_BRANCH', 'MAIN'), defaults={'name': 'Main Library'},
+    )
+
+    open_loans = defaultdict(list)
+    loans = BorrowRecord.objects.using(db).filter(is_returned=False).order_by('book_id', 'id')
+    for record_id, book_id in loans.values_list('id', 'book_id').iterator(chunk_size=BATCH_SIZE):
+        open_loans[book_id].append(record_id)
+
+    copies, stock = [], []
+    books = Book.objects.using(db).order_by('id').values_list('id', 'total_copies')
+    for book_id, total in books.iterator(chunk_size=BATCH_SIZE):
+        on_loan = len(open_loans.get(book_id, ()))
+        total = max(total, on_loan)
+        if not total:
+            continue
+        copies.extend(
+            Copy(book_id=book_id, branch=branch, barcode=copy_barcode(book_id, number),
+                 status='on_loan' if number <= on_loan else 'available')
+            for number in range(1, total + 1)
+        )
+        stock.append(BranchStock(book_id=book_id, branch=branch, total_copies=total, available_copies=total - on_loan))
+        if len(copies) >= BATCH_SIZE:
+            Copy.objects.using(db).bulk_create(copies, batch_size=BATCH_SIZE)
+            BranchStock.objects.using(db).bulk_create(stock, batch_size=BATCH_SIZE)
+            copies, stock = [], []
+    Copy.objects.using(db).bulk_create(copies, batch_size=BATCH_SIZE)
+    BranchStock.objects.using(db).bulk_create(stock, batch_size=BATCH_SIZE)
+
+    # the nth open loan of a book gets its nth copy
+    lent = dict(Copy.objects.using(db).filter(status='on_loan').values_list('barcode', 'id').iterator(chunk_size=BATCH_SIZE))
+    records = [
+        BorrowRecord(id=record_id, copy_id=lent[copy_barcode(book_id, number)])
+        for book_id, record_ids in open_loans.items()
+        for number, record_id in enumerate(record_ids, 1)
+    ]
+    BorrowRecord.objects.using(db).bulk_update(records, ['copy'], batch_size=BATCH_SIZE)
+
+    # the book counters become the sums of the branch counters
+    stock_of = BranchStock.objects.using(db).filter(book_id=OuterRef('pk'))
+    Book.objects.using(db).update(
+        total_copies=Coalesce(Subquery(stock_of.values('total_copies')[:1]), 0),
+        available_copies=Coalesce(Subquery(stock_of.values('available_copies')[:1]), 0),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0008_image_validators'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Branch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, verbose_name='اسم الفرع')),
+                ('code', models.CharField(max_length=20, unique=True, verbose_name='رمز الفرع')),
+                ('address', models.CharField(blank=True, max_length=300, verbose_name='العنوان')),
+            ],
+            options={
+                'verbose_name': 'فرع',
+                'verbose_name_plural': 'الفروع',
+                'ordering': ['name'],
+            },
+        ),
+        migrations.CreateModel(
+            name='Copy',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('barcode', models.CharField(max_length=32, unique=True, verbose_name='الباركود')),
+                ('status', models.CharField(choices=[('available', 'متاحة'), ('on_loan', 'معارة'), ('withdrawn', 'مسحوبة')], default='available', max_length=10, verbose_name='الحالة')),
+                ('added_at', models.DateTimeField(auto_now_add=True, verbose_name='تاريخ الإضافة')),
+                ('book', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='copies', to='library.book', verbose_name='الكتاب')),
+                ('branch', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='copies', to='library.branch', verbose_name='الفرع')),
+            ],
+            options={
+                'verbose_name': 'نسخة',
+                'verbose_name_plural': 'النسخ',
+                'ordering': ['barcode'],
+            },
+        ),
+        migrations.AddField(
+            model_name='borrowrecord',
+            name='copy',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='borrows', to='library.copy', verbose_name='النسخة'),
+        ),
+        migrations.CreateModel(
+            name='BranchStock',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('total_copies', models.PositiveIntegerField(default=0, verbose_name='إجمالي النسخ')),
+                ('available_copies', models.PositiveIntegerField(default=0, verbose_name='النسخ المتاحة')),
+                ('book', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stock', to='library.book', verbose_name='الكتاب')),
+                ('branch', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stock', to='library.branch', verbose_name='الفرع')),
+            ],
+            options={
+                'verbose_name': 'مخزون فرع',
+                'verbose_name_plural': 'مخزون الفروع',
+                'constraints': [models.UniqueConstraint(fields=('book', 'branch'), name='unique_book_branch_stock')],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='copy',
+            index=models.Index(fields=['book', 'branch', 'status'], name='library_cop_book_id_f52a4c_idx'),
+        ),
+        migrations.RunPython(expand_copies, migrations.RunPython.noop),
+    ]
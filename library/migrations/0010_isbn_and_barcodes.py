@@ -0,0 +1,39 @@
+# Generated by Django 5.2.8 on 2026-10-19 19:12
+
+import library.codes
+from django.db import migrations
+
+from library.codes import normalize_barcode
+
+
+# barcodes typed into the admin before the field normalised them
+def normalize_barcodes(apps, schema_editor):
+    db = schema_editor.connection.alias
+    Copy = apps.get_model('library', 'Copy')
+    changed = [
+        Copy(id=pk, barcode=normalize_barcode(barcode))
+        for pk, barcode in Copy.objects.using(db).values_list('id', 'barcode').iterator(chunk_size=5000)
+        if normalize_barcode(barcode) != barcode
+    ]
+    Copy.objects.using(db).bulk_update(changed, ['barcode'], batch_size=5000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0009_branches_and_copies'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='isbn',
+            field=library.codes.ISBNField(blank=True, max_length=13, null=True, unique=True, verbose_name='ISBN'),
+        ),
+        migrations.AlterField(
+            model_name='copy',
+            name='barcode',
+            field=library.codes.BarcodeField(max_length=32, unique=True, verbose_name='الباركود'),
+        ),
+        migrations.RunPython(normalize_barcodes, migrations.RunPython.noop),
+    ]
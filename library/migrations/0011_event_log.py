@@ -0,0 +1,79 @@
+# Generated by Django 5.2.8 on 2026-10-19 19:16
+
+from django.db import migrations, models
+
+from library.events import ensure_partitions
+
+
+# the table CreateModel made is empty, on PostgreSQL it is swapped for one that is
+# range partitioned by month. the primary key has to include the partition key
+def partition_by_month(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('DROP TABLE library_event')
+    schema_editor.execute("""
+        CREATE TABLE library_event (
+            id bigint GENERATED BY DEFAULT AS IDENTITY,
+            kind smallint NOT NULL CHECK (kind >= 0),
+            occurred_at timestamp with time zone NOT NULL,
+            actor_id integer NULL,
+            user_id integer NULL,
+            book_id bigint NULL,
+            copy_id bigint NULL,
+            branch_id bigint NULL,
+            data jsonb NULL,
+            PRIMARY KEY (id, occurred_at)
+        ) PARTITION BY RANGE (occurred_at)
+    """)
+    schema_editor.execute('CREATE TABLE library_event_default PARTITION OF library_event DEFAULT')
+    schema_editor.execute('CREATE INDEX library_event_book_time ON library_event (book_id, occurred_at)')
+    schema_editor.execute('CREATE INDEX library_event_user_time ON library_event (user_id, occurred_at)')
+    # old months are dropped as whole partitions, rows are never changed
+    schema_editor.execute("""
+        CREATE FUNCTION library_event_append_only() RETURNS trigger AS $$
+        BEGIN
+            RAISE EXCEPTION 'library_event is append-only';
+        END
+        $$ LANGUAGE plpgsql
+    """)
+    schema_editor.execute(
+        'CREATE TRIGGER library_event_append_only BEFORE UPDATE OR DELETE ON library_event '
+        'FOR EACH ROW EXECUTE FUNCTION library_event_append_only()'
+    )
+    ensure_partitions(using=schema_editor.connection)
+
+
+def drop_trigger_function(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute('DROP FUNCTION IF EXISTS library_event_append_only() CASCADE')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0010_isbn_and_barcodes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Event',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.PositiveSmallIntegerField(choices=[(1, 'استعارة'), (2, 'إرجاع'), (3, 'مراجعة جديدة'), (4, 'تعديل النسخ'), (5, 'تعديل كتاب'), (6, 'تغيير الإعدادات')], verbose_name='الحدث')),
+                ('occurred_at', models.DateTimeField(verbose_name='الوقت')),
+                ('actor_id', models.IntegerField(blank=True, null=True, verbose_name='المنفذ')),
+                ('user_id', models.IntegerField(blank=True, null=True, verbose_name='المستخدم')),
+                ('book_id', models.BigIntegerField(blank=True, null=True, verbose_name='الكتاب')),
+                ('copy_id', models.BigIntegerField(blank=True, null=True, verbose_name='النسخة')),
+                ('branch_id', models.BigIntegerField(blank=True, null=True, verbose_name='الفرع')),
+                ('data', models.JSONField(blank=True, null=True, verbose_name='البيانات')),
+            ],
+            options={
+                'verbose_name': 'حدث',
+                'verbose_name_plural': 'سجل الأحداث',
+                'ordering': ['-id'],
+                'indexes': [models.Index(fields=['book_id', 'occurred_at'], name='library_event_book_time'), models.Index(fields=['user_id', 'occurred_at'], name='library_event_user_time')],
+            },
+        ),
+        migrations.RunPython(partition_by_month, drop_trigger_function),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 5.2.8 on 2026-10-19 19:21
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0011_event_log'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CategoryActivity',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('borrowed', models.PositiveIntegerField(default=0, verbose_name='الاستعارات')),
+                ('category', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='library.category', verbose_name='التصنيف')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='category_activity', to=settings.AUTH_USER_MODEL, verbose_name='المستخدم')),
+            ],
+            options={
+                'verbose_name': 'نشاط تصنيف',
+                'verbose_name_plural': 'نشاط التصنيفات',
+                'constraints': [models.UniqueConstraint(fields=('user', 'category'), name='unique_user_category_activity')],
+            },
+        ),
+        migrations.CreateModel(
+            name='ReadingActivity',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField(verbose_name='الشهر')),
+                ('borrowed', models.PositiveIntegerField(default=0, verbose_name='الاستعارات')),
+                ('returned', models.PositiveIntegerField(default=0, verbose_name='الإرجاعات')),
+                ('returned_late', models.PositiveIntegerField(default=0, verbose_name='الإرجاعات المتأخرة')),
+                ('reviews', models.PositiveIntegerField(default=0, verbose_name='المراجعات')),
+                ('rating_total', models.PositiveIntegerField(default=0, verbose_name='مجموع التقييمات')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='reading_activity', to=settings.AUTH_USER_MODEL, verbose_name='المستخدم')),
+            ],
+            options={
+                'verbose_name': 'نشاط قراءة شهري',
+                'verbose_name_plural': 'نشاط القراءة الشهري',
+                'ordering': ['month'],
+                'constraints': [models.UniqueConstraint(fields=('user', 'month'), name='unique_user_month_activity')],
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.8 on 2026-10-19 19:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0013_contact_message_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='book',
+            name='available_copies',
+            field=models.PositiveIntegerField(default=0, verbose_name='النسخ المتاحة'),
+        ),
+        migrations.AlterField(
+            model_name='book',
+            name='total_copies',
+            field=models.PositiveIntegerField(default=0, verbose_name='إجمالي النسخ'),
+        ),
+    ]
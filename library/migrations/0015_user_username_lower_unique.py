@@ -0,0 +1,45 @@
+from django.conf import settings
+from django.db import migrations
+from django.db.models import Count
+from django.db.models.functions import Lower
+
+
+# usernames made in the admin or the shell could differ only by case ("Ali" and
+# "ali"). the oldest account keeps its name, the others get their id appended so
+# the unique index below can be built. they log in with the new name or their email
+def suffix_duplicate_usernames(apps, schema_editor):
+    User = apps.get_model('auth', 'User')
+    users = User.objects.annotate(username_lower=Lower('username'))
+    taken = users.values('username_lower').annotate(n=Count('pk')).filter(n__gt=1).values_list('username_lower', flat=True)
+    keep = set()
+    for user in users.filter(username_lower__in=list(taken)).order_by('date_joined', 'pk'):
+        if user.username_lower in keep:
+            user.username = f'{user.username[:150 - len(str(user.pk)) - 1]}_{user.pk}'
+            user.save(update_fields=['username'])
+        else:
+            keep.add(user.username_lower)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0014_book_counters_default_zero'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    # registration relies on the username index instead of checking first. the
+    # partial unique email index from 0006 is only used by queries that repeat
+    # its email <> '' condition, so the plain one is back for the login lookup
+    operations = [
+        migrations.RunPython(suffix_duplicate_usernames, migrations.RunPython.noop),
+        migrations.RunSQL(
+            sql=[
+                'CREATE UNIQUE INDEX library_user_username_lower_uniq ON auth_user (LOWER(username));',
+                'CREATE INDEX library_user_email_lower_idx ON auth_user (LOWER(email));',
+            ],
+            reverse_sql=[
+                'DROP INDEX library_user_email_lower_idx;',
+                'DROP INDEX library_user_username_lower_uniq;',
+            ],
+        ),
+    ]
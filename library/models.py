@@ -1,13 +1,17 @@
 from django.db import models
 from django.contrib.auth.models import User
 from django.core.validators import MinValueValidator, MaxValueValidator
+from django.utils import timezone
+
+from .codes import BarcodeField, ISBNField
+from .uploads import validate_image
 
 
 
 class Category(models.Model):
     name = models.CharField(max_length=100, verbose_name='اسم التصنيف')
     icon = models.CharField(max_length=50, default='fa-book', verbose_name='الأيقونة')
-    image = models.FileField(upload_to='categories/', blank=True, null=True, verbose_name='صورة التصنيف')
+    image = models.FileField(upload_to='categories/', blank=True, null=True, validators=[validate_image], verbose_name='صورة التصنيف')
     description = models.TextField(blank=True, verbose_name='الوصف')
 
     class Meta:
@@ -26,7 +30,7 @@ class Category(models.Model):
 
 class Author(models.Model):
     name = models.CharField(max_length=200, verbose_name='اسم المؤلف')
-    photo = models.FileField(upload_to='authors/', blank=True, null=True, verbose_name='الصورة')
+    photo = models.FileField(upload_to='authors/', blank=True, null=True, validators=[validate_image], verbose_name='الصورة')
     bio = models.TextField(blank=True, verbose_name='السيرة الذاتية')
 
     class Meta:
@@ -45,15 +49,18 @@ class Author(models.Model):
 
 class Book(models.Model):
     title = models.CharField(max_length=300, verbose_name='عنوان الكتاب')
+    isbn = ISBNField(unique=True, blank=True, null=True, verbose_name='ISBN')
     author = models.ForeignKey(Author, on_delete=models.CASCADE, related_name='books', verbose_name='المؤلف')
     category = models.ForeignKey(Category, on_delete=models.SET_NULL, null=True, related_name='books', verbose_name='التصنيف')
-    cover = models.FileField(upload_to='books/', blank=True, null=True, verbose_name='صورة الغلاف')
+    cover = models.FileField(upload_to='books/', blank=True, null=True, validators=[validate_image], verbose_name='صورة الغلاف')
     description = models.TextField(blank=True, verbose_name='الوصف')
     publication_year = models.PositiveIntegerField(blank=True, null=True, verbose_name='سنة النشر')
     pages = models.PositiveIntegerField(blank=True, null=True, verbose_name='عدد الصفحات')
     language = models.CharField(max_length=50, default='English', verbose_name='اللغة')
-    total_copies = models.PositiveIntegerField(default=1, verbose_name='إجمالي النسخ')
-    available_copies = models.PositiveIntegerField(default=1, verbose_name='النسخ المتاحة')
+    # sums over BranchStock, moved by library/circulation.py. a book created with
+    # total_copies set gets that many copies at the default branch
+    total_copies = models.PositiveIntegerField(default=0, verbose_name='إجمالي النسخ')
+    available_copies = models.PositiveIntegerField(default=0, verbose_name='النسخ المتاحة')
     created_at = models.DateTimeField(auto_now_add=True, verbose_name='تاريخ الإضافة')
 
     class Meta:
@@ -82,10 +89,91 @@ class Book(models.Model):
 
 
 
+class Branch(models.Model):
+    name = models.CharField(max_length=100, verbose_name='اسم الفرع')
+    code = models.CharField(max_length=20, unique=True, verbose_name='رمز الفرع')
+    address = models.CharField(max_length=300, blank=True, verbose_name='العنوان')
+
+    class Meta:
+        verbose_name = 'فرع'
+        verbose_name_plural = 'الفروع'
+        ordering = ['name']
+
+    def __str__(self):
+        return self.name
+
+
+
+# one physical copy on a shelf. status changes go through library/circulation.py
+# so the BranchStock counters move with them
+class Copy(models.Model):
+    AVAILABLE = 'available'
+    ON_LOAN = 'on_loan'
+    WITHDRAWN = 'withdrawn'
+    STATUS_CHOICES = [
+        (AVAILABLE, 'متاحة'),
+        (ON_LOAN, 'معارة'),
+        (WITHDRAWN, 'مسحوبة'),
+    ]
+
+    book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='copies', verbose_name='الكتاب')
+    branch = models.ForeignKey(Branch, on_delete=models.PROTECT, related_name='copies', verbose_name='الفرع')
+    barcode = BarcodeField(max_length=32, unique=True, verbose_name='الباركود')
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=AVAILABLE, verbose_name='الحالة')
+    added_at = models.DateTimeField(auto_now_add=True, verbose_name='تاريخ الإضافة')
+
+    class Meta:
+        verbose_name = 'نسخة'
+        verbose_name_plural = 'النسخ'
+        ordering = ['barcode']
+        # finding a free copy of a book at a branch
+        indexes = [models.Index(fields=['book', 'branch', 'status'])]
+
+    def __str__(self):
+        return self.barcode
+
+
+
+# copies of a book per branch, so availability is one indexed row instead of a
+# count over Copy. Book.total_copies and available_copies are the sums over branches
+class BranchStock(models.Model):
+    book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='stock', verbose_name='الكتاب')
+    branch = models.ForeignKey(Branch, on_delete=models.CASCADE, related_name='stock', verbose_name='الفرع')
+    total_copies = models.PositiveIntegerField(default=0, verbose_name='إجمالي النسخ')
+    available_copies = models.PositiveIntegerField(default=0, verbose_name='النسخ المتاحة')
+
+    class Meta:
+        verbose_name = 'مخزون فرع'
+        verbose_name_plural = 'مخزون الفروع'
+        constraints = [models.UniqueConstraint(fields=['book', 'branch'], name='unique_book_branch_stock')]
+
+    def __str__(self):
+        return f'{self.book_id} @ {self.branch_id}: {self.available_copies}/{self.total_copies}'
+
+
+
+# precomputed "readers also borrowed" neighbours, filled by build_recommendations
+class RelatedBook(models.Model):
+    book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='related_entries', verbose_name='الكتاب')
+    related = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='+', verbose_name='الكتاب المقترح')
+    score = models.FloatField(verbose_name='درجة التشابه')
+    computed_at = models.DateTimeField(auto_now=True, verbose_name='وقت الحساب')
+
+    class Meta:
+        verbose_name = 'كتاب مقترح'
+        verbose_name_plural = 'الكتب المقترحة'
+        ordering = ['-score']
+        indexes = [models.Index(fields=['book', '-score'])]
+
+    def __str__(self):
+        return f'{self.book_id} -> {self.related_id} ({self.score:.3f})'
+
+
+
 class UserProfile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='profile', verbose_name='المستخدم')
     phone = models.CharField(max_length=20, blank=True, verbose_name='رقم الهاتف')
-    profile_picture = models.FileField(upload_to='profiles/', blank=True, null=True, verbose_name='صورة الملف الشخصي')
+    profile_picture = models.FileField(upload_to='profiles/', blank=True, null=True, validators=[validate_image], verbose_name='صورة الملف الشخصي')
 
     class Meta:
         verbose_name = 'ملف شخصي'
@@ -107,6 +195,7 @@ class UserProfile(models.Model):
 class BorrowRecord(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='borrows', verbose_name='المستخدم')
     book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='borrows', verbose_name='الكتاب')
+    copy = models.ForeignKey(Copy, on_delete=models.SET_NULL, null=True, blank=True, related_name='borrows', verbose_name='النسخة')
     borrow_date = models.DateField(auto_now_add=True, verbose_name='تاريخ الاستعارة')
     due_date = models.DateField(verbose_name='تاريخ الإرجاع المتوقع')
     return_date = models.DateField(blank=True, null=True, verbose_name='تاريخ الإرجاع الفعلي')
@@ -122,14 +211,12 @@ class BorrowRecord(models.Model):
 
     # true if past due date
     def is_overdue(self):
-        from django.utils import timezone
         if not self.is_returned and self.due_date < timezone.now().date():
             return True
         return False
 
     # days left before its late
     def days_remaining(self):
-        from django.utils import timezone
         if self.is_returned:
             return 0
         delta = self.due_date - timezone.now().date()
@@ -156,6 +243,43 @@ class Review(models.Model):
 
 
 
+# one row per member per calendar month, kept up to date by library/activity.py
+# as books are borrowed, returned and reviewed. rebuilt by backfill_activity
+class ReadingActivity(models.Model):
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='reading_activity', verbose_name='المستخدم')
+    month = models.DateField(verbose_name='الشهر')
+    borrowed = models.PositiveIntegerField(default=0, verbose_name='الاستعارات')
+    returned = models.PositiveIntegerField(default=0, verbose_name='الإرجاعات')
+    returned_late = models.PositiveIntegerField(default=0, verbose_name='الإرجاعات المتأخرة')
+    reviews = models.PositiveIntegerField(default=0, verbose_name='المراجعات')
+    rating_total = models.PositiveIntegerField(default=0, verbose_name='مجموع التقييمات')
+
+    class Meta:
+        verbose_name = 'نشاط قراءة شهري'
+        verbose_name_plural = 'نشاط القراءة الشهري'
+        ordering = ['month']
+        constraints = [models.UniqueConstraint(fields=['user', 'month'], name='unique_user_month_activity')]
+
+    def __str__(self):
+        return f'{self.user_id} {self.month:%Y-%m}: {self.borrowed} borrowed'
+
+
+# borrows per member and category, for the favourite categories on the profile
+class CategoryActivity(models.Model):
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='category_activity', verbose_name='المستخدم')
+    category = models.ForeignKey(Category, on_delete=models.CASCADE, related_name='+', verbose_name='التصنيف')
+    borrowed = models.PositiveIntegerField(default=0, verbose_name='الاستعارات')
+
+    class Meta:
+        verbose_name = 'نشاط تصنيف'
+        verbose_name_plural = 'نشاط التصنيفات'
+        constraints = [models.UniqueConstraint(fields=['user', 'category'], name='unique_user_category_activity')]
+
+    def __str__(self):
+        return f'{self.user_id} / {self.category_id}: {self.borrowed}'
+
+
+
 class ContactMessage(models.Model):
     name = models.CharField(max_length=100, verbose_name='الاسم')
     email = models.EmailField(verbose_name='البريد الإلكتروني')
@@ -167,6 +291,8 @@ class ContactMessage(models.Model):
         verbose_name = 'رسالة تواصل'
         verbose_name_plural = 'رسائل التواصل'
         ordering = ['-created_at']
+        # newest first and date filters in the admin, and every message from one sender
+        indexes = [models.Index(fields=['created_at']), models.Index(fields=['email'])]
 
     def __str__(self):
         return f'{self.name} - {self.subject}'
@@ -210,3 +336,95 @@ class SiteSettings(models.Model):
 
         obj, created = cls.objects.get_or_create(pk=1)
         return obj
+
+
+
+# deferred work for the run_worker command, see library/taskqueue.py
+class Task(models.Model):
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PENDING, 'بالانتظار'),
+        (RUNNING, 'قيد التنفيذ'),
+        (DONE, 'مكتملة'),
+        (FAILED, 'فشلت'),
+    ]
+
+    name = models.CharField(max_length=100, verbose_name='المهمة')
+    kwargs = models.JSONField(default=dict, blank=True, verbose_name='المعاملات')
+    # a second enqueue with the same key returns the first task instead
+    idempotency_key = models.CharField(max_length=200, unique=True, blank=True, null=True, verbose_name='مفتاح عدم التكرار')
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING, verbose_name='الحالة')
+    attempts = models.PositiveIntegerField(default=0, verbose_name='المحاولات')
+    max_attempts = models.PositiveIntegerField(default=5, verbose_name='أقصى عدد محاولات')
+    run_at = models.DateTimeField(verbose_name='موعد التنفيذ')
+    # a running task whose lease ran out is picked up again by another worker
+    locked_until = models.DateTimeField(blank=True, null=True, verbose_name='محجوزة حتى')
+    locked_by = models.CharField(max_length=100, blank=True, verbose_name='العامل')
+    last_error = models.TextField(blank=True, verbose_name='آخر خطأ')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='تاريخ الإنشاء')
+    finished_at = models.DateTimeField(blank=True, null=True, verbose_name='تاريخ الانتهاء')
+
+    class Meta:
+        verbose_name = 'مهمة'
+        verbose_name_plural = 'المهام'
+        ordering = ['-id']
+        indexes = [models.Index(fields=['status', 'run_at'])]
+
+    def __str__(self):
+        return f'{self.name} #{self.pk} ({self.status})'
+
+
+
+class EventQuerySet(models.QuerySet):
+    def update(self, **kwargs):
+        raise TypeError('Events are append-only.')
+
+    def delete(self):
+        raise TypeError('Events are append-only.')
+
+
+# append-only history of catalog and circulation changes, written in batches by
+# library/events.py. plain ids rather than foreign keys, so deleting a book or a
+# user never touches its history. partitioned by month on PostgreSQL
+class Event(models.Model):
+    BORROWED = 1
+    RETURNED = 2
+    REVIEW_ADDED = 3
+    COPIES_ADJUSTED = 4
+    BOOK_EDITED = 5
+    SETTINGS_CHANGED = 6
+    KIND_CHOICES = [
+        (BORROWED, 'استعارة'),
+        (RETURNED, 'إرجاع'),
+        (REVIEW_ADDED, 'مراجعة جديدة'),
+        (COPIES_ADJUSTED, 'تعديل النسخ'),
+        (BOOK_EDITED, 'تعديل كتاب'),
+        (SETTINGS_CHANGED, 'تغيير الإعدادات'),
+    ]
+
+    kind = models.PositiveSmallIntegerField(choices=KIND_CHOICES, verbose_name='الحدث')
+    occurred_at = models.DateTimeField(verbose_name='الوقت')
+    # who did it, the member it concerns can be someone else (desk checkouts)
+    actor_id = models.IntegerField(blank=True, null=True, verbose_name='المنفذ')
+    user_id = models.IntegerField(blank=True, null=True, verbose_name='المستخدم')
+    book_id = models.BigIntegerField(blank=True, null=True, verbose_name='الكتاب')
+    copy_id = models.BigIntegerField(blank=True, null=True, verbose_name='النسخة')
+    branch_id = models.BigIntegerField(blank=True, null=True, verbose_name='الفرع')
+    data = models.JSONField(blank=True, null=True, verbose_name='البيانات')
+
+    objects = EventQuerySet.as_manager()
+
+    class Meta:
+        verbose_name = 'حدث'
+        verbose_name_plural = 'سجل الأحداث'
+        ordering = ['-id']
+        indexes = [
+            models.Index(fields=['book_id', 'occurred_at'], name='library_event_book_time'),
+            models.Index(fields=['user_id', 'occurred_at'], name='library_event_user_time'),
+        ]
+
+    def __str__(self):
+        return f'{self.get_kind_display()} #{self.pk} at {self.occurred_at}'
@@ -0,0 +1,272 @@
+import cProfile
+import io
+import itertools
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import defaultdict, deque
+from datetime import datetime
+
+from django.conf import settings
+from django.contrib import admin
+from django.contrib.admin.views.decorators import staff_member_required
+from django.core import signing
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+from django.http import Http404, HttpResponse
+from django.shortcuts import render
+from django.template.base import Template
+from django.utils import timezone
+
+
+PROFILE_PARAM = '_profile'
+PROFILE_HEADER = 'X-Profile'
+TOKEN_SALT = 'library.profiling'
+
+TEMPLATE_RENDER = Template.render.__code__
+
+# last few profiles, oldest drop off the end. with PROFILING_DIR set they are
+# files there instead, so every worker process lists the same ones
+profiles = deque(maxlen=getattr(settings, 'PROFILING_RING_SIZE', 20))
+profile_ids = itertools.count(1)
+profiles_lock = threading.Lock()
+
+# one profiled request at a time per process. cProfile hooks the whole
+# interpreter, a second enable() raises ValueError on 3.12+
+profiling_lock = threading.Lock()
+
+
+def make_token(user):
+    return signing.TimestampSigner(salt=TOKEN_SALT).sign(str(user.pk))
+
+
+def token_valid(token, user):
+    try:
+        user_pk = signing.TimestampSigner(salt=TOKEN_SALT).unsign(
+            token, max_age=getattr(settings, 'PROFILING_TOKEN_MAX_AGE', 60 * 60 * 12),
+        )
+    except signing.BadSignature:
+        return False
+    return user_pk == str(user.pk)
+
+
+# times every query and notes which ones ran while a template was rendering
+class QueryTimer:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.in_templates = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.count += 1
+            self.total += elapsed
+            frame = sys._getframe(1)
+            while frame is not None:
+                if frame.f_code is TEMPLATE_RENDER:
+                    self.in_templates += elapsed
+                    break
+                frame = frame.f_back
+
+
+# samples the request thread's stack on a timer, cProfile only keeps caller/callee
+# pairs so it cant give real stacks. output is "a;b;c count" per stack, which
+# flamegraph.pl and speedscope read
+class StackSampler(threading.Thread):
+    def __init__(self, thread_id, stop_code, interval):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.stop_code = stop_code
+        self.interval = interval
+        self.samples = defaultdict(int)
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            # stop at the middleware so server frames dont show up in every stack
+            while frame is not None and frame.f_code is not self.stop_code:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({code.co_filename.rsplit("/", 1)[-1]}:{code.co_firstlineno})')
+                frame = frame.f_back
+            if stack:
+                self.samples[';'.join(reversed(stack))] += 1
+
+    def collapsed(self):
+        return '\n'.join(f'{stack} {count}' for stack, count in self.samples.items())
+
+
+# staff only, turned on per request with ?_profile=<token> or an X-Profile header
+class ProfilingMiddleware:
+    def __init__(self, get_response):
+        if not getattr(settings, 'PROFILING_ENABLED', False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        token = request.GET.get(PROFILE_PARAM) or request.headers.get(PROFILE_HEADER)
+        if not token:
+            return self.get_response(request)
+
+        user = getattr(request, 'user', None)
+        if user is None or not user.is_staff or not token_valid(token, user):
+            return self.get_response(request)
+
+        # another request is being profiled, this one just runs
+        if not profiling_lock.acquire(blocking=False):
+            return self.get_response(request)
+        try:
+            return self.profile(request, user)
+        finally:
+            profiling_lock.release()
+
+    def profile(self, request, user):
+        timer = QueryTimer()
+        profiler = cProfile.Profile()
+        sampler = StackSampler(
+            threading.get_ident(), type(self).profile.__code__,
+            getattr(settings, 'PROFILING_SAMPLE_INTERVAL', 0.001),
+        )
+        sampler.start()
+        started = time.perf_counter()
+        with connection.execute_wrapper(timer):
+            profiler.enable()
+            try:
+                response = self.get_response(request)
+                # lazy template responses render here, keep that inside the profile
+                if hasattr(response, 'render') and callable(response.render):
+                    response.render()
+            finally:
+                profiler.disable()
+                sampler.stopped.set()
+        total = time.perf_counter() - started
+        sampler.join()
+
+        stats = pstats.Stats(profiler)
+        template_key = (TEMPLATE_RENDER.co_filename, TEMPLATE_RENDER.co_firstlineno, TEMPLATE_RENDER.co_name)
+        template_total = stats.stats[template_key][3] if template_key in stats.stats else 0.0
+        template_only = max(template_total - timer.in_templates, 0.0)
+
+        report = io.StringIO()
+        stats.stream = report
+        stats.sort_stats('cumulative').print_stats(40)
+
+        save_profile({
+            'id': f'{time.time_ns()}-{os.getpid()}-{next(profile_ids)}',
+            'path': request.get_full_path(),
+            'method': request.method,
+            'status': response.status_code,
+            'user': user.get_username(),
+            'created_at': timezone.now(),
+            'total_ms': total * 1000,
+            'sql_ms': timer.total * 1000,
+            'sql_count': timer.count,
+            'template_ms': template_only * 1000,
+            'python_ms': max(total - timer.total - template_only, 0.0) * 1000,
+            'report': report.getvalue(),
+            'collapsed': sampler.collapsed(),
+        })
+        return response
+
+
+def save_profile(profile):
+    directory = getattr(settings, 'PROFILING_DIR', None)
+    if not directory:
+        with profiles_lock:
+            profiles.appendleft(profile)
+        return
+
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f'{profile["id"]}.json')
+    temporary = f'{path}.{os.getpid()}.tmp'
+    with open(temporary, 'w') as f:
+        json.dump({**profile, 'created_at': profile['created_at'].isoformat()}, f)
+    os.replace(temporary, path)
+    # ids start with the time, so the oldest files sort first
+    for name in saved_names(directory)[getattr(settings, 'PROFILING_RING_SIZE', 20):]:
+        try:
+            os.remove(os.path.join(directory, name))
+        except FileNotFoundError:
+            pass
+
+
+def saved_names(directory):
+    try:
+        names = [name for name in os.listdir(directory) if name.endswith('.json')]
+    except FileNotFoundError:
+        return []
+    return sorted(names, key=lambda name: int(name.split('-', 1)[0]), reverse=True)
+
+
+def load_profile(path):
+    with open(path) as f:
+        profile = json.load(f)
+    profile['created_at'] = datetime.fromisoformat(profile['created_at'])
+    return profile
+
+
+def recent_profiles():
+    directory = getattr(settings, 'PROFILING_DIR', None)
+    if not directory:
+        with profiles_lock:
+            return list(profiles)
+    items = []
+    for name in saved_names(directory):
+        try:
+            items.append(load_profile(os.path.join(directory, name)))
+        except (FileNotFoundError, ValueError):
+            # pruned by another worker, or not a profile
+            continue
+    return items
+
+
+# ids come from the url as slugs, so they never leave the directory
+def find_profile(profile_id):
+    directory = getattr(settings, 'PROFILING_DIR', None)
+    if directory:
+        try:
+            return load_profile(os.path.join(directory, f'{profile_id}.json'))
+        except (FileNotFoundError, ValueError):
+            raise Http404('Profile no longer kept')
+    with profiles_lock:
+        for profile in profiles:
+            if profile['id'] == profile_id:
+                return profile
+    raise Http404('Profile no longer kept')
+
+
+@staff_member_required
+def profile_list(request):
+    return render(request, 'admin/profiles/list.html', {
+        **admin.site.each_context(request),
+        'title': 'Request profiles',
+        'profiles': recent_profiles(),
+        'enabled': getattr(settings, 'PROFILING_ENABLED', False),
+        'param': PROFILE_PARAM,
+        'header': PROFILE_HEADER,
+        'token': make_token(request.user),
+    })
+
+
+@staff_member_required
+def profile_detail(request, profile_id):
+    return render(request, 'admin/profiles/detail.html', {
+        **admin.site.each_context(request),
+        'title': 'Request profile',
+        'profile': find_profile(profile_id),
+    })
+
+
+@staff_member_required
+def profile_collapsed(request, profile_id):
+    response = HttpResponse(find_profile(profile_id)['collapsed'], content_type='text/plain; charset=utf-8')
+    response['Content-Disposition'] = f'attachment; filename="profile-{profile_id}.folded"'
+    return response
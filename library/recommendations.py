@@ -0,0 +1,180 @@
+import heapq
+from collections import Counter, defaultdict
+from datetime import timedelta
+from math import sqrt
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Max, Min, Q
+from django.utils import timezone
+
+from .metrics import cache_requests
+from .models import Book, BorrowRecord, Review, RelatedBook
+from .sessions import LOCAL_CACHE_BACKENDS
+
+
+TOP_K = 12
+
+FOR_YOU_SIZE = 6
+FOR_YOU_TIMEOUT = 60 * 60 * 24
+# a per-process cache only drops the list in the worker that saw the borrow, the
+# others keep theirs this long
+FOR_YOU_LOCAL_TIMEOUT = 60 * 5
+
+# readers with huge histories add lots of pairs but say little about any one book
+MAX_BASKET = 200
+
+
+# every book each user has borrowed or reviewed, streamed in chunks
+def load_baskets(chunk_size=20000):
+    baskets = defaultdict(set)
+    for model in (BorrowRecord, Review):
+        rows = model.objects.order_by().values_list('user_id', 'book_id')
+        for user_id, book_id in rows.iterator(chunk_size=chunk_size):
+            baskets[user_id].add(book_id)
+    return baskets
+
+
+# cosine similarity on co-borrow counts, keeping the top_k neighbours per book
+def compute_neighbours(baskets, book_ids=None, top_k=TOP_K):
+    readers = defaultdict(list)
+    for user_id, books in baskets.items():
+        if len(books) > MAX_BASKET:
+            continue
+        for book_id in books:
+            readers[book_id].append(user_id)
+
+    targets = readers.keys() if book_ids is None else book_ids
+    neighbours = {}
+    for book_id in targets:
+        book_readers = readers.get(book_id)
+        if not book_readers:
+            neighbours[book_id] = []
+            continue
+
+        co_counts = Counter()
+        for user_id in book_readers:
+            co_counts.update(baskets[user_id])
+        del co_counts[book_id]
+
+        popularity = len(book_readers)
+        scored = (
+            (count / sqrt(popularity * len(readers[other])), other)
+            for other, count in co_counts.items()
+        )
+        neighbours[book_id] = heapq.nlargest(top_k, scored)
+    return neighbours
+
+
+# full rebuilds are forced once the oldest row is this old, see changed_book_ids
+FULL_REBUILD_DAYS = 7
+
+
+# books whose lists can change since the last build: everything touched by
+# a reader who borrowed or reviewed something new. a new reader also changes the
+# popularity of the book, which moves its score in the lists of books outside this
+# set. those lists drift until the next full rebuild, at most FULL_REBUILD_DAYS
+def changed_book_ids(since):
+    active_users = (
+        Q(user_id__in=BorrowRecord.objects.filter(borrow_date__gte=since.date()).values('user_id'))
+        | Q(user_id__in=Review.objects.filter(created_at__gte=since).values('user_id'))
+    )
+    changed = set(BorrowRecord.objects.filter(active_users).values_list('book_id', flat=True))
+    changed.update(Review.objects.filter(active_users).values_list('book_id', flat=True))
+    return changed
+
+
+def last_build_time():
+    return RelatedBook.objects.aggregate(last=Max('computed_at'))['last']
+
+
+# rows that no incremental run touched are as old as the last full rebuild
+def needs_full_rebuild(max_age_days=None):
+    oldest = RelatedBook.objects.aggregate(oldest=Min('computed_at'))['oldest']
+    if max_age_days is None:
+        max_age_days = getattr(settings, 'RECOMMENDATIONS_FULL_REBUILD_DAYS', FULL_REBUILD_DAYS)
+    return oldest is None or timezone.now() - oldest > timedelta(days=max_age_days)
+
+
+# recompute neighbours for book_ids (or the whole catalog) and swap the rows in
+def rebuild(book_ids=None, top_k=TOP_K, batch_size=5000):
+    neighbours = compute_neighbours(load_baskets(), book_ids, top_k)
+
+    with transaction.atomic():
+        if book_ids is None:
+            RelatedBook.objects.all().delete()
+        else:
+            ids = list(neighbours)
+            for start in range(0, len(ids), batch_size):
+                RelatedBook.objects.filter(book_id__in=ids[start:start + batch_size]).delete()
+
+        batch = []
+        for book_id, items in neighbours.items():
+            for score, related_id in items:
+                batch.append(RelatedBook(book_id=book_id, related_id=related_id, score=score))
+            if len(batch) >= batch_size:
+                RelatedBook.objects.bulk_create(batch)
+                batch = []
+        RelatedBook.objects.bulk_create(batch)
+
+    return len(neighbours)
+
+
+def for_you_cache_key(user_id):
+    return f'library:for_you:{user_id}'
+
+
+# ranks unread books by how often the user went for their category and author
+def compute_for_you(user_id, limit=FOR_YOU_SIZE):
+    history = list(BorrowRecord.objects.filter(user_id=user_id).values_list(
+        'book_id', 'book__category_id', 'book__author_id',
+    ))
+    history += Review.objects.filter(user_id=user_id).values_list(
+        'book_id', 'book__category_id', 'book__author_id',
+    )
+    if not history:
+        return []
+
+    seen = {book_id for book_id, _, _ in history}
+    categories = Counter(category_id for _, category_id, _ in history if category_id)
+    authors = Counter(author_id for _, _, author_id in history)
+    top_categories = [c for c, _ in categories.most_common(3)]
+    top_authors = [a for a, _ in authors.most_common(5)]
+
+    candidates = Book.objects.filter(
+        Q(category_id__in=top_categories) | Q(author_id__in=top_authors)
+    ).exclude(id__in=seen).values_list('id', 'category_id', 'author_id')[:limit * 10]
+
+    # an author match counts double, readers tend to stick with authors
+    scored = (
+        (categories[category_id] + 2 * authors[author_id], book_id)
+        for book_id, category_id, author_id in candidates
+    )
+    return [book_id for _, book_id in heapq.nlargest(limit, scored)]
+
+
+def for_you_timeout():
+    backend = settings.CACHES.get('default', {}).get('BACKEND')
+    return FOR_YOU_LOCAL_TIMEOUT if backend in LOCAL_CACHE_BACKENDS else FOR_YOU_TIMEOUT
+
+
+# cached ids, regenerated on the next visit after a borrow, return or review
+def for_you_books(user_id):
+    key = for_you_cache_key(user_id)
+    book_ids = cache.get(key)
+    cache_requests.inc(cache='for_you', result='miss' if book_ids is None else 'hit')
+    if book_ids is None:
+        book_ids = compute_for_you(user_id)
+        cache.set(key, book_ids, for_you_timeout())
+    if not book_ids:
+        return []
+
+    books = Book.objects.in_bulk(book_ids)
+    return [books[book_id] for book_id in book_ids if book_id in books]
+
+
+# once the transaction commits, so a visit in between cant cache the old history again
+def invalidate_for_you(user_ids):
+    keys = [for_you_cache_key(user_id) for user_id in set(user_ids)]
+    transaction.on_commit(lambda: cache.delete_many(keys))
@@ -0,0 +1,141 @@
+import time
+import unicodedata
+from array import array
+from bisect import bisect_left
+
+from .indexing import InMemoryIndex
+from .models import Author, Book, Category
+
+
+KINDS = ('book', 'author', 'category')
+SOURCES = {'book': Book, 'author': Author, 'category': Category}
+LABELS = {'book': 'title', 'author': 'name', 'category': 'name'}
+KIND_SHIFT = 48
+ID_MASK = (1 << KIND_SHIFT) - 1
+
+# only the start of each key is stored, nobody types 25 letters before picking
+KEY_LENGTH = 24
+# full title plus the next couple of word starts, so "art of war" finds "The Art of War"
+MAX_KEYS_PER_ENTRY = 3
+
+# hamza/madda forms are handled by NFKD, these letters need mapping by hand
+ARABIC_FOLDS = str.maketrans({
+    'ٱ': 'ا',
+    'ى': 'ي',
+    'ة': 'ه',
+    'ـ': None,
+})
+
+
+# strips diacritics (latin accents and arabic harakat), folds alef variants and case
+def normalize(text):
+    text = unicodedata.normalize('NFKD', text)
+    text = ''.join(ch for ch in text if not unicodedata.combining(ch))
+    return ' '.join(text.translate(ARABIC_FOLDS).casefold().split())
+
+
+def index_keys(label):
+    words = normalize(label).split()
+    keys = []
+    for start in range(min(len(words), MAX_KEYS_PER_ENTRY)):
+        key = ' '.join(words[start:])[:KEY_LENGTH]
+        if key not in keys:
+            keys.append(key)
+    return keys
+
+
+def make_ref(kind, pk):
+    return KINDS.index(kind) << KIND_SHIFT | pk
+
+
+# sorted keys with a parallel array of refs, searched with bisect
+class PrefixIndex(InMemoryIndex):
+    name = 'search index'
+    max_age_setting = 'SEARCH_INDEX_MAX_AGE'
+
+    def __init__(self):
+        super().__init__()
+        self.keys = []
+        self.refs = array('q')
+        self.labels = {}
+
+    def load(self):
+        pairs = []
+        labels = {}
+        for kind in KINDS:
+            rows = SOURCES[kind].objects.order_by().values_list('id', LABELS[kind])
+            for pk, label in rows.iterator(chunk_size=5000):
+                ref = make_ref(kind, pk)
+                labels[ref] = label
+                pairs.extend((key, ref) for key in index_keys(label))
+        pairs.sort()
+
+        # equal keys share one string object, word suffixes repeat a lot
+        shared = {}
+        keys = [shared.setdefault(key, key) for key, _ in pairs]
+        refs = array('q', (ref for _, ref in pairs))
+        with self.lock:
+            self.keys, self.refs, self.labels = keys, refs, labels
+            self.built_at = time.monotonic()
+
+    def replay(self, refs):
+        for kind, pk in refs:
+            label = SOURCES[kind].objects.filter(pk=pk).values_list(LABELS[kind], flat=True).first()
+            if label is None:
+                self.remove(kind, pk)
+            else:
+                self.update(kind, pk, label)
+
+    def _remove(self, ref):
+        label = self.labels.pop(ref, None)
+        if label is None:
+            return
+        for key in index_keys(label):
+            pos = bisect_left(self.keys, key)
+            while pos < len(self.keys) and self.keys[pos] == key:
+                if self.refs[pos] == ref:
+                    del self.keys[pos]
+                    del self.refs[pos]
+                    break
+                pos += 1
+
+    def update(self, kind, pk, label):
+        ref = make_ref(kind, pk)
+        with self.lock:
+            self.touch((kind, pk))
+            self._remove(ref)
+            self.labels[ref] = label
+            for key in index_keys(label):
+                pos = bisect_left(self.keys, key)
+                while pos < len(self.keys) and self.keys[pos] == key and self.refs[pos] < ref:
+                    pos += 1
+                self.keys.insert(pos, key)
+                self.refs.insert(pos, ref)
+
+    def remove(self, kind, pk):
+        with self.lock:
+            self.touch((kind, pk))
+            self._remove(make_ref(kind, pk))
+
+    def search(self, text, limit=10):
+        self.ensure_fresh()
+        prefix = normalize(text)[:KEY_LENGTH]
+        if not prefix:
+            return []
+
+        results = []
+        seen = set()
+        with self.lock:
+            pos = bisect_left(self.keys, prefix)
+            while pos < len(self.keys) and len(results) < limit:
+                if not self.keys[pos].startswith(prefix):
+                    break
+                ref = self.refs[pos]
+                if ref not in seen:
+                    seen.add(ref)
+                    results.append((KINDS[ref >> KIND_SHIFT], ref & ID_MASK, self.labels[ref]))
+                pos += 1
+        return results
+
+
+index = PrefixIndex()
@@ -0,0 +1,69 @@
+from django.conf import settings
+from django.contrib.sessions.backends.cached_db import SessionStore as CachedDBStore
+from django.core import checks
+from django.core.exceptions import ImproperlyConfigured
+
+# caches that live inside one process (or keep nothing at all)
+LOCAL_CACHE_BACKENDS = {
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+}
+
+
+# the session cache backend when it can't hold write-behind sessions, else None
+def unshared_cache_backend():
+    alias = getattr(settings, 'SESSION_CACHE_ALIAS', 'default')
+    backend = settings.CACHES.get(alias, {}).get('BACKEND')
+    return backend if backend in LOCAL_CACHE_BACKENDS else None
+
+
+# cache holds the live session, the db copy is refreshed at most once per
+# SESSION_WRITE_BEHIND_SECONDS. needs a shared cache (memcached/redis/file):
+# with a per-process cache another worker, or an eviction, falls back to a db
+# row up to that old and logins or updates are lost
+class SessionStore(CachedDBStore):
+    cache_key_prefix = 'library.sessions.write_behind'
+
+    def __init__(self, session_key=None):
+        backend = unshared_cache_backend()
+        if backend:
+            raise ImproperlyConfigured(
+                f'The write_behind session engine needs a shared cache, {backend} is per process.'
+            )
+        super().__init__(session_key)
+
+    def save(self, must_create=False):
+        # new sessions always go to the db so the row exists for other workers
+        if must_create or self.session_key is None:
+            super().save(must_create)
+            self._cache.set(self.cache_key + ':synced', True, self.write_behind_seconds())
+            return
+
+        synced_key = self.cache_key + ':synced'
+        if self._cache.get(synced_key) is None:
+            super().save(must_create)
+            self._cache.set(synced_key, True, self.write_behind_seconds())
+        else:
+            self._cache.set(self.cache_key, self._session, self.get_expiry_age())
+
+    def delete(self, session_key=None):
+        key = session_key or self.session_key
+        super().delete(session_key)
+        if key:
+            self._cache.delete(self.cache_key_prefix + key + ':synced')
+
+    @staticmethod
+    def write_behind_seconds():
+        return getattr(settings, 'SESSION_WRITE_BEHIND_SECONDS', 60)
+
+
+@checks.register(checks.Tags.caches)
+def check_session_cache(app_configs, **kwargs):
+    backend = unshared_cache_backend()
+    if settings.SESSION_ENGINE != __name__ or not backend:
+        return []
+    return [checks.Error(
+        f'The write_behind session engine needs a shared cache, {backend} is per process.',
+        hint='Point CACHES at memcached or redis (DJANGO_CACHE_BACKEND), or use the cached_db session backend.',
+        id='library.E001',
+    )]
@@ -0,0 +1,137 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from . import activity, circulation, events
+from .models import Author, Book, BorrowRecord, Category, Event, Review, UserProfile
+from .facets import index as facet_index
+from .recommendations import invalidate_for_you
+from .search_index import index as search_index
+from .taskqueue import enqueue
+from .tasks import delete_replaced_file
+from .uploads import file_fields
+
+UPLOAD_FIELDS = dict(file_fields())
+
+
+# a borrow, return or review changes what we suggest on the home page. the bulk
+# returns in circulation skip these signals and invalidate themselves
+@receiver([post_save, post_delete], sender=BorrowRecord)
+@receiver([post_save, post_delete], sender=Review)
+def reset_for_you(sender, instance, **kwargs):
+    invalidate_for_you([instance.user_id])
+
+
+# Book.objects.create(total_copies=3) from the shell, a fixture-less import or
+# a test shelves three real copies, so the counters always match the copies.
+# the admin add form zeroes the count first and adds them itself
+@receiver(post_save, sender=Book)
+def shelve_new_book(sender, instance, created, raw=False, **kwargs):
+    if not created or raw or not instance.total_copies:
+        return
+    count = instance.total_copies
+    with transaction.atomic():
+        Book.objects.filter(pk=instance.pk).update(total_copies=0, available_copies=0)
+        circulation.add_copies(instance, circulation.default_branch(), count)
+    instance.refresh_from_db(fields=['total_copies', 'available_copies'])
+
+
+# keep the autocomplete index in step, only if this process built or is building it
+@receiver(post_save, sender=Book)
+@receiver(post_save, sender=Author)
+@receiver(post_save, sender=Category)
+def update_search_index(sender, instance, **kwargs):
+    if not search_index.is_tracking():
+        return
+    kind = sender._meta.model_name
+    search_index.update(kind, instance.pk, instance.title if sender is Book else instance.name)
+
+
+@receiver(post_delete, sender=Book)
+@receiver(post_delete, sender=Author)
+@receiver(post_delete, sender=Category)
+def remove_from_search_index(sender, instance, **kwargs):
+    if not search_index.is_tracking():
+        return
+    search_index.remove(sender._meta.model_name, instance.pk)
+
+
+@receiver(post_save, sender=Book)
+def update_facet_index(sender, instance, **kwargs):
+    if facet_index.is_tracking():
+        facet_index.update_book(instance)
+
+
+@receiver(post_delete, sender=Book)
+def remove_from_facet_index(sender, instance, **kwargs):
+    if facet_index.is_tracking():
+        facet_index.remove_book(instance.pk)
+
+
+@receiver(post_save, sender=Review)
+def log_review(sender, instance, created, **kwargs):
+    if created:
+        events.record(Event.REVIEW_ADDED, book=instance.book_id, user=instance.user_id, actor=instance.user_id,
+                      rating=instance.rating)
+
+
+# the rating a review had before this save, so an edit only adds the difference
+@receiver(pre_save, sender=Review)
+def remember_rating(sender, instance, **kwargs):
+    instance._stored_rating = None
+    if instance.pk is not None:
+        instance._stored_rating = sender.objects.filter(pk=instance.pk).values_list('rating', flat=True).first()
+
+
+@receiver(post_save, sender=Review)
+def count_review(sender, instance, created, **kwargs):
+    if created:
+        activity.reviewed(instance)
+    elif getattr(instance, '_stored_rating', None) is not None:
+        activity.reviewed(instance, 0, instance.rating - instance._stored_rating)
+
+
+@receiver(post_delete, sender=Review)
+def uncount_review(sender, instance, **kwargs):
+    activity.reviewed(instance, -1)
+
+
+# a new or removed review moves the book between rating buckets
+@receiver([post_save, post_delete], sender=Review)
+def update_facet_rating(sender, instance, **kwargs):
+    if facet_index.is_tracking():
+        facet_index.update_rating(instance.book_id)
+
+
+# remember which file the row pointed at before this save
+@receiver(pre_save, sender=Book)
+@receiver(pre_save, sender=Author)
+@receiver(pre_save, sender=Category)
+@receiver(pre_save, sender=UserProfile)
+def remember_stored_file(sender, instance, update_fields=None, **kwargs):
+    field = UPLOAD_FIELDS[sender]
+    instance._stored_file = None
+    if instance.pk is None or (update_fields is not None and field not in update_fields):
+        return
+    instance._stored_file = sender.objects.filter(pk=instance.pk).values_list(field, flat=True).first()
+
+
+# the replaced file goes once nothing else points at it, the worker checks that
+@receiver(post_save, sender=Book)
+@receiver(post_save, sender=Author)
+@receiver(post_save, sender=Category)
+@receiver(post_save, sender=UserProfile)
+def clean_up_replaced_file(sender, instance, **kwargs):
+    previous = getattr(instance, '_stored_file', None)
+    if previous and previous != getattr(instance, UPLOAD_FIELDS[sender]).name:
+        enqueue(delete_replaced_file, name=previous)
+
+
+@receiver(post_delete, sender=Book)
+@receiver(post_delete, sender=Author)
+@receiver(post_delete, sender=Category)
+@receiver(post_delete, sender=UserProfile)
+def clean_up_deleted_file(sender, instance, **kwargs):
+    name = getattr(instance, UPLOAD_FIELDS[sender]).name
+    if name:
+        enqueue(delete_replaced_file, name=name)
@@ -88,3 +88,31 @@ document.addEventListener('DOMContentLoaded', function () {
         });
     });
 });
+
+// search suggestions from the autocomplete endpoint, debounced per keystroke
+document.addEventListener('DOMContentLoaded', function () {
+    var input = document.querySelector('input[data-autocomplete-url]');
+    if (!input) return;
+
+    var list = document.getElementById(input.getAttribute('list'));
+    var timer = null;
+
+    input.addEventListener('input', function () {
+        clearTimeout(timer);
+        var q = input.value.trim();
+        if (!q) return;
+
+        timer = setTimeout(function () {
+            fetch(input.dataset.autocompleteUrl + '?q=' + encodeURIComponent(q))
+                .then(function (res) { return res.json(); })
+                .then(function (data) {
+                    list.innerHTML = '';
+                    data.results.forEach(function (item) {
+                        var option = document.createElement('option');
+                        option.value = item.label;
+                        list.appendChild(option);
+                    });
+                });
+        }, 150);
+    });
+});
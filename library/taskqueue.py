@@ -0,0 +1,176 @@
+import logging
+import random
+import traceback
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Min, Q
+from django.utils import timezone
+
+from .metrics import CallbackGauge, task_duration, task_latency, task_runs
+from .models import Task
+
+
+logger = logging.getLogger(__name__)
+
+# name -> (function, max attempts, visibility timeout in seconds)
+registry = {}
+
+
+# registers a function the worker can run, its kwargs have to be JSON
+def task(name=None, max_attempts=None, timeout=None):
+    def decorator(func):
+        registry[name or f'{func.__module__}.{func.__name__}'] = (
+            func,
+            max_attempts or getattr(settings, 'TASK_MAX_ATTEMPTS', 5),
+            timeout or getattr(settings, 'TASK_VISIBILITY_TIMEOUT', 300),
+        )
+        func.task_name = name or f'{func.__module__}.{func.__name__}'
+        return func
+    return decorator
+
+
+# stores the task and returns at once. inside a transaction the row commits
+# or rolls back with the rest of the request's writes
+def enqueue(func, *, idempotency_key=None, delay=0, **kwargs):
+    name = getattr(func, 'task_name', func)
+    if name not in registry:
+        raise ValueError(f'Unknown task {name!r}.')
+
+    if idempotency_key:
+        existing = Task.objects.filter(idempotency_key=idempotency_key).first()
+        if existing is not None:
+            return existing
+
+    try:
+        with transaction.atomic():
+            return Task.objects.create(
+                name=name,
+                kwargs=kwargs,
+                idempotency_key=idempotency_key or None,
+                max_attempts=registry[name][1],
+                run_at=timezone.now() + timedelta(seconds=delay),
+            )
+    except IntegrityError:
+        # someone enqueued the same key between the lookup and the insert
+        if not idempotency_key:
+            raise
+        return Task.objects.get(idempotency_key=idempotency_key)
+
+
+def due(now):
+    return Q(status=Task.PENDING, run_at__lte=now) | Q(status=Task.RUNNING, locked_until__lt=now)
+
+
+# picks tasks with an UPDATE guarded by the same filter, so when two workers
+# race for a row only one of them gets its token written. the attempt is
+# counted here so a task that kills its worker still runs out of attempts
+def claim(worker, limit):
+    now = timezone.now()
+    ids = list(Task.objects.filter(due(now)).order_by('run_at').values_list('id', flat=True)[:limit])
+    if not ids:
+        return []
+
+    token = f'{worker}:{uuid.uuid4().hex[:12]}'
+    claimed = Task.objects.filter(due(now), id__in=ids).update(
+        status=Task.RUNNING, locked_by=token, locked_until=now + timedelta(seconds=max_timeout()),
+        attempts=F('attempts') + 1,
+    )
+    if not claimed:
+        return []
+
+    tasks = []
+    for item in Task.objects.filter(locked_by=token, status=Task.RUNNING):
+        mine = Task.objects.filter(pk=item.pk, locked_by=token)
+        if item.attempts > item.max_attempts:
+            mine.update(status=Task.FAILED, last_error='Lease expired on the last attempt.', finished_at=now)
+            task_runs.inc(task=item.name, outcome='failed')
+            continue
+        # the claim used the longest lease, shorter tasks get theirs back
+        timeout = registry[item.name][2] if item.name in registry else max_timeout()
+        if timeout < max_timeout():
+            item.locked_until = now + timedelta(seconds=timeout)
+            mine.update(locked_until=item.locked_until)
+        tasks.append(item)
+    return tasks
+
+
+def max_timeout():
+    return max((entry[2] for entry in registry.values()), default=getattr(settings, 'TASK_VISIBILITY_TIMEOUT', 300))
+
+
+# exponential with jitter so failed tasks dont all come back in the same second
+def backoff(attempts):
+    base = getattr(settings, 'TASK_RETRY_BACKOFF', 10)
+    cap = getattr(settings, 'TASK_RETRY_BACKOFF_MAX', 3600)
+    delay = min(base * 2 ** (attempts - 1), cap)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def run(item):
+    started = timezone.now()
+    task_latency.observe((started - item.run_at).total_seconds(), task=item.name)
+    attempts = item.attempts
+    # every write is guarded by the token, a worker that lost its lease changes nothing
+    mine = Task.objects.filter(pk=item.pk, locked_by=item.locked_by)
+
+    entry = registry.get(item.name)
+    if entry is None:
+        mine.update(status=Task.FAILED, last_error=f'Unknown task {item.name!r}.', finished_at=started)
+        task_runs.inc(task=item.name, outcome='unknown')
+        return
+
+    try:
+        entry[0](**item.kwargs)
+    except Exception:
+        error = traceback.format_exc()
+        if attempts >= item.max_attempts:
+            mine.update(status=Task.FAILED, last_error=error, finished_at=timezone.now())
+            task_runs.inc(task=item.name, outcome='failed')
+            logger.error('Task %s #%s failed for good after %d attempt(s)', item.name, item.pk, attempts)
+        else:
+            mine.update(
+                status=Task.PENDING, last_error=error, locked_until=None, locked_by='',
+                run_at=timezone.now() + timedelta(seconds=backoff(attempts)),
+            )
+            task_runs.inc(task=item.name, outcome='retry')
+            logger.warning('Task %s #%s failed, attempt %d of %d', item.name, item.pk, attempts, item.max_attempts)
+    else:
+        mine.update(status=Task.DONE, last_error='', locked_until=None, finished_at=timezone.now())
+        task_runs.inc(task=item.name, outcome='done')
+    finally:
+        task_duration.observe((timezone.now() - started).total_seconds(), task=item.name)
+
+
+# finished rows are only kept around for their idempotency keys and the admin
+def purge_finished(older_than, chunk_size=1000):
+    finished = Task.objects.filter(
+        status__in=[Task.DONE, Task.FAILED], finished_at__lt=timezone.now() - older_than,
+    ).order_by()
+    removed = 0
+    while True:
+        ids = list(finished.values_list('id', flat=True)[:chunk_size])
+        if not ids:
+            return removed
+        removed += Task.objects.filter(id__in=ids).delete()[0]
+
+
+# read when /metrics is scraped, so the numbers come from the table and not from one process
+def queue_samples():
+    statuses = [Task.PENDING, Task.RUNNING, Task.FAILED]
+    samples = {(('status', status),): 0 for status in statuses}
+    for row in Task.objects.filter(status__in=statuses).values('status').annotate(n=Count('id')).order_by():
+        samples[(('status', row['status']),)] = row['n']
+    return samples
+
+
+def oldest_due_samples():
+    oldest = Task.objects.filter(status=Task.PENDING, run_at__lte=timezone.now()).aggregate(oldest=Min('run_at'))['oldest']
+    age = (timezone.now() - oldest).total_seconds() if oldest else 0
+    return {(): age}
+
+
+CallbackGauge('library_task_queue_depth', 'Tasks not finished yet by status.', queue_samples)
+CallbackGauge('library_task_oldest_due_seconds', 'How long the oldest due task has been waiting.', oldest_due_samples)
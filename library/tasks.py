@@ -0,0 +1,46 @@
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.files.storage import default_storage
+from django.core.mail import mail_admins
+
+from .hashers import WrappedPBKDF2PasswordHasher
+from .models import ContactMessage
+from .taskqueue import enqueue, task
+from .uploads import is_referenced
+
+
+# staff hear about new contact messages without the visitor waiting on SMTP
+@task(name='notify_contact_message')
+def notify_contact_message(message_id):
+    message = ContactMessage.objects.filter(pk=message_id).first()
+    if message is None:
+        return
+    mail_admins(
+        f'Contact: {message.subject}',
+        f'From: {message.name} <{message.email}>\n\n{message.message}',
+    )
+
+
+# old uploads are removed after the new one is saved, storage may be remote and slow.
+# stored files are shared by content hash, so another row may still use it
+@task(name='delete_replaced_file')
+def delete_replaced_file(name):
+    if name and not is_referenced(name) and default_storage.exists(name):
+        default_storage.delete(name)
+
+
+# cheap provisioning hashes of students who havent logged in yet are wrapped in
+# the full-cost hasher, a batch per run and the next batch queued behind it.
+# the UPDATE only lands if the hash is still the one that was read
+@task(name='rehash_provisioned_passwords')
+def rehash_provisioned_passwords(after=0):
+    hasher = WrappedPBKDF2PasswordHasher()
+    size = getattr(settings, 'PASSWORD_REHASH_BATCH_SIZE', 50)
+    users = list(User.objects.filter(pk__gt=after, password__startswith=f'{hasher.inner}$').order_by('pk').values_list(
+        'pk', 'password',
+    )[:size])
+    for pk, password in users:
+        if int(password.split('$')[1]) < hasher.iterations:
+            User.objects.filter(pk=pk, password=password).update(password=hasher.wrap(password))
+    if len(users) == size:
+        enqueue(rehash_provisioned_passwords, after=users[-1][0])
@@ -4,12 +4,26 @@ from django.utils.safestring import mark_safe
 register = template.Library()
 
 
+AVAILABLE_BADGE = mark_safe('<span class="badge bg-available">Available</span>')
+BORROWED_BADGE = mark_safe('<span class="badge bg-borrowed">Fully Borrowed</span>')
+
+FULL_STAR = '<i class="fas fa-star star-filled"></i>'
+HALF_STAR = '<i class="fas fa-star-half-alt star-filled"></i>'
+EMPTY_STAR = '<i class="far fa-star star-empty"></i>'
+
+# all 11 possible outputs (0 to 5 in half steps), built once at import
+STAR_STRINGS = [
+    mark_safe(FULL_STAR * (steps // 2) + HALF_STAR * (steps % 2) + EMPTY_STAR * (5 - steps // 2 - steps % 2))
+    for steps in range(11)
+]
+
+
 # badge showing if the book has copies left
 @register.filter(name='book_status')
 def book_status(book):
     if book.available_copies > 0:
-        return mark_safe('<span class="badge bg-available">Available</span>')
-    return mark_safe('<span class="badge bg-borrowed">Fully Borrowed</span>')
+        return AVAILABLE_BADGE
+    return BORROWED_BADGE
 
 
 # turns a number like 3.5 into filled and empty star icons
@@ -20,16 +34,6 @@ def star_rating(value):
     except (ValueError, TypeError):
         val = 0
 
-    full = int(val)
-    half = 1 if val - full >= 0.5 else 0
-    empty = 5 - full - half
-
-    stars = ''
-    for i in range(full):
-        stars += '<i class="fas fa-star star-filled"></i>'
-    if half:
-        stars += '<i class="fas fa-star-half-alt star-filled"></i>'
-    for i in range(empty):
-        stars += '<i class="far fa-star star-empty"></i>'
-
-    return mark_safe(stars)
+    # half steps, anything from x.5 up shows a half star
+    steps = int(val * 2)
+    return STAR_STRINGS[min(max(steps, 0), 10)]
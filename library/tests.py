@@ -1,3 +1,1115 @@
-from django.test import TestCase
+import contextlib
+import csv
+import io
+import json
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import zipfile
+from datetime import timedelta
+from importlib import import_module
+from importlib.util import find_spec
+from unittest import mock, skipUnless
+from xml.dom import minidom
 
-# Create your tests here.
+from django.apps import apps
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import OperationalError, connection
+from django.db.models import F, Sum
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from . import (
+    activity, api, circulation, events, exports, facets, media, metrics, profiling, recommendations, search_index,
+    sessions, taskqueue, uploads,
+)
+from .accounts import RegistrationError, register_user
+from .admin import EstimatedCountPaginator
+from .auth import find_account
+from .forms import RegistrationForm
+from .hashers import ProvisioningPasswordHasher
+from .models import (
+    Author, Book, BorrowRecord, Branch, BranchStock, Category, CategoryActivity, ContactMessage, Copy, ReadingActivity,
+    RelatedBook, Review, Task, VisitLog,
+)
+from .tasks import rehash_provisioned_passwords
+
+
+class DuplicateEmailMigrationTests(TestCase):
+    migration = import_module('library.migrations.0006_user_email_lower_unique')
+
+    def test_oldest_account_keeps_a_shared_email(self):
+        with connection.cursor() as cursor:
+            cursor.execute('DROP INDEX library_user_email_lower_uniq')
+        first = User.objects.create(username='first', email='Reader@example.com')
+        second = User.objects.create(username='second', email='reader@example.com')
+        third = User.objects.create(username='third', email='READER@example.com')
+        other = User.objects.create(username='other', email='other@example.com')
+        blank = [User.objects.create(username=f'blank{i}', email='') for i in range(2)]
+
+        self.migration.clear_duplicate_emails(apps, connection.schema_editor())
+        for user in (first, second, third, other, *blank):
+            user.refresh_from_db()
+        self.assertEqual(first.email, 'Reader@example.com')
+        self.assertEqual((second.email, third.email), ('', ''))
+        self.assertEqual(other.email, 'other@example.com')
+
+        # the index the migration builds next goes in cleanly
+        with connection.cursor() as cursor:
+            cursor.execute(self.migration.Migration.operations[1].sql[1])
+
+
+class DuplicateUsernameMigrationTests(TestCase):
+    migration = import_module('library.migrations.0015_user_username_lower_unique')
+
+    def test_oldest_account_keeps_a_shared_username(self):
+        with connection.cursor() as cursor:
+            cursor.execute('DROP INDEX library_user_username_lower_uniq')
+        first = User.objects.create(username='Ali')
+        second = User.objects.create(username='ali')
+        other = User.objects.create(username='omar')
+
+        self.migration.suffix_duplicate_usernames(apps, connection.schema_editor())
+        for user in (first, second, other):
+            user.refresh_from_db()
+        self.assertEqual((first.username, second.username, other.username), ('Ali', f'ali_{second.pk}', 'omar'))
+        with connection.cursor() as cursor:
+            cursor.execute(self.migration.Migration.operations[1].sql[0])
+
+    def test_login_lookup_uses_an_index(self):
+        with CaptureQueriesContext(connection) as queries:
+            find_account('reader@example.com')
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + queries[0]['sql'])
+            plan = ' '.join(str(row) for row in cursor.fetchall())
+        self.assertNotIn('SCAN auth_user', plan)
+
+
+class RegistrationFormTests(TestCase):
+    def form(self, **data):
+        return RegistrationForm({
+            'full_name': 'Ali Hassan', 'username': 'ali', 'email': 'ali@example.com',
+            'password': 'long enough', 'confirm_password': 'long enough', **data,
+        })
+
+    def test_username_taken_in_another_case(self):
+        User.objects.create(username='Ali')
+        form = self.form()
+        self.assertTrue(form.is_valid(), form.errors)
+        with self.assertRaises(RegistrationError) as raised:
+            register_user(**{name: form.cleaned_data[name] for name in ('username', 'email', 'password', 'full_name')})
+        self.assertEqual(raised.exception.field, 'username')
+        self.assertFalse(User.objects.filter(email='ali@example.com').exists())
+
+    def test_email_taken_in_another_case(self):
+        User.objects.create(username='other', email='ALI@example.com')
+        with self.assertRaises(RegistrationError) as raised:
+            register_user('ali', 'ali@example.com', 'long enough', 'Ali Hassan')
+        self.assertEqual(raised.exception.field, 'email')
+
+    def test_username_is_lowercased(self):
+        form = self.form(username='NewReader')
+        self.assertTrue(form.is_valid(), form.errors)
+        self.assertEqual(form.cleaned_data['username'], 'newreader')
+
+
+class StockTests(TestCase):
+    def setUp(self):
+        self.author = Author.objects.create(name='Author')
+        self.member = User.objects.create(username='member')
+        self.branch = Branch.objects.create(name='East', code='EAST')
+
+    def assertCountersMatchCopies(self, book):
+        book.refresh_from_db()
+        copies = book.copies.exclude(status=Copy.WITHDRAWN)
+        stock = BranchStock.objects.filter(book=book).aggregate(t=Sum('total_copies'), a=Sum('available_copies'))
+        self.assertEqual(book.total_copies, copies.count())
+        self.assertEqual(book.available_copies, copies.filter(status=Copy.AVAILABLE).count())
+        self.assertEqual((stock['t'] or 0, stock['a'] or 0), (book.total_copies, book.available_copies))
+
+    def test_created_book_gets_real_copies(self):
+        book = Book.objects.create(title='Counted', author=self.author, total_copies=3)
+        self.assertEqual(book.copies.count(), 3)
+        self.assertCountersMatchCopies(book)
+        self.assertEqual(Book.objects.create(title='Empty', author=self.author).available_copies, 0)
+
+    def test_borrow_and_return(self):
+        book = Book.objects.create(title='Loaned', author=self.author, total_copies=1)
+        record = circulation.borrow(self.member, book)
+        self.assertEqual(record.copy.status, Copy.ON_LOAN)
+        self.assertCountersMatchCopies(book)
+        with self.assertRaises(circulation.CirculationError):
+            circulation.borrow(User.objects.create(username='second'), book)
+        circulation.return_record(record)
+        self.assertCountersMatchCopies(book)
+        self.assertEqual(book.available_copies, 1)
+        with self.assertRaises(circulation.CirculationError):
+            circulation.return_record(record)
+
+    def test_stock_and_withdraw_copies_for_a_selection(self):
+        books = [Book.objects.create(title=f'Book {i}', author=self.author, total_copies=1) for i in range(3)]
+        self.assertEqual(circulation.stock_copies([book.pk for book in books], self.branch, count=2), 3)
+        record = circulation.borrow(self.member, books[0], branch=self.branch)
+
+        withdrawn = circulation.withdraw_copies(Copy.objects.filter(book__in=books, branch=self.branch))
+        # the copy on loan stays out
+        self.assertEqual(withdrawn, 5)
+        self.assertEqual(Copy.objects.get(pk=record.copy_id).status, Copy.ON_LOAN)
+        for book in books:
+            self.assertCountersMatchCopies(book)
+
+    def test_barcodes_continue_after_a_deleted_copy(self):
+        book = Book.objects.create(title='Numbered', author=self.author, total_copies=2)
+        book.copies.order_by('barcode').first().delete()
+        circulation.rebuild_stock(Book.objects.filter(pk=book.pk))
+        circulation.add_copies(book, self.branch, count=2)
+        self.assertEqual(
+            sorted(book.copies.values_list('barcode', flat=True)),
+            [f'{book.pk:06d}-002', f'{book.pk:06d}-003', f'{book.pk:06d}-004'],
+        )
+        self.assertCountersMatchCopies(book)
+
+    def test_deleted_copies_leave_the_counters(self):
+        book = Book.objects.create(title='Pruned', author=self.author, total_copies=3)
+        record = circulation.borrow(self.member, book)
+        circulation.withdraw_copies(book.copies.filter(pk=book.copies.filter(status=Copy.AVAILABLE).first().pk))
+        self.assertEqual(circulation.delete_copies(book.copies.all()), 3)
+        self.assertCountersMatchCopies(book)
+        self.assertEqual((book.total_copies, book.available_copies), (0, 0))
+        # the loan goes on without its copy and returns nothing to the shelf
+        circulation.return_record(BorrowRecord.objects.get(pk=record.pk))
+        self.assertCountersMatchCopies(book)
+
+    def test_rebuild_stock_fixes_drifted_counters(self):
+        book = Book.objects.create(title='Drifted', author=self.author, total_copies=2)
+        circulation.borrow(self.member, book)
+        Book.objects.filter(pk=book.pk).update(total_copies=9, available_copies=9)
+        BranchStock.objects.filter(book=book).update(available_copies=7)
+        self.assertEqual(circulation.rebuild_stock(Book.objects.filter(pk=book.pk)), 1)
+        self.assertCountersMatchCopies(book)
+        self.assertEqual((book.total_copies, book.available_copies), (2, 1))
+        self.assertEqual(BorrowRecord.objects.filter(book=book, is_returned=False).count(), 1)
+
+
+@override_settings(PASSWORD_PBKDF2_ITERATIONS=2000, PASSWORD_PROVISIONING_ITERATIONS=10, PASSWORD_REHASH_BATCH_SIZE=2)
+class ProvisionedPasswordTests(TestCase):
+    def test_cheap_hashes_are_wrapped_and_upgraded_on_login(self):
+        cheap = ProvisioningPasswordHasher()
+        users = [User.objects.create(username=f'student{i}', password=make_password('secret', hasher=cheap)) for i in range(3)]
+        full = User.objects.create(username='staff', password=make_password('secret'))
+
+        rehash_provisioned_passwords()
+        # the third student is left to the task queued behind the first batch
+        queued = Task.objects.get(name='rehash_provisioned_passwords')
+        rehash_provisioned_passwords(**queued.kwargs)
+
+        for user in users:
+            user.refresh_from_db()
+            self.assertTrue(user.password.startswith('pbkdf2_wrapped_sha256$10$'))
+        self.assertEqual(User.objects.get(pk=full.pk).password, full.password)
+
+        user = users[0]
+        self.assertFalse(user.check_password('wrong'))
+        self.assertTrue(user.check_password('secret'))
+        user.refresh_from_db()
+        self.assertTrue(user.password.startswith('pbkdf2_sha256$2000$'))
+        self.assertTrue(user.check_password('secret'))
+
+
+calls = []
+
+
+@taskqueue.task(name='tests.record_call', max_attempts=2, timeout=30)
+def record_call(fail=False, **kwargs):
+    calls.append(kwargs)
+    if fail:
+        raise RuntimeError('task failed')
+
+
+class TaskQueueTests(TestCase):
+    def setUp(self):
+        calls.clear()
+
+    def expire(self, task):
+        Task.objects.filter(pk=task.pk).update(run_at=timezone.now(), locked_until=timezone.now() - timedelta(seconds=1))
+
+    def test_enqueue_with_a_key_runs_once(self):
+        first = taskqueue.enqueue(record_call, idempotency_key='welcome:1', n=1)
+        second = taskqueue.enqueue(record_call, idempotency_key='welcome:1', n=2)
+        self.assertEqual(first.pk, second.pk)
+        self.assertEqual(Task.objects.count(), 1)
+
+        # another request inserted the key between the lookup and the insert
+        none = Task.objects.none()
+        with mock.patch.object(Task.objects, 'filter', return_value=none):
+            third = taskqueue.enqueue(record_call, idempotency_key='welcome:1', n=3)
+        self.assertEqual(third.pk, first.pk)
+        self.assertEqual(Task.objects.get().kwargs, {'n': 1})
+
+        with self.assertRaises(ValueError):
+            taskqueue.enqueue('tests.unknown')
+
+    def test_expired_lease_is_reclaimed(self):
+        queued = taskqueue.enqueue(record_call, n=1)
+        [claimed] = taskqueue.claim('a', 10)
+        self.assertEqual(claimed.attempts, 1)
+        # the task's own timeout, not the longest lease
+        self.assertLessEqual(claimed.locked_until, timezone.now() + timedelta(seconds=30))
+        self.assertEqual(taskqueue.claim('b', 10), [])
+
+        self.expire(queued)
+        [reclaimed] = taskqueue.claim('b', 10)
+        self.assertEqual(reclaimed.attempts, 2)
+        self.assertTrue(reclaimed.locked_by.startswith('b:'))
+
+        # the first worker lost its lease, finishing late changes nothing
+        taskqueue.run(claimed)
+        self.assertEqual(Task.objects.get().status, Task.RUNNING)
+        taskqueue.run(reclaimed)
+        self.assertEqual(Task.objects.get().status, Task.DONE)
+
+    def test_lease_expired_on_the_last_attempt_fails(self):
+        queued = taskqueue.enqueue(record_call)
+        for worker in ('a', 'b'):
+            self.assertEqual(len(taskqueue.claim(worker, 10)), 1)
+            self.expire(queued)
+        self.assertEqual(taskqueue.claim('c', 10), [])
+        task = Task.objects.get()
+        self.assertEqual(task.status, Task.FAILED)
+        self.assertEqual(task.last_error, 'Lease expired on the last attempt.')
+
+    def test_failures_back_off_until_max_attempts(self):
+        queued = taskqueue.enqueue(record_call, fail=True)
+        [claimed] = taskqueue.claim('a', 10)
+        before = timezone.now()
+        with self.assertLogs('library.taskqueue', 'WARNING'):
+            taskqueue.run(claimed)
+        task = Task.objects.get()
+        self.assertEqual((task.status, task.locked_by), (Task.PENDING, ''))
+        self.assertIn('task failed', task.last_error)
+        self.assertGreaterEqual(task.run_at, before + timedelta(seconds=5))
+        self.assertEqual(taskqueue.claim('a', 10), [])
+
+        self.expire(queued)
+        [claimed] = taskqueue.claim('a', 10)
+        with self.assertLogs('library.taskqueue', 'ERROR'):
+            taskqueue.run(claimed)
+        task = Task.objects.get()
+        self.assertEqual((task.status, task.attempts), (Task.FAILED, 2))
+        self.assertEqual(len(calls), 2)
+
+    def test_backoff_grows_and_is_capped(self):
+        with override_settings(TASK_RETRY_BACKOFF=10, TASK_RETRY_BACKOFF_MAX=3600):
+            for attempts, low, high in ((1, 5, 10), (3, 20, 40), (20, 1800, 3600)):
+                for _ in range(20):
+                    self.assertTrue(low <= taskqueue.backoff(attempts) <= high, attempts)
+
+
+class ContactIntakeTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def post(self, **data):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(reverse('contact'), {
+                'name': 'Visitor', 'email': 'visitor@example.com', 'subject': 'Hours', 'message': 'When do you open?',
+                **data,
+            })
+
+    def test_duplicate_is_stored_once(self):
+        self.assertEqual(self.post().status_code, 302)
+        self.assertEqual(self.post(message='When  do you open?').status_code, 302)
+        self.assertEqual(ContactMessage.objects.count(), 1)
+        self.assertEqual(Task.objects.filter(name='notify_contact_message').count(), 1)
+
+    @override_settings(CONTACT_EMAIL_BURST=2)
+    def test_sender_is_throttled_after_the_burst(self):
+        for i in range(2):
+            self.assertEqual(self.post(subject=f'Question {i}').status_code, 302)
+        self.assertEqual(self.post(subject='One more').status_code, 429)
+        self.assertEqual(self.post(subject='Another', email='other@example.com').status_code, 302)
+        self.assertEqual(ContactMessage.objects.count(), 3)
+
+    def test_failed_write_can_be_sent_again(self):
+        with mock.patch('library.forms.ContactForm.save', side_effect=OperationalError), self.assertLogs('library.contact'):
+            self.assertEqual(self.post().status_code, 503)
+        self.assertEqual(self.post().status_code, 302)
+        self.assertEqual(ContactMessage.objects.count(), 1)
+
+
+class MetricsTests(TestCase):
+    def test_finished_threads_are_folded_into_the_base(self):
+        counter = metrics.Counter('library_test_threads_total', 'Test counter.')
+        self.addCleanup(metrics.registry.remove, counter)
+        for _ in range(20):
+            thread = threading.Thread(target=counter.inc, kwargs={'amount': 2, 'kind': 'a'})
+            thread.start()
+            thread.join()
+        counter.inc(kind='a')
+        self.assertEqual(len(counter._shards), 1)
+        self.assertEqual(counter.samples(), {(('kind', 'a'),): 41})
+
+    def test_files_of_dead_workers_move_to_dead_json(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        dead_pid = 2 ** 22 + 1  # above the pid range, never alive
+        row = {'kind': 'counter', 'help': 'Test counter.', 'buckets': [], 'samples': [[[['kind', 'a']], 3]]}
+        with open(os.path.join(directory, f'{dead_pid}.json'), 'w') as f:
+            json.dump({'library_test_dead_total': row}, f)
+
+        with override_settings(METRICS_DIR=directory):
+            for _ in range(2):
+                collected = metrics.collect()
+                self.assertEqual(collected['library_test_dead_total']['samples'], {(('kind', 'a'),): 3})
+            self.assertFalse(os.path.exists(os.path.join(directory, f'{dead_pid}.json')))
+            self.assertTrue(os.path.exists(os.path.join(directory, f'{os.getpid()}.json')))
+
+            before = metrics.collect()['library_http_requests_total']['samples']
+            metrics.mark_process_dead(os.getpid())
+            self.addCleanup(setattr, metrics, '_dead_pid', None)
+            self.assertEqual(sorted(os.listdir(directory)), ['.lock', 'dead.json'])
+            with open(os.path.join(directory, 'dead.json')) as f:
+                dead = metrics.merge([json.load(f)])
+            self.assertEqual(dead['library_http_requests_total']['samples'], before)
+
+    @override_settings(METRICS_TOKEN='s3cret', METRICS_ALLOWED_IPS=[])
+    def test_scrape_needs_staff_or_the_token(self):
+        url = reverse('metrics')
+        self.assertEqual(self.client.get(url, REMOTE_ADDR='127.0.0.1').status_code, 403)
+        self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+        self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION='Bearer s3cret').status_code, 200)
+        self.client.force_login(User.objects.create(username='staff', is_staff=True))
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+
+@override_settings(PROFILING_ENABLED=True)
+class ProfilingTests(TestCase):
+    def setUp(self):
+        self.staff = User.objects.create(username='staff', is_staff=True)
+        self.middleware = profiling.ProfilingMiddleware(lambda request: HttpResponse('ok'))
+
+    def profiled_request(self):
+        request = RequestFactory().get('/', {profiling.PROFILE_PARAM: profiling.make_token(self.staff)})
+        request.user = self.staff
+        return self.middleware(request)
+
+    def test_busy_profiler_lets_the_request_through(self):
+        with mock.patch.object(profiling, 'save_profile') as save_profile:
+            with profiling.profiling_lock:
+                self.assertEqual(self.profiled_request().content, b'ok')
+            save_profile.assert_not_called()
+            self.profiled_request()
+            save_profile.assert_called_once()
+
+    def test_profiles_are_shared_through_the_directory(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        with override_settings(PROFILING_DIR=directory, PROFILING_RING_SIZE=2):
+            for _ in range(3):
+                self.profiled_request()
+            self.assertEqual(len(os.listdir(directory)), 2)
+            # what another worker would read
+            listed = profiling.recent_profiles()
+            self.assertEqual(len(listed), 2)
+            self.assertGreater(listed[0]['id'], listed[1]['id'])
+            self.assertEqual(profiling.find_profile(listed[0]['id'])['path'], listed[0]['path'])
+
+            self.client.force_login(self.staff)
+            self.assertContains(self.client.get(reverse('profile_list')), listed[1]['id'])
+            self.assertEqual(self.client.get(reverse('profile_detail', args=[listed[0]['id']])).status_code, 200)
+            self.assertEqual(self.client.get(reverse('profile_detail', args=['1-2-3'])).status_code, 404)
+
+
+class FacetIndexTests(TestCase):
+    def setUp(self):
+        author = Author.objects.create(name='Author')
+        for i in range(3):
+            Book.objects.create(title=f'Book {i}', author=author, total_copies=1)
+
+    def test_stale_index_is_rebuilt_in_the_background(self):
+        index = facets.FacetIndex()
+        index.ensure_fresh()
+        self.assertEqual(index.counts({})[0], 3)
+        with override_settings(FACET_INDEX_MAX_AGE=0), \
+                mock.patch.object(index, 'build') as build, \
+                mock.patch.object(index, 'rebuild_in_background') as rebuild:
+            self.assertEqual(index.counts({})[0], 3)
+            self.assertFalse(index.is_fresh())
+        build.assert_not_called()
+        rebuild.assert_called_once()
+
+    def test_paginator_counts_when_the_index_is_stale(self):
+        books = Book.objects.order_by('pk')
+        self.assertEqual(facets.KnownCountPaginator(books, 2, 7).num_pages, 4)
+        self.assertEqual(facets.KnownCountPaginator(books, 2, None).num_pages, 2)
+
+    def test_saves_during_the_first_build_are_replayed(self):
+        book = Book.objects.first()
+        index = facets.FacetIndex()
+        load = index.load
+
+        # the rows are read before the save and swapped in after it
+        def save_then_load():
+            rows = list(Book.objects.values_list('id', 'available_copies'))
+            book.available_copies = 0
+            book.save(update_fields=['available_copies'])
+            with mock.patch.object(Book.objects, 'order_by') as order_by:
+                order_by.return_value.values_list.return_value.iterator.return_value = [
+                    (book_id, None, '', book.author_id, None, None, available) for book_id, available in rows
+                ]
+                load()
+
+        with mock.patch('library.signals.facet_index', index), \
+                mock.patch.object(index, 'load', save_then_load):
+            index.ensure_fresh()
+        self.assertEqual(index.counts({'available': True})[0], 2)
+
+    def test_masks_follow_the_book_count_not_the_highest_id(self):
+        Book.objects.create(id=1_000_000, title='Far away', author=Author.objects.first())
+        index = facets.FacetIndex()
+        index.ensure_fresh()
+        self.assertEqual(index.all.bit_length(), 4)
+        self.assertEqual(index.counts({}, [1_000_000])[0], 1)
+
+    def test_selected_author_outside_the_top_ones_is_still_counted(self):
+        prolific = Author.objects.first()
+        for i in range(facets.TOP_AUTHORS):
+            Book.objects.create(title=f'More {i}', author=Author.objects.create(name=f'Author {i}'))
+            Book.objects.create(title=f'Again {i}', author=prolific)
+        rare = Author.objects.create(name='Rare')
+        Book.objects.create(title='Only one', author=rare)
+        Book.objects.create(title='Second', author=Author.objects.create(name='Another'))
+        index = facets.FacetIndex()
+        index.ensure_fresh()
+        self.assertNotIn(rare.id, index.counts({})[1]['author'])
+        total, counts = index.counts({'author': {rare.id}})
+        self.assertEqual(total, 1)
+        self.assertEqual(counts['author'][rare.id], 1)
+
+    def test_broad_search_is_counted_in_sql(self):
+        # response.context is only filled in by the django engine
+        with override_settings(CATALOG_SEARCH_FACET_LIMIT=2, CATALOG_TEMPLATE_ENGINE='django'):
+            response = self.client.get(reverse('book_list'), {'q': 'Book'})
+            self.assertTrue(response.context['broad_search'])
+            self.assertEqual(response.context['total'], 3)
+            response = self.client.get(reverse('book_list'), {'q': 'Book 1'})
+            self.assertFalse(response.context['broad_search'])
+            self.assertEqual(response.context['total'], 1)
+
+
+class EstimatedCountTests(TestCase):
+    def setUp(self):
+        self.logs = [VisitLog.objects.create(path=f'/{i}', method='GET', ip_address='10.0.0.1') for i in range(5)]
+
+    def test_small_tables_are_counted_exactly(self):
+        self.logs[-1].delete()
+        self.logs[-2].delete()
+        paginator = EstimatedCountPaginator(VisitLog.objects.order_by('-pk'), 2)
+        self.assertEqual(paginator.count, 3)
+        self.assertEqual(len(paginator.page(paginator.num_pages)), 1)
+
+    def test_statistics_are_used_past_the_limit(self):
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+        self.logs[0].delete()
+        with override_settings(ADMIN_EXACT_COUNT_LIMIT=1):
+            self.assertEqual(EstimatedCountPaginator(VisitLog.objects.all(), 2).count, 5)
+            self.assertEqual(EstimatedCountPaginator(VisitLog.objects.filter(method='GET'), 2).count, 4)
+        self.assertEqual(EstimatedCountPaginator(VisitLog.objects.all(), 2).count, 4)
+
+
+class ApiTests(TestCase):
+    def setUp(self):
+        self.author = Author.objects.create(name='Author')
+        other = Author.objects.create(name='Other')
+        self.books = [Book.objects.create(title=f'Book {i}', author=self.author) for i in range(5)]
+        self.books.append(Book.objects.create(title='Numbers', author=other, isbn='9780306406157'))
+        self.url = reverse('api_list', args=['books'])
+
+    def ids(self, response):
+        self.assertEqual(response.status_code, 200)
+        return [item['id'] for item in response.json()['results']]
+
+    def test_cursor_pages_cover_every_row_once(self):
+        seen = []
+        url = self.url + '?limit=2&fields=id,title'
+        while url:
+            response = self.client.get(url)
+            seen += self.ids(response)
+            self.assertEqual(set(response.json()['results'][0]), {'id', 'title'})
+            url = response.json()['next']
+        self.assertEqual(seen, [book.pk for book in self.books])
+
+    def test_bad_cursor(self):
+        for cursor in ('not-base64!', api.encode_cursor('abc')):
+            response = self.client.get(self.url, {'cursor': cursor})
+            self.assertEqual(response.status_code, 400)
+
+    def test_filters(self):
+        self.assertEqual(self.ids(self.client.get(self.url, {'author': self.author.pk})), [b.pk for b in self.books[:5]])
+        self.assertEqual(self.ids(self.client.get(self.url, {'author': 'x'})), [])
+        numbers = self.books[-1].pk
+        for isbn in ('9780306406157', '978-0-306-40615-7', '0-306-40615-2', '0306406152'):
+            self.assertEqual(self.ids(self.client.get(self.url, {'isbn': isbn})), [numbers], isbn)
+        self.assertEqual(self.ids(self.client.get(self.url, {'isbn': '0-306-40615-3'})), [])
+
+    def test_not_modified(self):
+        first = self.client.get(self.url)
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+
+class DeskScanTests(TestCase):
+    def setUp(self):
+        author = Author.objects.create(name='Author')
+        self.book = Book.objects.create(title='Shelved', author=author, total_copies=2)
+        self.other = Book.objects.create(title='By ISBN', author=author, total_copies=1, isbn='9780306406157')
+        self.first, self.second = Copy.objects.filter(book=self.book).order_by('pk')
+        self.member = User.objects.create(username='member', email='member@example.com')
+        self.client.force_login(User.objects.create(username='desk', is_staff=True, is_superuser=True))
+
+    def scan(self, codes, user='member', action='auto'):
+        return self.client.post(reverse('desk_scan'), {'user': user, 'codes': codes, 'action': action},
+                                content_type='application/json')
+
+    def outcomes(self, response):
+        self.assertEqual(response.status_code, 200)
+        return [result['outcome'] for result in response.json()['results']]
+
+    def test_mixed_batch_keeps_the_scan_order(self):
+        circulation.borrow(self.member, self.book, copy=self.first)
+        response = self.scan([self.first.barcode, self.second.barcode.lower(), '0-306-40615-2', 'nope'])
+        self.assertEqual(self.outcomes(response), ['returned', 'borrowed', 'borrowed', 'unknown_code'])
+        self.assertEqual([r['action'] for r in response.json()['results']], ['checkin', 'checkout', 'checkout', 'auto'])
+        self.assertEqual((response.json()['ok'], response.json()['failed']), (3, 1))
+        self.assertEqual(
+            set(BorrowRecord.objects.filter(is_returned=False).values_list('copy_id', flat=True)),
+            {self.second.pk, self.other.copies.get().pk},
+        )
+
+    def test_duplicate_scan_returns_once(self):
+        circulation.borrow(self.member, self.book, copy=self.first)
+        response = self.scan([self.first.barcode, self.first.barcode], user='')
+        self.assertEqual(self.outcomes(response), ['returned', 'already_returned'])
+        self.assertEqual(BranchStock.objects.get(book=self.book).available_copies, 2)
+
+    def test_explicit_actions(self):
+        circulation.borrow(self.member, self.book, copy=self.first)
+        User.objects.create(username='reader')
+        self.assertEqual(self.outcomes(self.scan([self.first.barcode], 'reader', 'checkout')), ['unavailable'])
+        self.assertEqual(self.outcomes(self.scan([self.second.barcode], action='checkin')), ['not_on_loan'])
+        self.assertEqual(self.outcomes(self.scan([self.second.barcode], user='')), ['no_member'])
+        self.assertEqual(self.outcomes(self.scan([self.second.barcode])), ['already_borrowing'])
+
+    def test_bad_requests(self):
+        self.assertEqual(self.scan(['x'] * 51).status_code, 400)
+        self.assertEqual(self.outcomes(self.scan(['x'] * 50)), ['unknown_code'] * 50)
+        self.assertEqual(self.scan([]).status_code, 400)
+        self.assertEqual(self.scan(['x'], action='lend').status_code, 400)
+        self.assertEqual(self.scan(['x'], user='nobody').status_code, 404)
+        self.client.force_login(self.member)
+        self.assertEqual(self.scan(['x']).status_code, 403)
+
+
+class EventReplayTests(TestCase):
+    def setUp(self):
+        self.author = Author.objects.create(name='Author')
+        self.reader = User.objects.create(username='reader')
+
+    # events are written as soon as their transaction commits, not by the writer thread
+    def logged(self):
+        stack = contextlib.ExitStack()
+        stack.enter_context(mock.patch.object(events.writer, 'add', side_effect=lambda event: event.save()))
+        stack.enter_context(self.captureOnCommitCallbacks(execute=True))
+        return stack
+
+    def stored(self, book):
+        return {
+            (book_id, branch_id): [total, available]
+            for book_id, branch_id, total, available in BranchStock.objects.filter(book=book).values_list(
+                'book_id', 'branch_id', 'total_copies', 'available_copies',
+            )
+        }
+
+    def test_replay_reproduces_branch_stock(self):
+        annex = Branch.objects.create(code='ANNEX', name='Annex')
+        with self.logged():
+            book = Book.objects.create(title='Logged', author=self.author, total_copies=3)
+            circulation.add_copies(book, annex, 2)
+        with self.logged():
+            first = circulation.borrow(self.reader, book)
+        with self.logged():
+            circulation.return_record(first)
+        with self.logged():
+            held = circulation.borrow(self.reader, book)
+        with self.logged():
+            circulation.withdraw_copy(book.copies.filter(branch=annex).first())
+        with self.logged():
+            circulation.delete_copies(Copy.objects.filter(pk=held.copy_id))
+        with self.logged():
+            circulation.return_record(held)
+
+        replayed = events.replay_stock([book.pk])
+        self.assertEqual(dict(replayed), self.stored(book))
+        self.assertEqual(sorted(map(tuple, replayed.values())), [(1, 1), (2, 2)])
+
+    def test_absolute_snapshot_resets_the_fold(self):
+        with self.logged():
+            book = Book.objects.create(title='Older than the log', author=self.author, total_copies=2)
+        # history from before the log existed
+        BranchStock.objects.filter(book=book).update(total_copies=5, available_copies=5)
+        Book.objects.filter(pk=book.pk).update(total_copies=5, available_copies=5)
+        call_command('replay_events', '--snapshot', '--book', str(book.pk), stdout=io.StringIO())
+        with self.logged():
+            circulation.borrow(self.reader, book)
+
+        self.assertEqual(list(events.replay_stock([book.pk]).values()), [[5, 4]])
+        out = io.StringIO()
+        call_command('replay_events', '--book', str(book.pk), stdout=out)
+        self.assertIn('0 counter(s) differ', out.getvalue())
+
+    def test_apply_rewrites_drifted_counters(self):
+        with self.logged():
+            book = Book.objects.create(title='Drifted', author=self.author, total_copies=2)
+        with self.logged():
+            circulation.borrow(self.reader, book)
+        expected = self.stored(book)
+        BranchStock.objects.filter(book=book).update(available_copies=0)
+
+        with self.logged():
+            call_command('replay_events', '--apply', '--book', str(book.pk), stdout=io.StringIO())
+        self.assertEqual(self.stored(book), expected)
+        book.refresh_from_db()
+        self.assertEqual((book.total_copies, book.available_copies), (2, 1))
+
+
+class ReadingActivityTests(TestCase):
+    def counters(self, user):
+        reading = ReadingActivity.objects.filter(user=user).order_by('month').values_list(
+            'month', *activity.COUNTERS,
+        )
+        categories = CategoryActivity.objects.filter(user=user).order_by('category_id').values_list(
+            'category_id', 'borrowed',
+        )
+        return list(reading), list(categories)
+
+    def test_incremental_counters_match_a_rebuild(self):
+        author = Author.objects.create(name='Author')
+        category = Category.objects.create(name='Poetry')
+        novel = Book.objects.create(title='Novel', author=author, total_copies=1)
+        poems = Book.objects.create(title='Poems', author=author, category=category, total_copies=1)
+        reader = User.objects.create(username='reader')
+
+        late = circulation.borrow(reader, novel)
+        circulation.borrow(reader, poems)
+        BorrowRecord.objects.filter(pk=late.pk).update(due_date=F('due_date') - timedelta(days=30))
+        circulation.return_record(late)
+        review = Review.objects.create(user=reader, book=novel, rating=2)
+        review.rating = 5
+        review.save()
+        Review.objects.create(user=reader, book=poems, rating=4).delete()
+
+        incremental = self.counters(reader)
+        month = activity.month_of(timezone.now())
+        self.assertEqual(incremental, ([(month, 2, 1, 1, 1, 5)], [(category.pk, 1)]))
+        activity.rebuild([reader.pk])
+        self.assertEqual(self.counters(reader), incremental)
+
+
+class RecommendationTests(TestCase):
+    def setUp(self):
+        author = Author.objects.create(name='Author')
+        self.a, self.b, self.c = (Book.objects.create(title=t, author=author, total_copies=2) for t in 'abc')
+        for name, books in (('one', (self.a, self.b)), ('two', (self.a, self.c))):
+            user = User.objects.create(username=name)
+            for book in books:
+                circulation.borrow(user, book)
+        # borrow dates are days, so the history has to be older than the build
+        BorrowRecord.objects.update(borrow_date=F('borrow_date') - timedelta(days=1))
+
+    def scores(self, book):
+        return dict(RelatedBook.objects.filter(book=book).values_list('related_id', 'score'))
+
+    def build(self):
+        call_command('build_recommendations', stdout=io.StringIO())
+
+    def test_scores_after_a_borrow(self):
+        self.build()
+        self.assertAlmostEqual(self.scores(self.a)[self.b.pk], 1 / 2 ** 0.5)
+
+        reader = User.objects.create(username='three')
+        circulation.borrow(reader, self.b)
+        circulation.borrow(reader, self.c)
+        self.build()
+        # b and c were borrowed by the new reader, a only through b's popularity
+        self.assertEqual(self.scores(self.b), {self.a.pk: 0.5, self.c.pk: 0.5})
+        self.assertEqual(self.scores(self.c), {self.a.pk: 0.5, self.b.pk: 0.5})
+        self.assertAlmostEqual(self.scores(self.a)[self.b.pk], 1 / 2 ** 0.5)
+
+        # once the untouched rows are older than the bound the next run is a full one
+        RelatedBook.objects.filter(book=self.a).update(
+            computed_at=RelatedBook.objects.get(book=self.a, related=self.b).computed_at
+            - timedelta(days=recommendations.FULL_REBUILD_DAYS + 1),
+        )
+        self.build()
+        self.assertEqual(self.scores(self.a), {self.b.pk: 0.5, self.c.pk: 0.5})
+
+    def test_bulk_return_drops_the_cached_for_you_list(self):
+        user = User.objects.get(username='one')
+        key = recommendations.for_you_cache_key(user.pk)
+        recommendations.for_you_books(user.pk)
+        self.assertIsNotNone(cache.get(key))
+        with mock.patch.object(events.writer, 'add'), self.captureOnCommitCallbacks(execute=True):
+            circulation.return_records(BorrowRecord.objects.filter(user=user))
+            self.assertIsNotNone(cache.get(key))
+        self.assertIsNone(cache.get(key))
+        self.assertEqual(recommendations.for_you_timeout(), recommendations.FOR_YOU_LOCAL_TIMEOUT)
+
+
+# the jinja2/ template directory also looks like a namespace package called jinja2
+@skipUnless(find_spec('jinja2.ext'), 'jinja2 is not installed')
+class CatalogTemplateTests(TestCase):
+    def setUp(self):
+        author = Author.objects.create(name='Author')
+        category = Category.objects.create(name='Poetry')
+        for i in range(3):
+            Book.objects.create(title=f'Collected Poems Volume {i}', author=author, category=category, total_copies=1)
+        self.category = category
+        self.client.force_login(User.objects.create(username='reader', first_name='Rana'))
+
+    def render(self, engine, url):
+        with override_settings(CATALOG_TEMPLATE_ENGINE=engine,
+                               TEMPLATES=settings.TEMPLATES[:1] + [settings.JINJA2_TEMPLATES]):
+            html = self.client.get(url).content.decode()
+        return [line.strip() for line in html.splitlines() if line.strip()]
+
+    # the jinja ports share base.html and the card partials with the django pages
+    def test_both_engines_render_the_same_page(self):
+        for url in (reverse('home'), reverse('category_books', args=[self.category.pk])):
+            self.assertEqual(self.render('jinja2', url), self.render('django', url), url)
+
+
+class SearchIndexTests(TestCase):
+    def test_stale_index_answers_while_it_rebuilds(self):
+        Book.objects.create(title='The Art of War', author=Author.objects.create(name='Sun Tzu'))
+        index = search_index.PrefixIndex()
+        self.assertEqual([label for _, _, label in index.search('art of')], ['The Art of War'])
+        with override_settings(SEARCH_INDEX_MAX_AGE=0), \
+                mock.patch.object(index, 'load') as load, \
+                mock.patch.object(index, 'rebuild_in_background') as rebuild:
+            self.assertEqual(len(index.search('sun')), 1)
+        load.assert_not_called()
+        rebuild.assert_called_once()
+
+    def test_changes_during_a_build_are_replayed(self):
+        author = Author.objects.create(name='Author')
+        book = Book.objects.create(title='Old Title', author=author)
+        gone = Book.objects.create(title='Gone Soon', author=author)
+        index = search_index.PrefixIndex()
+        index_keys = search_index.index_keys
+        changed = []
+
+        # the build has read the old rows when these changes come in
+        def keys_then_change(label):
+            if not changed:
+                changed.append(True)
+                Book.objects.filter(pk=book.pk).update(title='New Title')
+                index.update('book', book.pk, 'New Title')
+                Book.objects.filter(pk=gone.pk).delete()
+                index.remove('book', gone.pk)
+            return index_keys(label)
+
+        with mock.patch.object(search_index, 'index_keys', keys_then_change):
+            index.build()
+        self.assertIsNone(index.touched)
+        self.assertEqual([label for _, _, label in index.search('new')], ['New Title'])
+        self.assertEqual(index.search('old'), [])
+        self.assertEqual(index.search('gone'), [])
+
+    def test_saves_during_the_first_build_are_replayed(self):
+        book = Book.objects.create(title='Old Title', author=Author.objects.create(name='Author'))
+        index = search_index.PrefixIndex()
+        index_keys = search_index.index_keys
+        changed = []
+
+        def keys_then_save(label):
+            if not changed:
+                changed.append(True)
+                book.title = 'New Title'
+                book.save()
+            return index_keys(label)
+
+        with mock.patch('library.signals.search_index', index), \
+                mock.patch.object(search_index, 'index_keys', keys_then_save):
+            index.ensure_fresh()
+        self.assertEqual([label for _, _, label in index.search('new')], ['New Title'])
+        self.assertEqual(index.search('old'), [])
+
+
+@override_settings(SESSION_ENGINE='library.sessions')
+class WriteBehindSessionTests(TestCase):
+    def test_refused_with_a_per_process_cache(self):
+        self.assertEqual([error.id for error in sessions.check_session_cache(None)], ['library.E001'])
+        with self.assertRaises(ImproperlyConfigured):
+            sessions.SessionStore()
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+                                           'LOCATION': tempfile.gettempdir()}})
+    def test_allowed_with_a_shared_cache(self):
+        self.assertEqual(sessions.check_session_cache(None), [])
+        sessions.SessionStore()
+
+
+class MediaTests(TestCase):
+    def setUp(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        with open(os.path.join(root, 'cover.jpg'), 'wb') as f:
+            f.write(bytes(range(100)))
+        settings = override_settings(MEDIA_ROOT=root, MEDIA_SENDFILE=None)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.url = reverse('media', args=['cover.jpg'])
+
+    def test_parse_range(self):
+        self.assertEqual(media.parse_range('bytes=0-9', 100), (0, 9))
+        self.assertEqual(media.parse_range('bytes=90-', 100), (90, 99))
+        self.assertEqual(media.parse_range('bytes=-10', 100), (90, 99))
+        self.assertEqual(media.parse_range('bytes=50-500', 100), (50, 99))
+        self.assertEqual(media.parse_range('bytes=-500', 100), (0, 99))
+        self.assertFalse(media.parse_range('bytes=100-', 100))
+        self.assertFalse(media.parse_range('bytes=-0', 100))
+        for header in ('bytes=9-0', 'bytes=-', 'bytes=0-1,5-6', 'items=0-9'):
+            self.assertIsNone(media.parse_range(header, 100), header)
+
+    def test_partial_content(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=10-19')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 10-19/100')
+        self.assertEqual(b''.join(response.streaming_content), bytes(range(10, 20)))
+
+    def test_range_past_the_end(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=100-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */100')
+
+    def test_stale_if_range_gets_the_whole_file(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=10-19', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), bytes(range(100)))
+
+    def test_not_modified(self):
+        full = self.client.get(self.url)
+        full.close()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=full['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], full['ETag'])
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH='"other"')
+        response.close()
+        self.assertEqual(response.status_code, 200)
+
+
+class UploadStorageTests(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        settings = override_settings(MEDIA_ROOT=self.root)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def test_upload_racing_the_same_file_gets_the_blob_name(self):
+        storage = uploads.DedupFileSystemStorage(location=self.root)
+        first = storage.save('books/a.jpg', ContentFile(b'cover bytes'))
+        exists = storage.exists
+        calls = []
+
+        # the other upload lands after this one checked
+        def exists_once_missing(name):
+            calls.append(name)
+            return len(calls) > 1 and exists(name)
+
+        with mock.patch.object(storage, 'exists', exists_once_missing):
+            second = storage.save('books/b.jpg', ContentFile(b'cover bytes'))
+        self.assertEqual(second, first)
+        self.assertRegex(second, media.BLOB_RE)
+        self.assertEqual(os.listdir(os.path.dirname(storage.path(first))), [os.path.basename(first)])
+
+    def test_reclaim_only_touches_upload_directories(self):
+        for name in ('books/orphan.jpg', 'blobs/ab/orphan.jpg', 'backups/db.sqlite3', 'notes.txt'):
+            path = os.path.join(self.root, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(b'data')
+        call_command('media_storage', '--reclaim', '--min-age', '0', stdout=io.StringIO())
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'books/orphan.jpg')))
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'blobs/ab/orphan.jpg')))
+        self.assertTrue(os.path.exists(os.path.join(self.root, 'backups/db.sqlite3')))
+        self.assertTrue(os.path.exists(os.path.join(self.root, 'notes.txt')))
+
+
+def png_header(width, height):
+    return b'\x89PNG\r\n\x1a\n' + struct.pack('>I4sII', 13, b'IHDR', width, height) + b'\x08\x02\x00\x00\x00'
+
+
+def jpeg_header(width, height):
+    app0 = b'\xff\xe0' + struct.pack('>H', 16) + b'JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00'
+    sof0 = b'\xff\xc0' + struct.pack('>HBHHB', 11, 8, height, width, 1) + b'\x01\x11\x00'
+    return b'\xff\xd8' + app0 + sof0 + b'\xff\xd9'
+
+
+class ImageUploadTests(TestCase):
+    def test_sniff_image(self):
+        webp = b'RIFF' + struct.pack('<I', 30) + b'WEBPVP8X' + struct.pack('<I', 10) + b'\x00' * 4 + \
+            (639).to_bytes(3, 'little') + (479).to_bytes(3, 'little')
+        cases = [
+            (png_header(640, 480), ('.png', (640, 480))),
+            (b'GIF89a' + struct.pack('<HH', 640, 480) + b'\x00' * 20, ('.gif', (640, 480))),
+            (jpeg_header(640, 480), ('.jpg', (640, 480))),
+            (webp, ('.webp', (640, 480))),
+            (b'%PDF-1.7' + b'\x00' * 40, (None, None)),
+            # a known type with a damaged header
+            (b'\x89PNG\r\n\x1a\n', ('.png', None)),
+        ]
+        for data, expected in cases:
+            f = io.BytesIO(data)
+            f.seek(3)
+            self.assertEqual(uploads.sniff_image(f), expected)
+            # the caller's position is kept
+            self.assertEqual(f.tell(), 3)
+
+    def test_validate_image(self):
+        uploads.validate_image(SimpleUploadedFile('cover.jpg', jpeg_header(640, 480)))
+        cases = [
+            (b'<?php echo 1; ?>' * 4, 'invalid_image'),
+            (b'\xff\xd8\xff\xe0\x00', 'invalid_image'),
+            (png_header(0, 480), 'invalid_image'),
+            (png_header(100000, 100000), 'image_too_large'),
+        ]
+        for data, code in cases:
+            with self.assertRaises(ValidationError) as raised:
+                uploads.validate_image(SimpleUploadedFile('cover.png', data))
+            self.assertEqual(raised.exception.code, code)
+
+    @override_settings(MEDIA_UPLOAD_MAX_SIZE=32)
+    def test_validate_image_size_cap(self):
+        with self.assertRaises(ValidationError) as raised:
+            uploads.validate_image(SimpleUploadedFile('cover.jpg', jpeg_header(640, 480)))
+        self.assertEqual(raised.exception.code, 'file_too_large')
+
+
+@override_settings(PASSWORD_PBKDF2_ITERATIONS=1000, LOGIN_FAILURE_LIMIT_ACCOUNT=3, LOGIN_FAILURE_LIMIT_IP=5)
+class LoginThrottleTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        User.objects.create_user('reader', 'Reader@example.com', 'right password')
+
+    def login(self, username='reader', password='right password', ip='10.0.0.1', **headers):
+        self.client.post(reverse('login'), {'username': username, 'password': password}, REMOTE_ADDR=ip, **headers)
+        logged_in = '_auth_user_id' in self.client.session
+        self.client.logout()
+        return logged_in
+
+    def test_account_is_locked_after_failures(self):
+        for _ in range(3):
+            self.assertFalse(self.login(password='wrong'))
+        # even the right password is not checked now, from any address
+        with mock.patch.object(User, 'check_password') as check_password:
+            self.assertFalse(self.login(ip='10.0.0.2'))
+        check_password.assert_not_called()
+
+    def test_address_is_locked_across_accounts(self):
+        for i in range(5):
+            self.assertFalse(self.login(username=f'guess{i}', password='wrong'))
+        self.assertFalse(self.login())
+        self.assertTrue(self.login(ip='10.0.0.2'))
+
+    @override_settings(TRUSTED_PROXIES=['127.0.0.1'])
+    def test_clients_behind_the_proxy_are_told_apart(self):
+        for i in range(5):
+            self.login(username=f'guess{i}', password='wrong', ip='127.0.0.1', HTTP_X_FORWARDED_FOR='203.0.113.9')
+        self.assertFalse(self.login(ip='127.0.0.1', HTTP_X_FORWARDED_FOR='203.0.113.9'))
+        # a spoofed address on the left doesnt get the attacker a fresh bucket
+        self.assertFalse(self.login(ip='127.0.0.1', HTTP_X_FORWARDED_FOR='198.51.100.1, 203.0.113.9'))
+        self.assertTrue(self.login(ip='127.0.0.1', HTTP_X_FORWARDED_FOR='198.51.100.7'))
+
+    def test_failed_login_looks_the_account_up_once(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.login(password='wrong')
+        self.assertEqual(sum('FROM "auth_user"' in query['sql'] for query in queries), 1)
+
+    def test_username_and_email_share_a_counter(self):
+        self.assertFalse(self.login(password='wrong'))
+        self.assertFalse(self.login(username='READER@example.com', password='wrong'))
+        self.assertFalse(self.login(username='reader@example.com', password='wrong'))
+        self.assertFalse(self.login())
+
+    def test_success_clears_the_account_failures(self):
+        for _ in range(2):
+            self.login(password='wrong')
+        self.assertTrue(self.login(username='reader@example.com'))
+        for _ in range(2):
+            self.login(password='wrong')
+        self.assertTrue(self.login())
+
+
+class ProvisionUsersTests(TestCase):
+    def roster(self, *rows):
+        path = os.path.join(tempfile.mkdtemp(), 'roster.csv')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write('username,email,full_name\n' + ''.join(f'{row}\n' for row in rows))
+        return path
+
+    def test_names_taken_in_another_case_are_skipped(self):
+        User.objects.create(username='Ali', email='ali@example.com')
+        path = self.roster('ali,new@example.com,Ali One', 'omar,ALI@EXAMPLE.COM,Omar Two', 'sara,sara@example.com,Sara')
+        call_command('provision_users', path, stdout=io.StringIO())
+        self.assertEqual(sorted(User.objects.values_list('username', flat=True)), ['Ali', 'sara'])
+
+    def test_a_racing_duplicate_only_skips_its_row(self):
+        path = self.roster('sara,sara@example.com,Sara', 'omar,omar@example.com,Omar')
+        User.objects.create(username='Omar', email='other@example.com')
+        annotate = User.objects.annotate
+
+        # the clash lookup runs before "Omar" signs up, the insert after
+        def lookup_before_signup(*args, **kwargs):
+            return annotate(*args, **kwargs).exclude(username='Omar')
+
+        errors = io.StringIO()
+        with mock.patch.object(User.objects, 'annotate', lookup_before_signup):
+            call_command('provision_users', path, stdout=io.StringIO(), stderr=errors)
+        self.assertIn('Skipped omar', errors.getvalue())
+        self.assertTrue(User.objects.filter(username='sara', profile__isnull=False).exists())
+        self.assertEqual(User.objects.filter(username__iexact='omar').count(), 1)
+
+
+class ExportTests(TestCase):
+    def setUp(self):
+        VisitLog.objects.create(path='/a\x01b\x0c', method='GET', ip_address='10.0.0.1')
+        VisitLog.objects.create(path='=HYPERLINK("http://evil")', method='GET', ip_address='10.0.0.1')
+
+    def test_xlsx_stays_well_formed_with_control_characters(self):
+        data = b''.join(exports.export_chunks('visits', VisitLog.objects.all(), 'xlsx'))
+        with zipfile.ZipFile(io.BytesIO(data)) as archive:
+            sheet = minidom.parseString(archive.read('xl/worksheets/sheet1.xml'))
+        texts = [node.firstChild.data for node in sheet.getElementsByTagName('t') if node.firstChild]
+        self.assertIn('/a\ufffdb\ufffd', texts)
+
+    def test_csv_cells_cannot_start_a_formula(self):
+        text = ''.join(exports.export_chunks('visits', VisitLog.objects.all(), 'csv'))
+        rows = list(csv.reader(io.StringIO(text)))
+        self.assertEqual(rows[2][3], "'=HYPERLINK(\"http://evil\")")
+        self.assertEqual(exports.csv_cell('-1'), "'-1")
+        self.assertEqual(exports.csv_cell(-1), -1)
@@ -0,0 +1,193 @@
+import hashlib
+import os
+import struct
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.core.files.uploadhandler import FileUploadHandler, SkipFile
+from django.template.defaultfilters import filesizeformat
+
+
+# every upload field in the app, used to tell which stored files are still referenced
+def file_fields():
+    from .models import Author, Book, Category, UserProfile
+    return [
+        (Book, 'cover'),
+        (Author, 'photo'),
+        (Category, 'image'),
+        (UserProfile, 'profile_picture'),
+    ]
+
+
+# directories the app writes uploads to, anything else under MEDIA_ROOT isnt ours
+def upload_prefixes():
+    prefixes = {'blobs/'}
+    for model, field in file_fields():
+        upload_to = model._meta.get_field(field).upload_to
+        if isinstance(upload_to, str) and upload_to:
+            prefixes.add(upload_to.rstrip('/') + '/')
+    return tuple(sorted(prefixes))
+
+
+def is_referenced(name):
+    return any(model.objects.filter(**{field: name}).exists() for model, field in file_fields())
+
+
+# first in FILE_UPLOAD_HANDLERS. counts bytes as they arrive and drops a file
+# as soon as it goes over MEDIA_UPLOAD_MAX_SIZE, instead of after it is on disk
+class LimitedUploadHandler(FileUploadHandler):
+    def new_file(self, field_name, *args, **kwargs):
+        super().new_file(field_name, *args, **kwargs)
+        self.received = 0
+
+    def receive_data_chunk(self, raw_data, start):
+        self.received += len(raw_data)
+        if self.received > settings.MEDIA_UPLOAD_MAX_SIZE:
+            rejected = getattr(self.request, 'rejected_uploads', None)
+            if rejected is None:
+                rejected = self.request.rejected_uploads = set()
+            rejected.add(self.field_name)
+            raise SkipFile()
+        return raw_data
+
+    def file_complete(self, file_size):
+        return None
+
+
+def too_large_message():
+    return f'Files can be at most {filesizeformat(settings.MEDIA_UPLOAD_MAX_SIZE)}.'
+
+
+# the handler can only skip a file, this turns that into a form error
+def reject_oversized(request, form):
+    for field in getattr(request, 'rejected_uploads', ()):
+        if field in form.fields:
+            form.add_error(field, too_large_message())
+
+
+def _png(head, f):
+    if head[12:16] != b'IHDR':
+        return None
+    return struct.unpack('>II', head[16:24])
+
+
+def _gif(head, f):
+    return struct.unpack('<HH', head[6:10])
+
+
+def _webp(head, f):
+    chunk = head[12:16]
+    if chunk == b'VP8X':
+        return (int.from_bytes(head[24:27], 'little') + 1, int.from_bytes(head[27:30], 'little') + 1)
+    if chunk == b'VP8L' and head[20] == 0x2F:
+        bits = int.from_bytes(head[21:25], 'little')
+        return ((bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1)
+    if chunk == b'VP8 ' and head[23:26] == b'\x9d\x01\x2a':
+        width, height = struct.unpack('<HH', head[26:30])
+        return (width & 0x3FFF, height & 0x3FFF)
+    return None
+
+
+# walks the segment headers to the first frame header, the pixel data is never read
+def _jpeg(head, f):
+    f.seek(2)
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return None
+        kind = marker[1]
+        if kind == 0xFF:
+            f.seek(-1, os.SEEK_CUR)
+            continue
+        if kind in (0xD8, 0x01) or 0xD0 <= kind <= 0xD7:
+            continue
+        length = f.read(2)
+        if len(length) < 2:
+            return None
+        size = struct.unpack('>H', length)[0]
+        if 0xC0 <= kind <= 0xCF and kind not in (0xC4, 0xC8, 0xCC):
+            frame = f.read(5)
+            if len(frame) < 5:
+                return None
+            height, width = struct.unpack('>HH', frame[1:5])
+            return (width, height)
+        f.seek(size - 2, os.SEEK_CUR)
+
+
+# magic bytes -> (extension, reader for width and height)
+IMAGE_TYPES = [
+    (b'\x89PNG\r\n\x1a\n', '.png', _png),
+    (b'GIF87a', '.gif', _gif),
+    (b'GIF89a', '.gif', _gif),
+    (b'\xff\xd8\xff', '.jpg', _jpeg),
+]
+
+
+def sniff_image(f):
+    position = f.tell() if hasattr(f, 'tell') else 0
+    try:
+        f.seek(0)
+        head = f.read(32)
+        if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+            return '.webp', _webp(head, f)
+        for magic, extension, reader in IMAGE_TYPES:
+            if head.startswith(magic):
+                return extension, reader(head, f)
+        return None, None
+    except (struct.error, IndexError):
+        return None, None
+    finally:
+        f.seek(position)
+
+
+# checks the header only: a real image type, sane dimensions and the size cap.
+# files that are already stored were checked when they came in
+def validate_image(value):
+    if getattr(value, '_committed', False):
+        return
+    if value.size > settings.MEDIA_UPLOAD_MAX_SIZE:
+        raise ValidationError(too_large_message(), code='file_too_large')
+
+    extension, dimensions = sniff_image(value)
+    if extension is None:
+        raise ValidationError('Upload a JPEG, PNG, GIF or WebP image.', code='invalid_image')
+    if dimensions is None or 0 in dimensions:
+        raise ValidationError('The image header is damaged.', code='invalid_image')
+    width, height = dimensions
+    if width * height > settings.MEDIA_IMAGE_MAX_PIXELS:
+        raise ValidationError(f'The image is too large ({width}x{height}).', code='image_too_large')
+
+
+def content_hash(content):
+    digest = hashlib.sha256()
+    content.seek(0)
+    for chunk in content.chunks():
+        digest.update(chunk)
+    content.seek(0)
+    return digest.hexdigest()
+
+
+def blob_name(digest, name):
+    extension = os.path.splitext(name)[1].lower()
+    return f'blobs/{digest[:2]}/{digest}{extension}'
+
+
+# files are stored under their sha256, so a cover uploaded twice is kept once.
+# a temporary upload is moved into place rather than copied
+class DedupFileSystemStorage(FileSystemStorage):
+    def save(self, name, content, max_length=None):
+        if content is not None and not hasattr(content, 'chunks'):
+            content = File(content, name)
+        if content is not None:
+            name = blob_name(content_hash(content), name)
+            if self.exists(name):
+                return name
+        stored = super().save(name, content, max_length)
+        # another upload of the same file got there between the check and the
+        # save, django gave this one a suffixed name. the blob has the same bytes
+        if content is not None and stored != name:
+            self.delete(stored)
+            return name
+        return stored
@@ -1,5 +1,5 @@
 from django.urls import path
-from . import views
+from . import api, desk, views
 
 
 urlpatterns = [
@@ -10,6 +10,8 @@ urlpatterns = [
 
     path('books/', views.book_list, name='book_list'),
 
+    path('books/autocomplete/', views.autocomplete, name='autocomplete'),
+
     path('book/<int:id>/', views.book_detail, name='book_detail'),
 
     # categories
@@ -47,7 +49,19 @@ urlpatterns = [
 
     path('my-books/', views.my_books, name='my_books'),
 
+    # circulation desk scanner
+
+    path('desk/scan/', desk.desk_scan, name='desk_scan'),
+
     # reviews
 
     path('book/<int:id>/review/', views.add_review, name='add_review'),
+
+    # read only json api
+
+    path('api/v1/<str:resource_name>/', api.resource_list, name='api_list'),
+
+    path('api/v1/<str:resource_name>/export.ndjson', api.resource_export, name='api_export'),
+
+    path('api/v1/<str:resource_name>/<int:id>/', api.resource_detail, name='api_detail'),
 ]
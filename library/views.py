@@ -2,14 +2,28 @@ from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
+from django.conf import settings
 from django.contrib import messages
-from django.core.paginator import Paginator
+from django.http import JsonResponse
+from django.urls import reverse
+from django.db import IntegrityError, transaction
 from django.db.models import Avg, Q
-from django.utils import timezone
-from datetime import timedelta
 
-from .models import Book, Author, Category, BorrowRecord, Review, UserProfile
+from .models import Book, Author, Category, BorrowRecord, Branch, Review, UserProfile, RelatedBook
 from .forms import RegistrationForm, LoginForm, ContactForm, ReviewForm, ProfileEditForm
+from . import activity, circulation, contact, facets
+from .accounts import RegistrationError, register_user
+from .auth import find_account, login_throttle_keys, login_throttled, record_login_failure, reset_login_failures
+from .facets import index as facet_index
+from .metrics import borrow_outcomes
+from .recommendations import for_you_books
+from .search_index import index as search_index
+from .uploads import reject_oversized
+
+
+# the card heavy pages can run on jinja2, see CATALOG_TEMPLATE_ENGINE
+def render_catalog(request, template_name, context):
+    return render(request, template_name, context, using=settings.CATALOG_TEMPLATE_ENGINE)
 
 
 def home(request):
@@ -26,32 +40,43 @@ def home(request):
         'student_count': User.objects.filter(is_staff=False).count(),
     }
 
-    return render(request, 'home.html', {
+    # personal picks only for logged in users, anonymous pages stay the same for everyone
+    for_you = []
+    if request.user.is_authenticated:
+        for_you = for_you_books(request.user.id)
+
+    return render_catalog(request, 'home.html', {
         'recent_books': recent_books,
         'top_books': top_books,
+        'for_you': for_you,
         'stats': stats,
     })
 
 
 def book_list(request):
-    books = Book.objects.all()
+    books = Book.objects.select_related('author', 'category')
 
     # search by title or author name
     query = request.GET.get('q', '')
+    search_ids = None
+    broad_search = False
     if query:
         books = books.filter(
             Q(title__icontains=query) | Q(author__name__icontains=query)
         )
-
-    # filter by category from dropdown — guard against non-numeric values like 'None'
-    category_id = request.GET.get('category', '')
-    selected_category = None
-    if category_id:
-        try:
-            selected_category = int(category_id)
-            books = books.filter(category_id=selected_category)
-        except (ValueError, TypeError):
-            selected_category = None
+        # the facet counts are narrowed to the matches while there arent too many
+        # of them. a broader search is counted and paged in sql, the sidebar then
+        # counts the whole catalog
+        limit = getattr(settings, 'CATALOG_SEARCH_FACET_LIMIT', 2000)
+        search_ids = list(books.values_list('id', flat=True)[:limit + 1])
+        if len(search_ids) > limit:
+            search_ids = None
+            broad_search = True
+
+    # facet selections from the sidebar, counts come from the in-memory facet index
+    filters = facets.parse_filters(request.GET)
+    books = facets.apply_filters(books, filters)
+    total, counts = facet_index.counts(filters, search_ids)
 
     # sort options from the sort dropdown
     sort = request.GET.get('sort', 'newest')
@@ -62,21 +87,92 @@ def book_list(request):
     else:
         books = books.order_by('-created_at')
 
-    paginator = Paginator(books, 9)
+    # a stale index may be behind writes made in other workers
+    known = facet_index.is_fresh() and not broad_search
+    paginator = facets.KnownCountPaginator(books, 9, total if known else None)
     page_num = request.GET.get('page', 1)
     page = paginator.get_page(page_num)
-
-    categories = Category.objects.all()
-
-    return render(request, 'book_list.html', {
+    # one query on the branch counters for the whole page
+    stock = circulation.branch_availability([book.id for book in page])
+    for book in page:
+        book.branch_stock = stock.get(book.id, [])
+
+    selected_categories = filters.get('category', set())
+    categories = [
+        {'id': cat.id, 'name': cat.name, 'count': counts['category'].get(cat.id, 0),
+         'selected': cat.id in selected_categories}
+        for cat in Category.objects.all()
+    ]
+    selected_authors = filters.get('author', set())
+    top_authors = Author.objects.in_bulk(list(counts['author']))
+    authors = [
+        {'id': author_id, 'name': top_authors[author_id].name, 'count': count,
+         'selected': author_id in selected_authors}
+        for author_id, count in sorted(counts['author'].items(), key=lambda item: -item[1])
+        if author_id in top_authors
+    ]
+    selected_languages = filters.get('language', set())
+    languages = [
+        {'value': language, 'count': count, 'selected': language in selected_languages}
+        for language, count in sorted(counts['language'].items()) if count or language in selected_languages
+    ]
+    selected_pages = filters.get('pages', set())
+    page_ranges = [
+        {'value': position, 'label': label, 'count': counts['pages'].get(position, 0),
+         'selected': position in selected_pages}
+        for position, (_, _, label) in enumerate(facets.PAGE_BUCKETS)
+    ]
+    decades = [
+        {'decade': decade, 'end': decade + 9, 'count': count}
+        for decade, count in sorted(counts['decade'].items(), reverse=True) if count
+    ]
+    ratings = [
+        {'value': stars, 'count': counts['rating'].get(stars, 0)}
+        for stars in (4, 3, 2, 1)
+    ]
+    year_from, year_to = filters.get('year', (None, None))
+
+    # keep every filter when moving between pages
+    params = request.GET.copy()
+    params.pop('page', None)
+
+    return render_catalog(request, 'book_list.html', {
         'page': page,
+        'total': paginator.count,
+        'broad_search': broad_search,
         'categories': categories,
+        'authors': authors,
+        'languages': languages,
+        'page_ranges': page_ranges,
+        'decades': decades,
+        'ratings': ratings,
+        'available_count': counts['available'].get(True, 0),
+        'only_available': filters.get('available', False),
+        'selected_rating': filters.get('rating'),
+        'year_from': year_from,
+        'year_to': year_to,
         'query': query,
-        'selected_category': selected_category,
         'selected_sort': sort,
+        'querystring': params.urlencode(),
     })
 
 
+# type-ahead for the search box, served from the in-memory prefix index
+AUTOCOMPLETE_URLS = {
+    'book': 'book_detail',
+    'author': 'author_detail',
+    'category': 'category_books',
+}
+
+
+def autocomplete(request):
+    results = [
+        {'type': kind, 'id': pk, 'label': label, 'url': reverse(AUTOCOMPLETE_URLS[kind], args=[pk])}
+        for kind, pk, label in search_index.search(request.GET.get('q', '')[:100])
+    ]
+    return JsonResponse({'results': results})
+
+
 def book_detail(request, id):
     book = get_object_or_404(Book, id=id)
     reviews = book.reviews.all()
@@ -98,9 +194,17 @@ def book_detail(request, id):
             user=request.user, book=book
         ).exists()
 
+    # neighbours are precomputed by build_recommendations, this is one index lookup
+    related_books = [
+        entry.related for entry in
+        RelatedBook.objects.filter(book=book).select_related('related')[:6]
+    ]
+
     return render(request, 'book_detail.html', {
         'book': book,
+        'branch_stock': circulation.branch_availability([book.id]).get(book.id, []),
         'reviews': reviews,
+        'related_books': related_books,
         'user_has_borrowed': user_has_borrowed,
         'user_currently_borrowing': user_currently_borrowing,
         'user_has_reviewed': user_has_reviewed,
@@ -115,7 +219,7 @@ def category_list(request):
 def category_books(request, id):
     category = get_object_or_404(Category, id=id)
     books = Book.objects.filter(category=category)
-    return render(request, 'category_books.html', {
+    return render_catalog(request, 'category_books.html', {
         'category': category,
         'books': books,
     })
@@ -139,7 +243,13 @@ def contact_us(request):
     if request.method == 'POST':
         form = ContactForm(request.POST)
         if form.is_valid():
-            form.save()
+            outcome = contact.intake(request, form)
+            if outcome == contact.THROTTLED:
+                messages.error(request, 'You have sent too many messages. Please try again later.')
+                return render(request, 'contact.html', {'form': form}, status=429)
+            if outcome == contact.UNAVAILABLE:
+                messages.error(request, 'Your message could not be sent right now. Please try again later.')
+                return render(request, 'contact.html', {'form': form}, status=503)
             messages.success(request, 'Your message has been sent. Thank you!')
             return redirect('contact')
     else:
@@ -156,25 +266,19 @@ def register_view(request):
     if request.method == 'POST':
         form = RegistrationForm(request.POST)
         if form.is_valid():
-            user = User.objects.create_user(
-                username=form.cleaned_data['username'],
-                email=form.cleaned_data['email'],
-                password=form.cleaned_data['password'],
-            )
-            # split the full name into first and last
-            names = form.cleaned_data['full_name'].split(' ', 1)
-            user.first_name = names[0]
-            if len(names) > 1:
-                user.last_name = names[1]
-            user.save()
-
-            UserProfile.objects.create(
-                user=user,
-                phone=form.cleaned_data.get('phone', ''),
-            )
-
-            messages.success(request, 'Account created. You can now log in.')
-            return redirect('login')
+            try:
+                register_user(
+                    username=form.cleaned_data['username'],
+                    email=form.cleaned_data['email'],
+                    password=form.cleaned_data['password'],
+                    full_name=form.cleaned_data['full_name'],
+                    phone=form.cleaned_data.get('phone', ''),
+                )
+            except RegistrationError as e:
+                form.add_error(e.field, e.message)
+            else:
+                messages.success(request, 'Account created. You can now log in.')
+                return redirect('login')
     else:
         form = RegistrationForm()
 
@@ -192,16 +296,19 @@ def login_view(request):
             password = form.cleaned_data['password']
             remember = form.cleaned_data.get('remember_me', False)
 
-            user = authenticate(request, username=username, password=password)
-            if user is None:
-                # maybe they typed their email instead of username
-                try:
-                    user_obj = User.objects.get(email__iexact=username)
-                    user = authenticate(request, username=user_obj.username, password=password)
-                except User.DoesNotExist:
-                    user = None
+            # the username or email is looked up once, for the throttle and the backend
+            account = find_account(username)
+            throttle_keys = login_throttle_keys(request, username, account)
+
+            # too many failures from this ip or for this account, dont even hash
+            if login_throttled(throttle_keys):
+                messages.error(request, 'Too many failed attempts. Please try again later.')
+                return render(request, 'login.html', {'form': form})
+
+            user = authenticate(request, username=username, password=password, account=account)
 
             if user is not None:
+                reset_login_failures(throttle_keys)
                 login(request, user)
                 # if they didnt check remember me the session dies when browser closes
                 if not remember:
@@ -209,6 +316,7 @@ def login_view(request):
                 messages.success(request, f'Welcome back, {user.first_name or user.username}!')
                 return redirect('home')
             else:
+                record_login_failure(throttle_keys)
                 messages.error(request, 'Invalid username or password.')
     else:
         form = LoginForm()
@@ -225,7 +333,7 @@ def logout_view(request):
 @login_required
 def profile_view(request):
     profile, created = UserProfile.objects.get_or_create(user=request.user)
-    return render(request, 'profile.html', {'profile': profile})
+    return render(request, 'profile.html', {'profile': profile, 'activity': activity.summary(request.user)})
 
 
 @login_required
@@ -234,6 +342,8 @@ def edit_profile(request):
 
     if request.method == 'POST':
         form = ProfileEditForm(request.POST, request.FILES)
+        # a picture over the size cap was dropped while it was still uploading
+        reject_oversized(request, form)
         if form.is_valid():
             user = request.user
             names = form.cleaned_data['full_name'].split(' ', 1)
@@ -242,9 +352,18 @@ def edit_profile(request):
             user.email = form.cleaned_data['email']
             if form.cleaned_data.get('new_password'):
                 user.set_password(form.cleaned_data['new_password'])
-            user.save()
+
+            # the email index is unique, someone else may already use it
+            try:
+                with transaction.atomic():
+                    user.save()
+            except IntegrityError:
+                user.refresh_from_db()
+                form.add_error('email', 'An account with this email already exists.')
+                return render(request, 'edit_profile.html', {'form': form, 'profile': profile})
 
             profile.phone = form.cleaned_data.get('phone', '')
+            # the old picture is cleaned up by the post_save signal
             if form.cleaned_data.get('profile_picture'):
                 profile.profile_picture = form.cleaned_data['profile_picture']
             profile.save()
@@ -268,59 +387,51 @@ def edit_profile(request):
 @login_required
 def borrow_book(request, book_id):
     book = get_object_or_404(Book, id=book_id)
+    branches = [stock for stock in book.stock.select_related('branch') if stock.available_copies > 0]
 
-    if not book.is_available():
+    if not branches:
+        borrow_outcomes.inc(action='borrow', outcome='unavailable')
         messages.error(request, 'This book has no available copies right now.')
         return redirect('book_detail', id=book.id)
 
-    # make sure they dont already have this book out
-    already_borrowing = BorrowRecord.objects.filter(
-        user=request.user, book=book, is_returned=False
-    ).exists()
-    if already_borrowing:
-        messages.error(request, 'You already have this book borrowed.')
-        return redirect('book_detail', id=book.id)
-
-    # students can only have 5 books at a time
-    active_borrows = BorrowRecord.objects.filter(user=request.user, is_returned=False).count()
-    if active_borrows >= 5:
-        messages.error(request, 'You have reached the maximum of 5 borrowed books.')
+    try:
+        circulation.check_can_borrow(request.user, book)
+    except circulation.CirculationError as e:
+        borrow_outcomes.inc(action='borrow', outcome=e.outcome)
+        messages.error(request, e.message)
         return redirect('book_detail', id=book.id)
 
     if request.method == 'POST':
-        due = timezone.now().date() + timedelta(days=14)
-        BorrowRecord.objects.create(
-            user=request.user,
-            book=book,
-            due_date=due,
-        )
-        # decrease available copies since the book is now borrowed
-        book.available_copies -= 1
-        book.save()
-        messages.success(request, f'You have borrowed "{book.title}". Due date: {due}.')
+        # no branch picked means whichever has a copy on the shelf
+        branch = None
+        if request.POST.get('branch'):
+            branch = get_object_or_404(Branch, id=request.POST['branch'])
+        try:
+            record = circulation.borrow(request.user, book, branch)
+        except circulation.CirculationError as e:
+            borrow_outcomes.inc(action='borrow', outcome=e.outcome)
+            messages.error(request, e.message)
+            return redirect('book_detail', id=book.id)
+        borrow_outcomes.inc(action='borrow', outcome='borrowed')
+        messages.success(request, f'You have borrowed "{book.title}". Due date: {record.due_date}.')
         return redirect('my_books')
 
-    return render(request, 'borrow_book.html', {'book': book})
+    return render(request, 'borrow_book.html', {'book': book, 'branches': branches})
 
 
 @login_required
 def return_book(request, record_id):
-    record = get_object_or_404(BorrowRecord, id=record_id, user=request.user)
+    record = get_object_or_404(BorrowRecord.objects.select_related('book'), id=record_id, user=request.user)
 
-    if record.is_returned:
-        messages.error(request, 'This book has already been returned.')
+    try:
+        circulation.return_record(record)
+    except circulation.CirculationError as e:
+        borrow_outcomes.inc(action='return', outcome=e.outcome)
+        messages.error(request, e.message)
         return redirect('my_books')
 
-    record.is_returned = True
-    record.return_date = timezone.now().date()
-    record.save()
-
-    # give the copy back to the available pool
-    book = record.book
-    book.available_copies += 1
-    book.save()
-
-    messages.success(request, f'You have returned "{book.title}".')
+    borrow_outcomes.inc(action='return', outcome='returned')
+    messages.success(request, f'You have returned "{record.book.title}".')
     return redirect('my_books')
 
 
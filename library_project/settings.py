@@ -25,11 +25,13 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'library.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'library.profiling.ProfilingMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'library.middleware.VisitLoggingMiddleware',
@@ -38,12 +40,38 @@ MIDDLEWARE = [
 
 ROOT_URLCONF = 'library_project.urls'
 
+# per request cProfile capture for staff, removed from the stack entirely when off
+PROFILING_ENABLED = os.environ.get('DJANGO_PROFILING', 'False').lower() == 'true'
+PROFILING_RING_SIZE = 20
+# with several worker processes point PROFILING_DIR at a directory they all share,
+# otherwise /admin/profiles/ only lists what the answering worker captured
+PROFILING_DIR = os.environ.get('DJANGO_PROFILING_DIR') or None
+
+# /metrics for prometheus, open to staff and to scrapers sending
+# `Authorization: Bearer <METRICS_TOKEN>`. METRICS_ALLOWED_IPS is only for scrapers
+# that reach the app directly, never behind a proxy on the same host.
+# with several worker processes point METRICS_DIR at a directory they all share
+# and each scrape adds their numbers together
+METRICS_TOKEN = os.environ.get('DJANGO_METRICS_TOKEN') or None
+METRICS_ALLOWED_IPS = [ip for ip in os.environ.get('DJANGO_METRICS_ALLOWED_IPS', '').split(',') if ip]
+METRICS_DIR = os.environ.get('DJANGO_METRICS_DIR') or None
+METRICS_FLUSH_INTERVAL = 5
+
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # DjangoTemplates with render timing for /metrics
+        'NAME': 'django',
+        'BACKEND': 'library.metrics.InstrumentedDjangoTemplates',
         'DIRS': [BASE_DIR / 'templates'],
-        'APP_DIRS': True,
         'OPTIONS': {
+            # compiled templates are kept in memory, in DEBUG the autoreloader
+            # clears them when a template file changes
+            'loaders': [
+                ('django.template.loaders.cached.Loader', [
+                    'django.template.loaders.filesystem.Loader',
+                    'django.template.loaders.app_directories.Loader',
+                ]),
+            ],
             'context_processors': [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
@@ -53,6 +81,52 @@ TEMPLATES = [
     },
 ]
 
+# engine for the catalog pages (home, book list, category books). 'jinja2' renders
+# the ports in jinja2/ and shares base.html and includes/ with the django engine,
+# everything else stays on django
+CATALOG_TEMPLATE_ENGINE = os.environ.get('DJANGO_CATALOG_TEMPLATES', 'django')
+
+JINJA2_TEMPLATES = {
+    'NAME': 'jinja2',
+    'BACKEND': 'library.jinja2_env.InstrumentedJinja2',
+    'DIRS': [BASE_DIR / 'jinja2', BASE_DIR / 'templates'],
+    'OPTIONS': {
+        'environment': 'library.jinja2_env.environment',
+        'autoescape': True,
+        # base.html needs user and messages like the django version
+        'context_processors': [
+            'django.template.context_processors.request',
+            'django.contrib.auth.context_processors.auth',
+            'django.contrib.messages.context_processors.messages',
+        ],
+    },
+}
+
+if CATALOG_TEMPLATE_ENGINE == 'jinja2':
+    TEMPLATES.append(JINJA2_TEMPLATES)
+
+# background tasks, run by manage.py run_worker
+TASK_WORKER_THREADS = int(os.environ.get('DJANGO_TASK_WORKER_THREADS', 4))
+TASK_MAX_ATTEMPTS = 5
+# seconds a claimed task stays hidden from other workers before it is retried
+TASK_VISIBILITY_TIMEOUT = 300
+TASK_RETRY_BACKOFF = 10
+TASK_RETRY_BACKOFF_MAX = 3600
+TASK_KEEP_FINISHED_DAYS = 7
+
+# branch (by code) that new copies go to when none is picked
+LIBRARY_DEFAULT_BRANCH = os.environ.get('DJANGO_LIBRARY_DEFAULT_BRANCH', 'MAIN')
+# codes the circulation desk accepts in one scan request
+DESK_BATCH_LIMIT = 50
+
+# event log (library/events.py), written by a background thread in each process
+EVENT_FLUSH_INTERVAL = 1.0
+EVENT_BATCH_SIZE = 500
+# events kept in memory while the database is unreachable, later ones are dropped
+EVENT_BUFFER_MAX = 50000
+# monthly partitions older than this are dropped by manage.py event_partitions (PostgreSQL)
+EVENT_KEEP_MONTHS = 24
+
 WSGI_APPLICATION = 'library_project.wsgi.application'
 
 DATABASES = {
@@ -62,6 +136,64 @@ DATABASES = {
     }
 }
 
+# a shared cache is needed for cached sessions across several workers. the home page
+# "for you" lists are kept 5 minutes instead of a day when the cache is per process
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get('DJANGO_CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('DJANGO_CACHE_LOCATION', ''),
+    }
+}
+
+# session storage: db (default), cached_db, write_behind (cache first, db refreshed
+# every SESSION_WRITE_BEHIND_SECONDS, needs a shared cache) or signed_cookies (no
+# server side storage at all)
+SESSION_BACKENDS = {
+    'db': 'django.contrib.sessions.backends.db',
+    'cached_db': 'django.contrib.sessions.backends.cached_db',
+    'write_behind': 'library.sessions',
+    'signed_cookies': 'django.contrib.sessions.backends.signed_cookies',
+}
+SESSION_ENGINE = SESSION_BACKENDS[os.environ.get('DJANGO_SESSION_BACKEND', 'db')]
+SESSION_WRITE_BEHIND_SECONDS = 60
+
+AUTHENTICATION_BACKENDS = ['library.auth.EmailOrUsernameBackend']
+
+# addresses of our own reverse proxies. requests from them are attributed to the
+# client in X-Forwarded-For, for the login and contact throttles
+TRUSTED_PROXIES = [ip for ip in os.environ.get('DJANGO_TRUSTED_PROXIES', '127.0.0.1,::1').split(',') if ip]
+
+# failed logins allowed per ip / per account before we stop checking passwords
+LOGIN_FAILURE_LIMIT_IP = 20
+LOGIN_FAILURE_LIMIT_ACCOUNT = 5
+LOGIN_FAILURE_WINDOW = 15 * 60
+
+# contact form token buckets: a burst of messages, then this many per hour
+CONTACT_IP_BURST = 5
+CONTACT_IP_PER_HOUR = 10
+CONTACT_EMAIL_BURST = 3
+CONTACT_EMAIL_PER_HOUR = 5
+# the same message from the same address within this many seconds is dropped
+CONTACT_DEDUP_WINDOW = 60 * 60
+
+# preferred hasher first, the rest are only kept to verify older hashes
+PASSWORD_HASHER_CHOICES = {
+    'pbkdf2': 'library.hashers.TunedPBKDF2PasswordHasher',
+    'scrypt': 'library.hashers.TunedScryptPasswordHasher',
+    'argon2': 'django.contrib.auth.hashers.Argon2PasswordHasher',  # needs argon2-cffi
+}
+_preferred_hasher = PASSWORD_HASHER_CHOICES[os.environ.get('DJANGO_PASSWORD_HASHER', 'pbkdf2')]
+PASSWORD_HASHERS = [_preferred_hasher] + [
+    hasher for hasher in PASSWORD_HASHER_CHOICES.values() if hasher != _preferred_hasher
+] + ['library.hashers.WrappedPBKDF2PasswordHasher']
+
+# pick these with `manage.py bench_hashers --budget-ms ...`
+PASSWORD_PBKDF2_ITERATIONS = int(os.environ.get('DJANGO_PBKDF2_ITERATIONS', 1_000_000))
+PASSWORD_SCRYPT_WORK_FACTOR = 2 ** 14
+PASSWORD_PROVISIONING_ITERATIONS = 1000
+# provisioned hashes wrapped per rehash_provisioned_passwords task
+PASSWORD_REHASH_BATCH_SIZE = 50
+
 AUTH_PASSWORD_VALIDATORS = [
     {'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator'},
     {'NAME': 'django.contrib.auth.password_validation.MinimumLengthValidator'},
@@ -82,6 +214,29 @@ STATIC_ROOT = BASE_DIR / 'staticfiles'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# uploads are stored once per content hash under media/blobs/
+STORAGES = {
+    'default': {'BACKEND': 'library.uploads.DedupFileSystemStorage'},
+    'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+}
+# media is served by library.media.serve_media. 'x-accel' (nginx) or 'x-sendfile'
+# (apache, lighttpd) hands the file back to the web server after the checks
+MEDIA_SENDFILE = os.environ.get('DJANGO_MEDIA_SENDFILE') or None
+# nginx internal location that maps onto MEDIA_ROOT
+MEDIA_ACCEL_PREFIX = '/protected-media/'
+# blobs are cached for a year, anything else for this long
+MEDIA_CACHE_SECONDS = 3600
+MEDIA_UPLOAD_MAX_SIZE = int(os.environ.get('DJANGO_MEDIA_UPLOAD_MAX_SIZE', 5 * 1024 * 1024))
+# checked from the image header, guards against tiny files that decode to huge images
+MEDIA_IMAGE_MAX_PIXELS = 40_000_000
+# anything bigger than this goes to a temp file in chunks instead of memory
+FILE_UPLOAD_MAX_MEMORY_SIZE = 256 * 1024
+FILE_UPLOAD_HANDLERS = [
+    'library.uploads.LimitedUploadHandler',
+    'django.core.files.uploadhandler.MemoryFileUploadHandler',
+    'django.core.files.uploadhandler.TemporaryFileUploadHandler',
+]
+
 # needed for https on pythonanywhere
 CSRF_TRUSTED_ORIGINS = [
     'https://*.pythonanywhere.com',
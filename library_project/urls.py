@@ -4,13 +4,20 @@ from django.conf import settings
 from django.conf.urls.static import static
 from django.shortcuts import render
 
+from library import media, metrics, profiling
+
 urlpatterns = [
+    # request profiles sit under /admin/ but arent part of the admin site
+    path('admin/profiles/', profiling.profile_list, name='profile_list'),
+    path('admin/profiles/<slug:profile_id>/', profiling.profile_detail, name='profile_detail'),
+    path('admin/profiles/<slug:profile_id>/collapsed/', profiling.profile_collapsed, name='profile_collapsed'),
     path('admin/', admin.site.urls),
+    path('metrics', metrics.metrics_view, name='metrics'),
+    # uploads, with caching headers and byte ranges. works with DEBUG off as well
+    path(settings.MEDIA_URL.lstrip('/') + '<path:path>', media.serve_media, name='media'),
     path('', include('library.urls')),
 ]
 
-urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
-
 if settings.DEBUG:
     urlpatterns += static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
 